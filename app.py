@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, send_file, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, send_file, jsonify, redirect, url_for, session, make_response
 from jinja2 import TemplateSyntaxError
 try:
     from docxtpl.exceptions import TemplateError as DocxTplTemplateError
@@ -7,14 +7,31 @@ except Exception:
 import os
 import tempfile
 # import pandas as pd  # 延迟导入以避免启动时超时
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import threading
 import time
 from pathlib import Path
+from urllib.parse import quote
 import re
 import json
+import hashlib
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import MultiDict
+from customer_snapshot import CustomerSnapshotService
+from result_cache import ResultCache
+from export_cache import ExportCache
+from stage_writer import StageWriteQueue
+from export_jobs import ExportJobManager, ExportQueueFull, JOB_DONE, JOB_FAILED
+from streaming_export import iter_xlsx, iter_csv, iter_frame_rows, XLSX_MIMETYPE, CSV_MIMETYPE
+from customer_index import MATCH_EXACT, MATCH_PREFIX, MATCH_SUBSTRING, MATCH_OVERLAP
+from customer_query import (
+    normalize_zone, find_zone_column,
+    build_derived_columns,
+    format_amount, format_arr_display, format_contract_display, expiry_label,
+    parse_query_spec, encode_cursor, decode_cursor, project_records,
+    QuerySpec, STAGE_STATUSES
+)
 
 # 全局变量用于延迟导入
 pd = None
@@ -111,11 +128,6 @@ else:
 
 # 存储最后导入时间
 last_import_time = None
-_cached_df = None
-_cached_mtime = None
-_cached_path = None
-_cached_loaded_at = None
-_cache_ttl_seconds = 300
 
 # 初始化状态管理器（按请求动态选择数据文件，不在启动时绑定固定Excel）
 stage_manager = None
@@ -135,6 +147,78 @@ def get_user_excel_path():
         logger.warning(f"数据文件不存在: {path}")
     return path
 
+# 客户数据快照服务：所有读写路径共用，避免每个请求重复解析Excel
+customer_snapshots = CustomerSnapshotService(
+    get_user_excel_path,
+    ttl_seconds=300,
+    stale_while_revalidate=os.environ.get('SNAPSHOT_STALE_WHILE_REVALIDATE', 'true').lower() == 'true'
+)
+
+# 查询结果缓存：键 = (接口, 快照版本, 归一化参数, 当天日期)；新快照发布（上传/阶段更新/文件变化）时清空
+query_result_cache = ResultCache(
+    max_entries=int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 256)),
+    max_bytes=int(os.environ.get('RESULT_CACHE_MAX_MB', 32)) * 1024 * 1024
+)
+customer_snapshots.subscribe(lambda snapshot: query_result_cache.invalidate(f'（快照版本 {snapshot.version}）'))
+
+# 导出文件磁盘缓存：键 = (快照内容哈希, 筛选条件, 格式)，文件名前缀为工作簿哈希；
+# 工作簿本身变化（上传/压实）时清除旧工作簿的文件，阶段变更只改变内容哈希，旧条目按 LRU 淘汰
+export_cache = ExportCache(
+    os.environ.get('EXPORT_CACHE_DIR') or os.path.join(os.getcwd(), 'export_cache'),
+    max_bytes=int(os.environ.get('EXPORT_CACHE_MAX_MB', 256)) * 1024 * 1024,
+    max_entries=int(os.environ.get('EXPORT_CACHE_MAX_ENTRIES', 64))
+)
+_export_cache_file_hash = None
+
+
+def _prune_export_cache(snapshot):
+    """快照发布回调（持有服务锁）：工作簿哈希变化时才清理，文件删除放到后台线程，不阻塞读者"""
+    global _export_cache_file_hash
+    if snapshot.file_hash == _export_cache_file_hash:
+        return
+    _export_cache_file_hash = snapshot.file_hash
+    threading.Thread(target=export_cache.prune, kwargs={'keep_hash': snapshot.file_hash},
+                     name='export-cache-prune', daemon=True).start()
+
+
+customer_snapshots.subscribe(_prune_export_cache)
+
+# 后台导出任务：有界线程池执行，结果保留 EXPORT_JOB_TTL_SECONDS 秒
+export_jobs = ExportJobManager(
+    os.environ.get('EXPORT_JOB_DIR') or os.path.join(os.getcwd(), 'export_jobs'),
+    max_workers=int(os.environ.get('EXPORT_JOB_WORKERS', 1)),
+    max_pending=int(os.environ.get('EXPORT_JOB_MAX_PENDING', 4)),
+    ttl_seconds=int(os.environ.get('EXPORT_JOB_TTL_SECONDS', 3600))
+)
+
+# 阶段变更日志定时压实（秒，0 表示只在调用 /stage_journal/compact 时压实）
+STAGE_JOURNAL_COMPACT_INTERVAL = int(os.environ.get('STAGE_JOURNAL_COMPACT_INTERVAL', 900))
+
+
+def stage_journal_compactor():
+    """后台压实线程：定期把阶段变更日志写回工作簿"""
+    while True:
+        time.sleep(STAGE_JOURNAL_COMPACT_INTERVAL)
+        try:
+            customer_snapshots.compact('（定时）')
+        except Exception as e:
+            logger.error(f"阶段变更日志定时压实失败: {str(e)}")
+
+
+if STAGE_JOURNAL_COMPACT_INTERVAL > 0:
+    threading.Thread(target=stage_journal_compactor, name='stage-journal-compactor', daemon=True).start()
+
+# 单条阶段变更经合并写入队列：突发点击/监控批量推进合并为一次日志追加+一次快照发布
+stage_write_queue = StageWriteQueue(
+    customer_snapshots,
+    flush_interval=int(os.environ.get('STAGE_WRITE_FLUSH_MS', 50)) / 1000,
+    max_batch=int(os.environ.get('STAGE_WRITE_MAX_BATCH', 100))
+)
+
+# 批量查询每个公司名称默认返回的最大条数（请求可用 top_k 覆盖）；/query_customer 默认返回全部匹配
+NAME_SEARCH_TOP_K = int(os.environ.get('NAME_SEARCH_TOP_K', 50))
+NAME_MATCH_TYPES = {MATCH_EXACT: 'exact', MATCH_PREFIX: 'prefix', MATCH_SUBSTRING: 'substring', MATCH_OVERLAP: 'fuzzy'}
+
 # 自动监控相关变量
 auto_monitor_enabled = False
 monitor_thread = None
@@ -144,82 +228,6 @@ monitor_results = {'recent_contracts': [], 'updated_contracts': [], 'last_check'
 # 已处理文件记录（文件路径 -> 处理时间戳）
 processed_files = {}
 
-# 销售代表姓名标准化函数
-def normalize_sales_name(sales_name):
-    """
-    标准化销售代表姓名，解决大小写不一致问题
-    例如：Esther.zhu 和 Esther.Zhu 都标准化为 Esther.Zhu
-    """
-    if not sales_name or str(sales_name).lower() == 'nan':
-        return ''
-    
-    # 检查是否为pandas的NaN值
-    try:
-        pd = ensure_pandas_imported()
-        if pd.isna(sales_name):
-            return ''
-    except:
-        # 如果pandas不可用，使用简单的检查
-        if sales_name is None or (hasattr(sales_name, '__len__') and len(str(sales_name).strip()) == 0):
-            return ''
-    
-    name = str(sales_name).strip()
-    if not name:
-        return ''
-    
-    # 特殊处理已知的销售代表姓名
-    name_lower = name.lower()
-    if name_lower == 'esther.zhu':
-        return 'Esther.Zhu'
-    elif name_lower == 'mia.mi':
-        return 'Mia.Mi'
-    
-    # 对于其他姓名，保持原有格式但确保首字母大写
-    return name
-
-def get_normalized_sales_person(row):
-    """
-    从数据行中获取标准化的销售代表姓名
-    优先使用续费责任销售，如果为空则使用责任销售中英文
-    """
-    sales_raw = row.get('续费责任销售', '')
-    
-    # 检查是否为空值
-    is_empty = False
-    if not sales_raw or sales_raw == '' or str(sales_raw).lower() == 'nan':
-        is_empty = True
-    else:
-        # 检查是否为pandas的NaN值
-        try:
-            pd = ensure_pandas_imported()
-            if pd.isna(sales_raw):
-                is_empty = True
-        except:
-            pass
-    
-    if is_empty:
-        sales_person = str(row.get('责任销售中英文', ''))
-    else:
-        sales_person = str(sales_raw)
-    
-    return normalize_sales_name(sales_person)
-
-# 战区名称标准化函数（去掉“战区/大区/区”后缀，统一空格）
-def normalize_zone(zone_name):
-    if zone_name is None:
-        return ''
-    name = str(zone_name).strip()
-    if not name or name.lower() == 'nan':
-        return ''
-    # 去除全角空格
-    name = name.replace('\u3000', ' ').strip()
-    try:
-        # 去掉末尾后缀：战区/大区/区
-        name = re.sub(r'(战区|大区|区)$', '', name)
-    except Exception:
-        pass
-    return name.strip()
-
 # 健康检查端点
 @app.route('/health')
 def health_check():
@@ -234,7 +242,14 @@ def health_check():
                 'flask': 'available',
                 'template_handler': 'available' if TEMPLATE_HANDLER_AVAILABLE else 'unavailable',
                 'ocr_service': 'available' if ocr_service else 'unavailable'
-            }
+            },
+            'customer_snapshot': customer_snapshots.stats(),
+            'result_cache': query_result_cache.stats(),
+            'export_cache': export_cache.stats(),
+            'export_jobs': export_jobs.stats(),
+            'stage_journal': customer_snapshots.journal_for().stats() if customer_snapshots.use_journal else None,
+            'stage_write_queue': stage_write_queue.stats(),
+            'write_coordinator': customer_snapshots.write_lock.stats()
         }), 200
     except Exception as e:
         return jsonify({
@@ -289,71 +304,97 @@ def login_required(func):
     wrapper.__name__ = func.__name__
     return wrapper
 
-# 加载Excel数据
-def load_customer_data():
-    global last_import_time
-    excel_path = get_user_excel_path()
-    try:
-        if not os.path.exists(excel_path):
-            logger.error(f"文件不存在: {excel_path}")
-            return None
-        pd = ensure_pandas_imported()
-        df = pd.read_excel(excel_path)
-        # 统一常见列名别名，兼容不同数据来源
-        try:
-            if '用户ID' not in df.columns and '简道云ID' in df.columns:
-                df.rename(columns={'简道云ID': '用户ID'}, inplace=True)
-            if '到期日期' not in df.columns and '到期时间' in df.columns:
-                df.rename(columns={'到期时间': '到期日期'}, inplace=True)
-            if '到期日期' not in df.columns and '试用到期时间' in df.columns:
-                df.rename(columns={'试用到期时间': '到期日期'}, inplace=True)
-            if '公司名称' not in df.columns and '账号-企业名称' in df.columns:
-                df.rename(columns={'账号-企业名称': '公司名称'}, inplace=True)
-        except Exception:
-            pass
-        return df
-    except Exception as e:
-        logger.error(f"Excel加载错误: {str(e)}")
-        return None
+def _normalized_query_args():
+    """查询参数归一化：去空白、逗号分隔的多值排序去重，保证等价请求命中同一缓存键"""
+    items = []
+    for key in sorted(request.args.keys()):
+        values = []
+        for value in request.args.getlist(key):
+            parts = [p.strip() for p in str(value).split(',') if p.strip()]
+            values.append(','.join(sorted(set(parts))))
+        items.append((key, tuple(values)))
+    return tuple(items)
+
+def cached_result(func):
+    """GET 查询接口的结果缓存：成功的 JSON 响应体按 (接口, 快照版本, 参数, 日期) 缓存"""
+    def wrapper(*args, **kwargs):
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return func(*args, **kwargs)
+        today = datetime.now().date()
+        key = (func.__name__, snapshot.path, snapshot.version, _normalized_query_args(), today)
+        body = query_result_cache.get(key)
+        if body is not None:
+            response = app.response_class(body, mimetype='application/json')
+            response.headers['X-Result-Cache'] = 'HIT'
+            return response
+        response = make_response(func(*args, **kwargs))
+        if response.status_code == 200 and response.mimetype == 'application/json':
+            query_result_cache.put(key, response.get_data(), day=today)
+        response.headers['X-Result-Cache'] = 'MISS'
+        return response
+    wrapper.__name__ = func.__name__
+    return wrapper
 
-def get_cached_df():
-    global _cached_df, _cached_mtime, _cached_path, _cached_loaded_at
-    excel_path = get_user_excel_path()
-    if not os.path.exists(excel_path):
+def _snapshot_validator():
+    """客户数据快照的校验值：工作簿内容哈希（多进程间一致），缺失时退回快照版本号"""
+    snapshot = get_cached_snapshot()
+    if snapshot is None:
         return None
+    return snapshot.content_hash or f'v{snapshot.version}'
+
+def _file_validator(path):
+    """追加写文件（日记、状态日志）的校验值：修改时间 + 大小"""
     try:
-        mtime = os.path.getmtime(excel_path)
-    except Exception:
-        mtime = None
-    now_ts = time.time()
-    if _cached_df is not None and _cached_mtime == mtime and _cached_path == excel_path and _cached_loaded_at is not None and (now_ts - _cached_loaded_at) <= _cache_ttl_seconds:
-        return _cached_df
-    try:
-        pd = ensure_pandas_imported()
-        df = pd.read_excel(excel_path)
-        try:
-            if '用户ID' not in df.columns and '简道云ID' in df.columns:
-                df.rename(columns={'简道云ID': '用户ID'}, inplace=True)
-            if '到期日期' not in df.columns and '到期时间' in df.columns:
-                df.rename(columns={'到期时间': '到期日期'}, inplace=True)
-            if '到期日期' not in df.columns and '试用到期时间' in df.columns:
-                df.rename(columns={'试用到期时间': '到期日期'}, inplace=True)
-            if '公司名称' not in df.columns and '账号-企业名称' in df.columns:
-                df.rename(columns={'账号-企业名称': '公司名称'}, inplace=True)
-        except Exception:
-            pass
-        try:
-            if '到期日期' in df.columns:
-                df['到期日期'] = pd.to_datetime(df['到期日期'], errors='coerce')
-        except Exception:
-            pass
-        _cached_df = df
-        _cached_mtime = mtime
-        _cached_path = excel_path
-        _cached_loaded_at = now_ts
-        return _cached_df
-    except Exception:
-        return None
+        stat = os.stat(path)
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+    except OSError:
+        return 'missing'
+
+def _diary_path():
+    return os.path.join(os.getcwd(), 'uploads', 'sales_diary.jsonl')
+
+def _stage_log_path():
+    return os.path.join(os.getcwd(), 'logs', 'stage_changes.log')
+
+def conditional_get(*validators):
+    """GET 接口的强 ETag：由数据校验值 + 归一化参数 + 当天日期生成，If-None-Match 命中时直接返回304"""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET':
+                return func(*args, **kwargs)
+            tokens = [validator() for validator in validators]
+            if any(token is None for token in tokens):
+                return func(*args, **kwargs)
+            raw = json.dumps([func.__name__, tokens, _normalized_query_args(), datetime.now().date().isoformat()],
+                             ensure_ascii=False)
+            etag = hashlib.sha1(raw.encode('utf-8')).hexdigest()[:32]
+            if request.if_none_match.contains(etag):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(func(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+# 加载Excel数据（统一走快照服务）
+def load_customer_data():
+    return get_cached_df()
+
+def get_cached_df():
+    # 调用方依赖模块级 pd，保持导入副作用
+    ensure_pandas_imported()
+    return customer_snapshots.get_df()
+
+def get_cached_snapshot():
+    """获取当前客户数据快照（含物化派生列），不可用时返回None"""
+    ensure_pandas_imported()
+    return customer_snapshots.get()
 
 @app.route('/')
 @login_required
@@ -366,8 +407,9 @@ def index():
 # 销售跟进日记：支持GET/POST，采用JSONL追加，不覆盖
 @app.route('/sales_diary', methods=['GET', 'POST'])
 @login_required
+@conditional_get(lambda: _file_validator(_diary_path()))
 def sales_diary():
-    diary_path = os.path.join(os.getcwd(), 'uploads', 'sales_diary.jsonl')
+    diary_path = _diary_path()
     os.makedirs(os.path.dirname(diary_path), exist_ok=True)
     if request.method == 'POST':
         try:
@@ -428,15 +470,13 @@ def verify_jdy_account():
         if not os.path.exists(excel_path):
             return jsonify({'success': False, 'error': '数据文件不存在'}), 500
 
-        pd = ensure_pandas_imported()
-        try:
-            df = pd.read_excel(excel_path)
-        except Exception as e:
-            logger.error(f"读取Excel失败: {str(e)}")
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
             return jsonify({'success': False, 'error': '数据文件读取失败'}), 500
+        df = snapshot.df
 
-        # 统一为字符串进行匹配（包含匹配，兼容完整或部分输入）
-        matches = df[df['用户ID'].astype(str).str.contains(jdy_account, case=False, na=False)]
+        # 用户ID索引匹配：精确优先，未命中时按部分ID匹配（兼容完整或部分输入）
+        matches = df.iloc[snapshot.find_rows(jdy_account, allow_partial=True)]
         exists = not matches.empty
         info = None
         if exists:
@@ -456,12 +496,13 @@ def verify_jdy_account():
 # 单账号历史跟进记录查询：返回该账号的所有历史记录（完整信息）
 @app.route('/sales_diary_query', methods=['GET'])
 @login_required
+@conditional_get(lambda: _file_validator(_diary_path()), _snapshot_validator)
 def sales_diary_query():
     try:
         jdy_account = str(request.args.get('jdy_account', '')).strip()
         if not jdy_account:
             return jsonify({'success': False, 'error': '请提供简道云账号'}), 400
-        diary_path = os.path.join(os.getcwd(), 'uploads', 'sales_diary.jsonl')
+        diary_path = _diary_path()
         entries = []
 
         # 1) 读取 JSONL 追加的跟进日记
@@ -483,25 +524,13 @@ def sales_diary_query():
 
         # 2) 兼容从 Excel 中读取“跟进记录/跟进日期”并合并（只读，不写）
         try:
-            excel_path = get_user_excel_path()
-            if os.path.exists(excel_path):
+            # 快照服务已统一列名别名（简道云ID/账号-企业名称/跟进时间/跟进日记）
+            snapshot = customer_snapshots.get()
+            if snapshot is not None:
                 pd = ensure_pandas_imported()
-                df = pd.read_excel(excel_path)
-                # 列名归一化
-                try:
-                    if '用户ID' not in df.columns and '简道云ID' in df.columns:
-                        df.rename(columns={'简道云ID': '用户ID'}, inplace=True)
-                    if '公司名称' not in df.columns and '账号-企业名称' in df.columns:
-                        df.rename(columns={'账号-企业名称': '公司名称'}, inplace=True)
-                    if '跟进日期' not in df.columns and '跟进时间' in df.columns:
-                        df.rename(columns={'跟进时间': '跟进日期'}, inplace=True)
-                    if '跟进记录' not in df.columns and '跟进日记' in df.columns:
-                        df.rename(columns={'跟进日记': '跟进记录'}, inplace=True)
-                except Exception:
-                    pass
-
+                df = snapshot.df
                 if '用户ID' in df.columns:
-                    matches = df[df['用户ID'].astype(str).str.contains(jdy_account, case=False, na=False)]
+                    matches = df.iloc[snapshot.find_rows(jdy_account, allow_partial=True)]
                     for _, row in matches.iterrows():
                         note = row.get('跟进记录', '')
                         date_val = row.get('跟进日期', '')
@@ -544,13 +573,14 @@ def upload_excel():
         if not file.filename.endswith('.xlsx'):
             return jsonify({'error': '请上传Excel文件(.xlsx)'}), 400
 
-        # 原子写入保存文件：临时文件 + os.replace
+        # 原子写入保存文件：临时文件 + 跨进程写锁内 os.replace
+        # 新文件为准：同时丢弃未压实的阶段变更，立即重建快照并生成列式旁路文件
         target_path = get_user_excel_path()
         tmp_fd, tmp_path = tempfile.mkstemp(prefix='upload_', suffix='.xlsx', dir=os.path.dirname(target_path))
         os.close(tmp_fd)
         try:
             file.save(tmp_path)
-            os.replace(tmp_path, target_path)
+            customer_snapshots.replace_workbook(tmp_path, '(上传新文件)')
         except Exception as save_err:
             try:
                 if os.path.exists(tmp_path):
@@ -560,12 +590,7 @@ def upload_excel():
             logger.error(f"保存文件失败: {str(save_err)}")
             return jsonify({'error': f'文件保存失败: {str(save_err)}'}), 500
         
-        global _cached_df, _cached_mtime, _cached_path, _cached_loaded_at
         last_import_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        _cached_df = None
-        _cached_mtime = None
-        _cached_path = None
-        _cached_loaded_at = None
         
         return jsonify({
             'message': '文件上传成功',
@@ -609,25 +634,22 @@ def log_client_error():
         logger.error(f"记录前端错误失败: {str(exc)}")
         return jsonify({'success': False, 'error': '日志记录失败'}), 500
 
-@app.route('/get_monthly_revenue')
-@login_required
-def get_monthly_revenue():
-    """获取本月收款总金额"""
+def _get_monthly_revenue_payload(args, snapshot=None):
+    """本月收款总金额，返回 (payload, HTTP状态码)"""
     try:
         # 检查文件是否存在
         excel_path = get_user_excel_path()
         logger.info(f"尝试读取文件: {excel_path}")
         if not os.path.exists(excel_path):
             logger.error(f"文件不存在: {excel_path}")
-            return jsonify({'revenue': 0, 'error': '数据文件不存在'}), 500
+            return {'revenue': 0, 'error': '数据文件不存在'}, 500
 
-        try:
-            ensure_pandas_imported()
-            df = pd.read_excel(excel_path)
-            logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-        except Exception as e:
-            logger.error(f"Excel读取错误: {str(e)}")
-            return jsonify({'revenue': 0, 'error': '数据文件读取失败'}), 500
+        snapshot = snapshot or get_cached_snapshot()
+        if snapshot is None:
+            logger.error("Excel读取错误: 客户数据快照不可用")
+            return {'revenue': 0, 'error': '数据文件读取失败'}, 500
+        df = snapshot.df
+        logger.info(f"成功读取客户数据快照，共{len(df)}行数据")
 
         # 获取当前月份
         now = datetime.now()
@@ -670,14 +692,23 @@ def get_monthly_revenue():
                             continue
         
         logger.info(f"本月收款总金额: {monthly_revenue}元")
-        return jsonify({'revenue': monthly_revenue})
+        return {'revenue': monthly_revenue}, 200
 
     except Exception as e:
         logger.error(f"获取收款数据失败: {str(e)}")
-        return jsonify({'revenue': 0, 'error': f'获取收款数据失败: {str(e)}'}), 500
+        return {'revenue': 0, 'error': f'获取收款数据失败: {str(e)}'}, 500
+
+@app.route('/get_monthly_revenue')
+@login_required
+@conditional_get(_snapshot_validator)
+def get_monthly_revenue():
+    payload, status = _get_monthly_revenue_payload(request.args)
+    return jsonify(payload), status
 
 @app.route('/get_future_expiring_customers')
 @login_required
+@conditional_get(_snapshot_validator)
+@cached_result
 def get_future_expiring_customers():
     try:
         # 获取筛选参数：支持销售筛选（兼容旧参数）与战区多选筛选
@@ -718,15 +749,10 @@ def get_future_expiring_customers():
             return jsonify({'error': '数据文件不存在'}), 500
 
         try:
-            df = get_cached_df()
+            # 列别名（到期时间 -> 到期日期等）已由快照服务统一处理
+            snapshot = get_cached_snapshot()
+            df = snapshot.df
             logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-            # 列别名兼容：到期时间 -> 到期日期
-            if df is not None and '到期日期' not in df.columns and '到期时间' in df.columns:
-                try:
-                    df.rename(columns={'到期时间': '到期日期'}, inplace=True)
-                    logger.info("兼容列名：将'到期时间'重命名为'到期日期'")
-                except Exception as alias_err:
-                    logger.warning(f"列名兼容失败: {str(alias_err)}")
             # 战区列兼容：支持'战区'、'所属战区'或'归属战区'
             zone_col = None
             if '战区' in df.columns:
@@ -755,78 +781,31 @@ def get_future_expiring_customers():
             return jsonify({'error': f'数据格式错误：缺少必要列 {missing_columns}'}), 500
         
         # 获取当前日期并计算窗口：默认未来第8天到第33天
-        now = datetime.now()
-        today = now.date()
-        window_start = pd.Timestamp(today) + pd.Timedelta(days=min_days)
-        window_end = pd.Timestamp(today) + pd.Timedelta(days=max_days)
-        
-        # 筛选出指定天数范围内（min_days-max_days）将要过期的客户
-        future_customers = []
+        today = datetime.now().date()
 
-        for _, row in df.iterrows():
-            if pd.notna(row['到期日期']):
-                try:
-                    expiry_date = pd.to_datetime(row['到期日期']).normalize()
-                    # 如果过期时间在min_days-max_days窗口内
-                    if window_start <= expiry_date <= window_end:
-                        # 使用标准化函数获取销售代表姓名
-                        sales_person = get_normalized_sales_person(row)
-                        # 战区筛选
-                        if apply_zone_filter:
-                            # 如果战区列缺失（未在前面返回错误），则跳过筛选
-                            if zone_col:
-                                zone_value = row.get(zone_col, '')
-                                # 兼容NaN与字符串空白
-                                try:
-                                    is_nan = pd.isna(zone_value)
-                                except Exception:
-                                    is_nan = False
-                                zone_value_str = '' if (zone_value is None or is_nan) else normalize_zone(zone_value)
-                                if zone_value_str not in zones_list:
-                                    continue
-                        else:
-                            # 兼容旧的销售筛选参数（未启用战区筛选时）
-                            if sales_filter != 'all' and sales_filter != sales_person:
-                                continue
-                        
-                        customer_info = {
-                            'id': str(row.get('用户ID', '')),
-                            'expiry_date': expiry_date.strftime('%Y年%m月%d日'),
-                            'jdy_account': str(row.get('用户ID', '')),
-                            'company_name': str(row.get('账号-企业名称', '')),
-                            'sales_person': sales_person,
-                            'zone': (normalize_zone(row.get(zone_col, '')) if zone_col else '')
-                        }
-                        try:
-                            arr_val = row.get('应续ARR', '')
-                            if pd.notna(arr_val) and str(arr_val).strip() and str(arr_val).lower() != 'nan':
-                                arr_display = f"{float(str(arr_val).replace(',', ''))}元"
-                            else:
-                                arr_display = '0元'
-                        except Exception:
-                            arr_display = '0元'
-                        try:
-                            contract_val = None
-                            for col in ['合同金额', '合同价', '合同总金额', '合同金额（元）']:
-                                cv = row.get(col, '')
-                                if pd.notna(cv) and str(cv).strip() and str(cv).lower() != 'nan':
-                                    contract_val = str(cv)
-                                    break
-                            contract_display = f"{float(str(contract_val).replace(',', '').replace('元',''))}元" if contract_val else '0元'
-                        except Exception:
-                            contract_display = '0元'
-                        customer_info['uid_arr'] = arr_display
-                        customer_info['contract_amount'] = contract_display
-                        customer_info['amount'] = arr_display if arr_display != '0元' else contract_display
-                        
-                        future_customers.append(customer_info)
-                            
-                except Exception as e:
-                    logger.warning(f"日期转换错误: {str(e)}")
-                    continue
-        
-        # 按过期日期排序
-        future_customers.sort(key=lambda x: x['expiry_date'])
+        # 向量化筛选：战区筛选优先，未启用战区筛选时兼容旧的销售筛选参数
+        window, _ = snapshot.window(
+            today, min_days, max_days,
+            zones=zones_list if apply_zone_filter else None,
+            sales_person=None if apply_zone_filter else sales_filter
+        )
+
+        # 仅为命中切片构建返回数据（已按到期日期升序）
+        future_customers = []
+        for record in window.to_dict('records'):
+            arr_display = format_arr_display(record)
+            contract_display = format_contract_display(record)
+            future_customers.append({
+                'id': str(record.get('用户ID', '')),
+                'expiry_date': record['_expiry_day'].strftime('%Y年%m月%d日'),
+                'jdy_account': str(record.get('用户ID', '')),
+                'company_name': str(record.get('账号-企业名称', '')),
+                'sales_person': record['_sales'],
+                'zone': record['_zone'],
+                'uid_arr': arr_display,
+                'contract_amount': contract_display,
+                'amount': arr_display if arr_display != '0元' else contract_display
+            })
         
         logger.info(f"找到{len(future_customers)}个即将过期的客户（销售筛选：{sales_filter}，战区筛选：{zones_list if apply_zone_filter else 'all'}）")
         return jsonify({
@@ -837,50 +816,50 @@ def get_future_expiring_customers():
         logger.error(f"获取未来即将过期客户失败: {str(e)}")
         return jsonify({'error': f'获取未来即将过期客户失败: {str(e)}'}), 500
 
-@app.route('/get_sales_representatives')
-@login_required
-def get_sales_representatives():
+def _get_sales_representatives_payload(args, snapshot=None):
+    """销售代表列表，返回 (payload, HTTP状态码)"""
     try:
         # 检查文件是否存在
         excel_path = get_user_excel_path()
         logger.info(f"尝试读取文件获取销售代表列表: {excel_path}")
         if not os.path.exists(excel_path):
             logger.error(f"文件不存在: {excel_path}")
-            return jsonify({'error': '数据文件不存在'}), 500
+            return {'error': '数据文件不存在'}, 500
 
         try:
-            df = get_cached_df()
+            snapshot = snapshot or get_cached_snapshot()
+            df = snapshot.df
             logger.info(f"成功读取Excel文件，共{len(df)}行数据")
         except Exception as e:
             logger.error(f"Excel读取错误: {str(e)}")
-            return jsonify({'error': '数据文件读取失败'}), 500
+            return {'error': '数据文件读取失败'}, 500
 
-        # 收集所有销售代表姓名
-        sales_representatives = set()
-        
-        for _, row in df.iterrows():
-            # 使用标准化函数获取销售代表姓名
-            sales_person = get_normalized_sales_person(row)
-            
-            # 添加到集合中（自动去重）
-            if sales_person:
-                sales_representatives.add(sales_person)
+        # 收集所有销售代表姓名（快照派生列已完成标准化）
+        derived = snapshot.derived if snapshot.derived is not None else build_derived_columns(df)
+        sales_representatives = set(derived['_sales'].unique()) - {''}
         
         # 转换为排序列表
-        sales_list = sorted(list(sales_representatives))
+        sales_list = sorted(sales_representatives)
         
         logger.info(f"找到{len(sales_list)}个销售代表")
-        return jsonify({
+        return {
             'sales_representatives': sales_list
-        })
+        }, 200
 
     except Exception as e:
         logger.error(f"获取销售代表列表失败: {str(e)}")
-        return jsonify({'error': f'获取销售代表列表失败: {str(e)}'}), 500
+        return {'error': f'获取销售代表列表失败: {str(e)}'}, 500
 
-@app.route('/get_zones')
+@app.route('/get_sales_representatives')
 @login_required
-def get_zones():
+@conditional_get(_snapshot_validator)
+@cached_result
+def get_sales_representatives():
+    payload, status = _get_sales_representatives_payload(request.args)
+    return jsonify(payload), status
+
+def _get_zones_payload(args, snapshot=None):
+    """战区列表（默认战区 + Excel战区），返回 (payload, HTTP状态码)"""
     try:
         # 默认战区列表（按业务常用顺序），排除“简道云大区”
         default_zones_order = [
@@ -895,31 +874,17 @@ def get_zones():
         zones_from_excel = set()
         if os.path.exists(excel_path):
             try:
-                ensure_pandas_imported()
-                df = pd.read_excel(excel_path)
+                snapshot = snapshot or get_cached_snapshot()
+                if snapshot is None:
+                    raise ValueError('客户数据快照不可用')
+                df = snapshot.df
                 logger.info(f"成功读取Excel文件，共{len(df)}行数据")
 
-                # 战区列兼容：支持'战区'、'所属战区'或'归属战区'
-                zone_col = None
-                if '战区' in df.columns:
-                    zone_col = '战区'
-                elif '所属战区' in df.columns:
-                    zone_col = '所属战区'
-                elif '归属战区' in df.columns:
-                    zone_col = '归属战区'
-
+                # 战区列兼容：支持'战区'、'所属战区'或'归属战区'；标准化结果取自快照派生列
+                zone_col = find_zone_column(df)
                 if zone_col:
-                    for _, row in df.iterrows():
-                        zone_val = row.get(zone_col, '')
-                        try:
-                            is_nan = pd.isna(zone_val)
-                        except Exception:
-                            is_nan = False
-                        if zone_val is None or is_nan:
-                            continue
-                        zone_str = normalize_zone(zone_val)
-                        if zone_str and zone_str != '简道云':
-                            zones_from_excel.add(zone_str)
+                    derived = snapshot.derived if snapshot.derived is not None else build_derived_columns(df)
+                    zones_from_excel = set(derived['_zone'].unique()) - {'', '简道云'}
                 else:
                     logger.warning("Excel文件中缺少战区列 ['战区'、'所属战区'、'归属战区']，将仅使用默认战区列表")
             except Exception as e:
@@ -943,26 +908,170 @@ def get_zones():
                 seen.add(nz)
 
         logger.info(f"返回{len(merged_zones)}个战区（含默认与Excel提取，已排除简道云大区）")
-        return jsonify({'zones': merged_zones})
+        return {'zones': merged_zones}, 200
 
     except Exception as e:
         logger.error(f"获取战区列表失败: {str(e)}")
-        return jsonify({'error': f'获取战区列表失败: {str(e)}'}), 500
+        return {'error': f'获取战区列表失败: {str(e)}'}, 500
 
-@app.route('/get_unsigned_customers')
+@app.route('/get_zones')
 @login_required
-def get_unsigned_customers():
-    """获取未来8-33天内客户数据，支持状态筛选"""
+@conditional_get(_snapshot_validator)
+@cached_result
+def get_zones():
+    payload, status = _get_zones_payload(request.args)
+    return jsonify(payload), status
+
+@app.route('/customers/query', methods=['POST'])
+@login_required
+def customers_query():
+    """统一客户查询：声明式筛选（到期窗口/战区/销售/阶段/金额/文本）+ 排序 + 分页 + 字段投影"""
+    try:
+        try:
+            spec = parse_query_spec(request.get_json(silent=True) or {})
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e), 'error_type': 'validation'}), 400
+
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': '数据文件读取失败', 'error_type': 'file_read_error'}), 500
+
+        fingerprint = spec.fingerprint()
+        if spec.cursor:
+            try:
+                spec.offset = decode_cursor(spec.cursor, snapshot.version, fingerprint)
+            except ValueError as e:
+                return jsonify({'success': False, 'error': str(e), 'error_type': 'validation'}), 400
+            except LookupError as e:
+                return jsonify({'success': False, 'error': str(e), 'error_type': 'cursor_expired'}), 409
+
+        today = datetime.now().date()
+        page, total = snapshot.query(spec, today)
+        items = project_records(page, spec.fields, today)
+        next_offset = spec.offset + len(items)
+        next_cursor = encode_cursor(snapshot.version, fingerprint, next_offset) if next_offset < total else None
+
+        return jsonify({
+            'success': True,
+            'items': items,
+            'total': total,
+            'offset': spec.offset,
+            'limit': spec.limit,
+            'fields': spec.fields,
+            'next_cursor': next_cursor,
+            'snapshot_version': snapshot.version
+        })
+    except Exception as e:
+        logger.error(f"统一查询失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'查询失败: {str(e)}', 'error_type': 'system_error'}), 500
+
+@app.route('/customers/facets')
+@login_required
+@conditional_get(_snapshot_validator)
+@cached_result
+def customers_facets():
+    """到期窗口内的分面计数：状态芯片计数 + 按战区/销售代表展开的状态透视"""
+    try:
+        try:
+            min_days = int(request.args.get('min_days', 8))
+            max_days = int(request.args.get('max_days', 33))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': 'min_days/max_days 应为整数', 'error_type': 'validation'}), 400
+        if max_days < min_days:
+            max_days = min_days
+        zones = [normalize_zone(z) for z in request.args.get('zones', '').split(',') if z.strip()] or None
+        sales = [s.strip() for s in request.args.get('sales', '').split(',') if s.strip()] or None
+        pivots = [p.strip() for p in request.args.get('pivot', 'zone,sales').split(',') if p.strip()]
+        unknown = [p for p in pivots if p not in ('zone', 'sales')]
+        if unknown:
+            return jsonify({'success': False, 'error': f'不支持的分面维度: {unknown}', 'error_type': 'validation'}), 400
+
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': '数据文件读取失败', 'error_type': 'file_read_error'}), 500
+
+        today = datetime.now().date()
+        cube = snapshot.facets(today, min_days, max_days)
+        result = {
+            'success': True,
+            'query_date': today.strftime('%Y-%m-%d'),
+            'min_days': min_days,
+            'max_days': max_days,
+            'total': cube.total(zones, sales),
+            'statuses': cube.status_counts(zones, sales)
+        }
+        for dim in pivots:
+            result[f'by_{dim}'] = cube.pivot(dim, zones, sales)
+        return jsonify(result)
+    except Exception as e:
+        logger.error(f"分面计数失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'分面计数失败: {str(e)}', 'error_type': 'system_error'}), 500
+
+# 日历/续费预测：单次最多返回的天数
+EXPIRY_CALENDAR_MAX_DAYS = 3660
+
+@app.route('/customers/expiry_calendar')
+@login_required
+@conditional_get(_snapshot_validator)
+@cached_result
+def customers_expiry_calendar():
+    """逐日到期直方图：任意日期区间的每日到期客户数与应续ARR，可按战区/销售过滤、按维度展开"""
+    try:
+        today = datetime.now().date()
+        try:
+            if request.args.get('start') or request.args.get('end'):
+                start = datetime.strptime(request.args.get('start') or today.isoformat(), '%Y-%m-%d').date()
+                end = datetime.strptime(request.args.get('end') or request.args.get('start'), '%Y-%m-%d').date()
+            else:
+                start = today + timedelta(days=int(request.args.get('min_days', 0)))
+                end = today + timedelta(days=int(request.args.get('max_days', 30)))
+        except (TypeError, ValueError):
+            return jsonify({'success': False, 'error': '日期参数格式应为 YYYY-MM-DD，天数应为整数', 'error_type': 'validation'}), 400
+        if end < start:
+            return jsonify({'success': False, 'error': '结束日期不能早于开始日期', 'error_type': 'validation'}), 400
+        if (end - start).days >= EXPIRY_CALENDAR_MAX_DAYS:
+            return jsonify({'success': False, 'error': f'单次最多查询{EXPIRY_CALENDAR_MAX_DAYS}天', 'error_type': 'validation'}), 400
+
+        zone = normalize_zone(request.args['zone']) if request.args.get('zone') else None
+        sales = request.args.get('sales') or None
+        breakdown = [d.strip() for d in request.args.get('breakdown', '').split(',') if d.strip()]
+        unknown = [d for d in breakdown if d not in ('zone', 'sales', 'stage')]
+        if unknown:
+            return jsonify({'success': False, 'error': f'不支持的展开维度: {unknown}', 'error_type': 'validation'}), 400
+
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': '数据文件读取失败', 'error_type': 'file_read_error'}), 500
+        histogram = snapshot.histogram()
+        try:
+            days = histogram.series(start, end, zone=zone, sales=sales, breakdown=breakdown)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e), 'error_type': 'validation'}), 400
+
+        return jsonify({
+            'success': True,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'days': days,
+            'total_count': sum(day['count'] for day in days),
+            'total_arr': round(sum(day['arr'] for day in days), 2)
+        })
+    except Exception as e:
+        logger.error(f"获取到期日历失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'获取到期日历失败: {str(e)}', 'error_type': 'system_error'}), 500
+
+def _get_unsigned_customers_payload(args, snapshot=None):
+    """未来 min_days-max_days 天内客户及状态计数，返回 (payload, HTTP状态码)"""
     try:
         # 获取筛选参数
-        status_filter = request.args.get('status', 'all')  # all, na, contract, invoice, paid
+        status_filter = args.get('status', 'all')  # all, na, contract, invoice, paid
         # 可选：支持自定义天数范围，默认未来第8天到第33天
         try:
-            min_days = int(request.args.get('min_days', 8))
+            min_days = int(args.get('min_days', 8))
         except Exception:
             min_days = 8
         try:
-            max_days = int(request.args.get('max_days', 33))
+            max_days = int(args.get('max_days', 33))
         except Exception:
             max_days = 33
         if max_days < min_days:
@@ -973,251 +1082,331 @@ def get_unsigned_customers():
         logger.info(f"尝试读取文件: {excel_path}")
         if not os.path.exists(excel_path):
             logger.error(f"文件不存在: {excel_path}")
-            return jsonify({'customers': [], 'error': '数据文件不存在'}), 500
+            return {'customers': [], 'error': '数据文件不存在'}, 500
 
         try:
-            df = get_cached_df()
+            # 列别名（到期时间 -> 到期日期等）已由快照服务统一处理
+            snapshot = snapshot or get_cached_snapshot()
+            df = snapshot.df
             logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-            # 列别名兼容：部分数据使用“到期时间”，统一重命名为“到期日期”
-            if '到期日期' not in df.columns and '到期时间' in df.columns:
-                try:
-                    df.rename(columns={'到期时间': '到期日期'}, inplace=True)
-                    logger.info("兼容列名：将'到期时间'重命名为'到期日期'")
-                except Exception as alias_err:
-                    logger.warning(f"列名兼容失败: {str(alias_err)}")
         except Exception as e:
             logger.error(f"Excel读取错误: {str(e)}")
-            return jsonify({'customers': [], 'error': '数据文件读取失败'}), 500
+            return {'customers': [], 'error': '数据文件读取失败'}, 500
 
         # 检查必要的列是否存在（到期日期已在上方做过别名兼容）
         required_columns = ['用户ID', '账号-企业名称', '到期日期', '客户阶段']
         missing_columns = [col for col in required_columns if col not in df.columns]
         if missing_columns:
             logger.error(f"Excel文件中缺少必要列: {missing_columns}")
-            return jsonify({'customers': [], 'error': f'数据格式错误：缺少必要列 {missing_columns}'}), 500
+            return {'customers': [], 'error': f'数据格式错误：缺少必要列 {missing_columns}'}, 500
         
         # 获取当前日期
-        now = datetime.now()
-        today = now.date()
-        eight_days_later = today + pd.Timedelta(days=min_days)
-        thirty_three_days_later = today + pd.Timedelta(days=max_days)
-        
-        # 筛选出未来30天内到期的客户
+        today = datetime.now().date()
+
+        # 状态芯片计数来自分面引擎（按快照版本与日期缓存）；列表只取命中状态的窗口切片
+        unique_statuses = snapshot.facets(today, min_days, max_days).status_counts()
+        selected, _ = snapshot.window(today, min_days, max_days, status=status_filter)
+
+        # 仅为命中切片构建返回数据（已按到期日期升序，最近到期的在前）
         filtered_customers = []
-        for _, row in df.iterrows():
-            # 检查到期日期是否在未来8-33天内
-            if pd.notna(row['到期日期']):
-                try:
-                    expiry_date = pd.to_datetime(row['到期日期']).date()
-                    # 如果到期日期在未来8-33天内
-                    if eight_days_later <= expiry_date <= thirty_three_days_later:
-                        # 获取客户阶段
-                        customer_stage = row.get('客户阶段', '')
-                        stage_normalized = ''
-                        if pd.notna(customer_stage) and str(customer_stage).strip() != '' and str(customer_stage).lower() != 'nan':
-                            stage_normalized = str(customer_stage).strip()
-                        
-                        # 根据状态筛选
-                        should_include = False
-                        if status_filter == 'all':
-                            should_include = True
-                        # NA 兼容：空值或显式字符串 "NA"
-                        elif status_filter == 'na' and (stage_normalized == '' or str(stage_normalized).strip().upper() == 'NA'):
-                            should_include = True
-                        elif status_filter == 'contract' and '合同' in stage_normalized:
-                            should_include = True
-                        elif status_filter == 'invoice' and '开票' in stage_normalized:
-                            should_include = True
-                        elif status_filter == 'advance_invoice' and '提前开' in stage_normalized:
-                            should_include = True
-                        elif status_filter == 'paid' and ('回款' in stage_normalized or '已付' in stage_normalized):
-                            should_include = True
-                        elif status_filter == 'upsell' and '增购' in stage_normalized:
-                            should_include = True
-                        elif status_filter == 'invalid' and '无效' in stage_normalized:
-                            should_include = True
-                        elif status_filter == 'lost' and '失联' in stage_normalized:
-                            should_include = True
-                        
-                        if should_include:
-                            # 处理责任销售字段
-                            sales_raw = row.get('续费责任销售', '')
-                            if pd.isna(sales_raw) or sales_raw == '' or str(sales_raw).lower() == 'nan':
-                                sales_person = str(row.get('责任销售中英文', ''))
-                            else:
-                                sales_person = str(sales_raw)
-                            
-                            # 计算距离到期的天数
-                            days_until_expiry = (expiry_date - today).days
-                            if days_until_expiry == 0:
-                                date_label = "今天到期"
-                            elif days_until_expiry == 1:
-                                date_label = "明天到期"
-                            else:
-                                date_label = f"{days_until_expiry}天后到期"
-                            
-                            filtered_customers.append({
-                                'expiry_date': f"{date_label} ({expiry_date.strftime('%Y年%m月%d日')})",
-                                'jdy_account': str(row.get('用户ID', '')),
-                                'company_name': str(row.get('账号-企业名称', '')),
-                                'sales_person': sales_person,
-                                'customer_stage': stage_normalized if stage_normalized else 'NA',
-                                'days_until_expiry': days_until_expiry
-                            })
-                except Exception as e:
-                    logger.warning(f"日期转换错误: {str(e)}")
-                    continue
-        
-        # 按到期日期排序（最近到期的在前）
-        filtered_customers.sort(key=lambda x: x['days_until_expiry'])
-        
-        # 获取所有未来8-33天内的客户（不考虑状态筛选）用于计算各状态的数量
-        all_customers_30days = []
-        for _, row in df.iterrows():
-            if pd.notna(row['到期日期']):
-                try:
-                    expiry_date = pd.to_datetime(row['到期日期']).date()
-                    if eight_days_later <= expiry_date <= thirty_three_days_later:
-                        customer_stage = row.get('客户阶段', '')
-                        stage_normalized = ''
-                        if pd.notna(customer_stage) and str(customer_stage).strip() != '' and str(customer_stage).lower() != 'nan':
-                            stage_normalized = str(customer_stage).strip()
-                        
-                        all_customers_30days.append({
-                            'customer_stage': stage_normalized if stage_normalized else 'NA'
-                        })
-                except Exception:
-                    continue
-        
-        # 计算各状态计数（稳定返回所有已知状态，即使为0）
-        count_all = len(all_customers_30days)
-        count_na = len([c for c in all_customers_30days if str(c['customer_stage']).strip().upper() == 'NA'])
-        count_contract = len([c for c in all_customers_30days if '合同' in c['customer_stage']])
-        count_invoice = len([c for c in all_customers_30days if '开票' in c['customer_stage']])
-        count_advance_invoice = len([c for c in all_customers_30days if '提前开' in c['customer_stage']])
-        count_paid = len([c for c in all_customers_30days if ('回款' in c['customer_stage'] or '已付' in c['customer_stage'])])
-        count_upsell = len([c for c in all_customers_30days if '增购' in c['customer_stage']])
-        count_invalid = len([c for c in all_customers_30days if '无效' in c['customer_stage']])
-        count_lost = len([c for c in all_customers_30days if '失联' in c['customer_stage']])
-
-        # 固定顺序返回，避免前端芯片缺失
-        unique_statuses = [
-            {'value': 'all', 'label': '全部状态', 'count': count_all},
-            {'value': 'na', 'label': 'NA状态', 'count': count_na},
-            {'value': 'contract', 'label': '合同状态', 'count': count_contract},
-            {'value': 'invoice', 'label': '开票状态', 'count': count_invoice},
-            {'value': 'advance_invoice', 'label': '提前开状态', 'count': count_advance_invoice},
-            {'value': 'paid', 'label': '回款状态', 'count': count_paid},
-            {'value': 'upsell', 'label': '增购状态', 'count': count_upsell},
-            {'value': 'invalid', 'label': '无效状态', 'count': count_invalid},
-            {'value': 'lost', 'label': '失联状态', 'count': count_lost},
-        ]
+        for record in selected.to_dict('records'):
+            expiry_date = record['_expiry_day'].date()
+            days_until_expiry = (expiry_date - today).days
+            stage_normalized = record['_stage']
+            filtered_customers.append({
+                'expiry_date': f"{expiry_label(days_until_expiry)} ({expiry_date.strftime('%Y年%m月%d日')})",
+                'jdy_account': str(record.get('用户ID', '')),
+                'company_name': str(record.get('账号-企业名称', '')),
+                'sales_person': record['_sales_raw'],
+                'customer_stage': stage_normalized if stage_normalized else 'NA',
+                'days_until_expiry': days_until_expiry
+            })
         
         logger.info(f"找到{len(filtered_customers)}个未来{min_days}-{max_days}天内的客户（筛选条件: {status_filter}）")
-        return jsonify({
+        return {
             'customers': filtered_customers,
             'total_count': len(filtered_customers),
             'query_date': today.strftime('%Y年%m月%d日'),
             'current_filter': status_filter,
             'available_statuses': unique_statuses
-        })
+        }, 200
 
     except Exception as e:
         logger.error(f"获取客户数据失败: {str(e)}")
-        return jsonify({
+        return {
             'customers': [], 
             'error': f'获取客户信息时出现问题',
             'query_date': datetime.now().strftime('%Y年%m月%d日')
-        }), 500
+        }, 500
+
+@app.route('/get_unsigned_customers')
+@login_required
+@conditional_get(_snapshot_validator)
+@cached_result
+def get_unsigned_customers():
+    payload, status = _get_unsigned_customers_payload(request.args)
+    return jsonify(payload), status
+
+def _parse_zone_args(args):
+    """战区筛选参数（支持CSV和重复参数两种形式），标准化、去重并保留顺序"""
+    zones_list = []
+    for val in args.getlist('zones'):
+        if not val:
+            continue
+        for z in val.split(','):
+            z_clean = z.strip()
+            if z_clean:
+                zones_list.append(z_clean)
+    return list(dict.fromkeys([normalize_zone(z) for z in zones_list if str(z).lower() != 'all']))
+
+
+def _export_query_spec(args):
+    """由导出请求参数构造查询条件（与页面列表相同的筛选参数），参数不合法时抛出 ValueError"""
+    spec = QuerySpec()
+    for name in ('min_days', 'max_days'):
+        raw = args.get(name)
+        if raw not in (None, ''):
+            try:
+                setattr(spec, name, int(raw))
+            except ValueError:
+                raise ValueError(f'{name} 应为整数')
+    if spec.min_days is not None and spec.max_days is not None and spec.min_days > spec.max_days:
+        raise ValueError('min_days 不能大于 max_days')
+    spec.zones = _parse_zone_args(args) or None
+    sales_filter = args.get('sales_filter', 'all')
+    if sales_filter and sales_filter != 'all':
+        spec.sales = [sales_filter]
+    status = args.get('status', 'all')
+    if status and status != 'all':
+        if status not in {value for value, _ in STAGE_STATUSES}:
+            raise ValueError(f'未知的阶段状态: {status}')
+        spec.stages = [status]
+    spec.text = (args.get('q') or '').strip()
+    return spec
+
+
+def _export_columns(snapshot, args):
+    """导出列：[(表头（Excel原始列名）, 快照列名)]；columns 参数可用原始列名或标准列名，缺省导出全部列"""
+    alias_of = dict(snapshot.renamed_columns)
+    available = [(alias_of.get(col, col), col) for col in snapshot.df.columns]
+    requested = [c.strip() for val in args.getlist('columns') for c in val.split(',') if c.strip()]
+    if not requested:
+        return available
+    lookup = {}
+    for header, col in available:
+        lookup[header] = (header, col)
+        lookup[col] = (header, col)
+    unknown = [c for c in requested if c not in lookup]
+    if unknown:
+        raise ValueError(f'未知的导出列: {unknown}')
+    return list(dict.fromkeys(lookup[c] for c in requested))
+
+
+def _prepare_export(args):
+    """校验导出参数并锁定当前快照，返回 (导出计划, None) 或 (None, (错误payload, HTTP状态码))"""
+    # 检查文件是否存在
+    excel_path = get_user_excel_path()
+    logger.info(f"尝试读取文件: {excel_path}")
+    if not os.path.exists(excel_path):
+        logger.error(f"文件不存在: {excel_path}")
+        return None, ({'error': '数据文件不存在'}, 500)
+
+    snapshot = customer_snapshots.get()
+    if snapshot is None:
+        logger.error("Excel读取错误: 客户数据快照不可用")
+        return None, ({'error': '数据文件读取失败'}, 500)
+    df = snapshot.df
+    logger.info(f"成功读取Excel文件，共{len(df)}行数据")
+
+    # 检查必要的列是否存在
+    required_columns = ['用户ID', '账号-企业名称', '到期日期', '客户阶段']
+    missing_columns = [col for col in required_columns if col not in df.columns]
+    if missing_columns:
+        logger.error(f"Excel文件中缺少必要列: {missing_columns}")
+        return None, ({'error': f'数据格式错误：缺少必要列 {missing_columns}'}, 500)
+
+    export_format = (args.get('format') or 'xlsx').lower()
+    if export_format not in ('xlsx', 'csv'):
+        return None, ({'error': 'format 仅支持 xlsx 或 csv'}, 400)
+    try:
+        spec = _export_query_spec(args)
+        columns = _export_columns(snapshot, args)
+    except ValueError as e:
+        return None, ({'error': str(e)}, 400)
+
+    # 获取当前日期
+    today = datetime.now().date()
+    plan = {
+        'snapshot': snapshot,
+        'spec': spec,
+        'columns': columns,
+        'format': export_format,
+        'today': today,
+        'download_name': f"六大战区全部客户_{today.strftime('%Y%m%d')}.{export_format}",
+        'mimetype': CSV_MIMETYPE if export_format == 'csv' else XLSX_MIMETYPE,
+        'cache_key': None,
+    }
+    # 同一数据文件 + 同一筛选条件的导出共用磁盘缓存（到期窗口相对今天，有窗口时键中带日期）
+    if snapshot.file_hash and snapshot.content_hash:
+        has_window = spec.min_days is not None or spec.max_days is not None
+        plan['cache_key'] = export_cache.make_key(snapshot.file_hash, export_format, snapshot.content_hash,
+                                                  spec.fingerprint(), columns,
+                                                  today.isoformat() if has_window else None)
+    return plan, None
+
+
+def _render_export(plan, track_rows=None, on_total=None):
+    """按导出计划筛选并逐批生成文件字节块（生成完整后写入导出缓存）"""
+    snapshot = plan['snapshot']
+    positions = snapshot.select_positions(plan['spec'], plan['today'])
+    logger.info(f"导出{len(positions)}个客户数据（{plan['format']}，{len(plan['columns'])}列）")
+    if on_total is not None:
+        on_total(len(positions))
+
+    header = [h for h, _ in plan['columns']]
+    rows = iter_frame_rows(snapshot.df, positions, [c for _, c in plan['columns']])
+    if track_rows is not None:
+        rows = track_rows(rows)
+    if plan['format'] == 'csv':
+        body = iter_csv(header, rows)
+    else:
+        body = iter_xlsx(header, rows, sheet_name='客户列表')
+    if plan['cache_key']:
+        # 边生成边输出，同时写入缓存；中途中断则不入缓存
+        body = export_cache.tee(plan['cache_key'], body)
+    return body
+
 
 @app.route('/export_unsigned_customers')
 @login_required
 def export_unsigned_customers():
-    """导出所有客户数据，包含全部3606行"""
-    try:
-        # 检查文件是否存在
-        excel_path = get_user_excel_path()
-        logger.info(f"尝试读取文件: {excel_path}")
-        if not os.path.exists(excel_path):
-            logger.error(f"文件不存在: {excel_path}")
-            return jsonify({'error': '数据文件不存在'}), 500
+    """流式导出客户数据（默认全部行、全部列，xlsx）
 
-        try:
-            ensure_pandas_imported()
-            df = pd.read_excel(excel_path)
-            logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-        except Exception as e:
-            logger.error(f"Excel读取错误: {str(e)}")
-            return jsonify({'error': '数据文件读取失败'}), 500
+    参数：format=xlsx|csv；columns=列名（逗号分隔或重复参数）；
+    筛选与页面列表一致：min_days、max_days、zones、sales_filter、status、q。
+    行按批从快照读取并直接写入响应，内存占用与行数无关。
+    """
+    try:
+        plan, error = _prepare_export(request.args)
+        if error:
+            payload, status = error
+            return jsonify(payload), status
+
+        cache_key = plan['cache_key']
+        cached_path = export_cache.get(cache_key) if cache_key else None
+        if cached_path:
+            logger.info(f"导出缓存命中: {cache_key}")
+            response = send_file(cached_path, as_attachment=True, download_name=plan['download_name'],
+                                 mimetype=plan['mimetype'], conditional=True, etag=cache_key, max_age=0)
+            response.headers['X-Export-Cache'] = 'HIT'
+            return response
+
+        response = app.response_class(_render_export(plan), mimetype=plan['mimetype'])
+        response.headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{quote(plan['download_name'])}"
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Export-Cache'] = 'MISS'
+        if cache_key:
+            response.set_etag(cache_key)
+        return response
 
-        # 检查必要的列是否存在
-        required_columns = ['用户ID', '账号-企业名称', '到期日期', '客户阶段']
-        missing_columns = [col for col in required_columns if col not in df.columns]
-        if missing_columns:
-            logger.error(f"Excel文件中缺少必要列: {missing_columns}")
-            return jsonify({'error': f'数据格式错误：缺少必要列 {missing_columns}'}), 500
-        
-        # 获取当前日期
-        now = datetime.now()
-        today = now.date()
-        
-        # 创建导出的DataFrame，直接使用原始数据
-        export_df = df.copy()
-        
-        # 创建临时文件
-        temp_file = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
-        
-        # 保存为Excel文件
-        export_df.to_excel(temp_file.name, index=False)
-        
-        logger.info(f"导出了{len(export_df)}个客户数据到临时文件")
-        
-        # 返回文件下载
-        return send_file(
-            temp_file.name,
-            as_attachment=True,
-            download_name=f"六大战区全部客户_{today.strftime('%Y%m%d')}.xlsx",
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
-        
     except Exception as e:
         logger.error(f"导出客户数据失败: {str(e)}")
         return jsonify({'error': f'导出客户数据时出现问题: {str(e)}'}), 500
-    finally:
-        # 确保临时文件被清理
-        try:
-            if 'temp_file' in locals():
-                os.unlink(temp_file.name)
-        except Exception as e:
-            logger.error(f"清理临时文件时发生错误: {str(e)}")
 
-@app.route('/get_expiring_customers')
+
+def _export_job_payload(job):
+    data = job.to_dict()
+    data.pop('path', None)
+    data['status_url'] = url_for('export_job_status', job_id=job.id)
+    data['download_url'] = url_for('export_job_download', job_id=job.id) if job.status == JOB_DONE else None
+    return data
+
+
+def _find_export_job(job_id):
+    """只允许提交者本人查询/下载任务"""
+    job = export_jobs.get(job_id)
+    if job is None or (job.owner and job.owner != session.get('user')):
+        return None
+    return job
+
+
+@app.route('/export_jobs', methods=['POST'])
 @login_required
-def get_expiring_customers():
+def submit_export_job():
+    """提交后台导出任务（参数同 /export_unsigned_customers，可放在JSON请求体或查询串），立即返回任务ID"""
+    try:
+        payload = request.get_json(silent=True)
+        if isinstance(payload, dict) and payload:
+            args = MultiDict([(key, str(v)) for key, value in payload.items()
+                              for v in (value if isinstance(value, list) else [value]) if v is not None])
+        else:
+            args = request.args
+        plan, error = _prepare_export(args)
+        if error:
+            payload, status = error
+            return jsonify({'success': False, **payload}), status
+
+        owner = session.get('user')
+        cache_key = plan['cache_key']
+        cached_path = export_cache.get(cache_key) if cache_key else None
+        if cached_path:
+            job = export_jobs.complete_from(owner, plan['format'], plan['download_name'], plan['mimetype'],
+                                            cached_path)
+        else:
+            def render(job):
+                def set_total(total):
+                    job.rows_total = total
+                return _render_export(plan, track_rows=job.track, on_total=set_total)
+            try:
+                job = export_jobs.submit(owner, plan['format'], plan['download_name'], plan['mimetype'], render)
+            except ExportQueueFull as e:
+                return jsonify({'success': False, 'error': str(e)}), 429
+        logger.info(f"导出任务已提交 {job.id}（{plan['format']}，来源: {job.source}）")
+        return jsonify({'success': True, **_export_job_payload(job)}), 202
+
+    except Exception as e:
+        logger.error(f"提交导出任务失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'提交导出任务失败: {str(e)}'}), 500
+
+
+@app.route('/export_jobs/<job_id>')
+@login_required
+def export_job_status(job_id):
+    """导出任务状态：status、进度、已写出行数"""
+    job = _find_export_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '导出任务不存在或已过期'}), 404
+    return jsonify({'success': True, **_export_job_payload(job)})
+
+
+@app.route('/export_jobs/<job_id>/download')
+@login_required
+def export_job_download(job_id):
+    """下载已完成的导出任务结果"""
+    job = _find_export_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': '导出任务不存在或已过期'}), 404
+    if job.status == JOB_FAILED:
+        return jsonify({'success': False, 'error': f'导出任务失败: {job.error}'}), 410
+    if job.status != JOB_DONE:
+        return jsonify({'success': False, 'error': '导出任务尚未完成', 'status': job.status}), 409
+    if not job.path or not os.path.exists(job.path):
+        return jsonify({'success': False, 'error': '导出文件已被清理，请重新提交'}), 410
+    return send_file(job.path, as_attachment=True, download_name=job.download_name, mimetype=job.mimetype,
+                     conditional=True, etag=job.id, max_age=0)
+
+def _get_expiring_customers_payload(args, snapshot=None):
+    """未来7天到期客户，返回 (payload, HTTP状态码)"""
     try:
         # 获取筛选参数
-        sales_filter = request.args.get('sales_filter', 'all')
-        test_mode = request.args.get('test_mode', 'false').lower() == 'true'
+        sales_filter = args.get('sales_filter', 'all')
+        test_mode = args.get('test_mode', 'false').lower() == 'true'
         # 战区筛选参数（支持CSV和重复参数两种形式）
-        raw_zones = request.args.getlist('zones')
-        zones_list = []
-        for val in raw_zones:
-            if not val:
-                continue
-            if ',' in val:
-                for z in val.split(','):
-                    z_clean = z.strip()
-                    if z_clean:
-                        zones_list.append(z_clean)
-            else:
-                v = val.strip()
-                if v:
-                    zones_list.append(v)
-        # 去重并保留顺序
-        zones_list = list(dict.fromkeys([normalize_zone(z) for z in zones_list if str(z).lower() != 'all']))
+        raw_zones = args.getlist('zones')
+        zones_list = _parse_zone_args(args)
         logger.info(f"=== API调用开始 ===")
         logger.info(f"请求参数 - sales_filter: {sales_filter}, test_mode: {test_mode}, zones: {zones_list}")
-        logger.info(f"原始参数 - sales_filter: {request.args.get('sales_filter')}, test_mode: {request.args.get('test_mode')}, zones(raw): {raw_zones}")
+        logger.info(f"原始参数 - sales_filter: {args.get('sales_filter')}, test_mode: {args.get('test_mode')}, zones(raw): {raw_zones}")
         logger.info(f"获取到期客户，销售筛选: {sales_filter}, 战区筛选: {zones_list}, 测试模式: {test_mode}")
         
         # 获取当前日期
@@ -1229,141 +1418,73 @@ def get_expiring_customers():
         logger.info(f"尝试读取文件: {excel_path}")
         if not os.path.exists(excel_path):
             logger.error(f"文件不存在: {excel_path}")
-            return jsonify({'expiring_customers': [], 'error': '数据文件不存在', 'today_date': today.strftime('%Y年%m月%d日')})
+            return {'expiring_customers': [], 'error': '数据文件不存在', 'today_date': today.strftime('%Y年%m月%d日')}, 200
 
         try:
-            df = get_cached_df()
+            # 列别名（到期时间 -> 到期日期等）已由快照服务统一处理
+            snapshot = snapshot or get_cached_snapshot()
+            df = snapshot.df
             logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-            # 列别名兼容：到期时间 -> 到期日期
-            if df is not None and '到期日期' not in df.columns and '到期时间' in df.columns:
-                try:
-                    df.rename(columns={'到期时间': '到期日期'}, inplace=True)
-                    logger.info("兼容列名：将'到期时间'重命名为'到期日期'")
-                except Exception as alias_err:
-                    logger.warning(f"列名兼容失败: {str(alias_err)}")
         except Exception as e:
             logger.error(f"Excel读取错误: {str(e)}")
-            return jsonify({'expiring_customers': [], 'error': '数据文件读取失败', 'today_date': today.strftime('%Y年%m月%d日')})
+            return {'expiring_customers': [], 'error': '数据文件读取失败', 'today_date': today.strftime('%Y年%m月%d日')}, 200
 
         # 检查必要的列并返回具体缺失项
         required_columns = ['到期日期', '用户ID', '账号-企业名称']
         missing_columns = [col for col in required_columns if col not in df.columns]
         if missing_columns:
             logger.error(f"Excel文件中缺少必要列: {missing_columns}")
-            return jsonify({
+            return {
                 'expiring_customers': [],
                 'error': f'数据格式错误：缺少必要列 {missing_columns}',
                 'today_date': today.strftime('%Y年%m月%d日')
-            })
+            }, 200
         
         # 战区列识别
-        zone_col = None
-        for candidate in ['战区', '所属战区', '归属战区']:
-            if candidate in df.columns:
-                zone_col = candidate
-                break
+        zone_col = find_zone_column(df)
         apply_zone_filter = len(zones_list) > 0 and zone_col is not None
         if len(zones_list) > 0 and zone_col is None:
             logger.warning("Excel中未找到战区相关列，忽略战区筛选")
         
         # 按需求：显示从今天开始，向后推延7天内到期
-        start_date = today
-        end_date = today + pd.Timedelta(days=7)
         reminder_type = "未来7天到期提醒"
-        logger.info(f"到期提醒窗口：{start_date} 至 {end_date}，战区列: {zone_col}")
+        logger.info(f"到期提醒窗口：{today} 至 {today + timedelta(days=7)}，战区列: {zone_col}")
         
-        # 筛选出目标日期到期的客户
-        expiring_customers = []
-        total_expiring = 0
-        filtered_out = 0
-        
-        for _, row in df.iterrows():
-            if pd.notna(row['到期日期']):
-                try:
-                    expiry_date = pd.to_datetime(row['到期日期']).date()
-                    if start_date <= expiry_date <= end_date:
-                        total_expiring += 1
-                        # 使用标准化函数获取销售代表姓名
-                        sales_person = get_normalized_sales_person(row)
-                        
-                        # 应用销售代表筛选
-                        if sales_filter != 'all' and sales_filter != sales_person:
-                            filtered_out += 1
-                            continue
-                        
-                        # 读取战区用于展示/筛选
-                        zone_val = ''
-                        if zone_col is not None:
-                            raw_zone_val = row.get(zone_col, None)
-                            try:
-                                is_nan_zone = pd.isna(raw_zone_val)
-                            except Exception:
-                                is_nan_zone = False
-                            zone_val = '' if (raw_zone_val is None or is_nan_zone) else normalize_zone(raw_zone_val)
-                        
-                        # 应用战区筛选（如有）
-                        if apply_zone_filter:
-                            if zone_val == '' or zone_val not in zones_list:
-                                filtered_out += 1
-                                continue
-                        
-                        # 计算距离到期的天数
-                        days_until_expiry = (expiry_date - today).days
-                        if days_until_expiry == 0:
-                            date_label = "今天到期"
-                        elif days_until_expiry == 1:
-                            date_label = "明天到期"
-                        else:
-                            date_label = f"{days_until_expiry}天后到期"
-                        # 追加客户阶段到日期标签（如有），格式示例：3天后到期-回款 (2025年10月31日)
-                        stage_val = row.get('客户阶段', None)
-                        try:
-                            stage_is_nan = pd.isna(stage_val)
-                        except Exception:
-                            stage_is_nan = False
-                        stage_label = '' if (stage_val is None or stage_is_nan) else str(stage_val).strip()
-                        if stage_label:
-                            expiry_text = f"{date_label}-{stage_label} ({expiry_date.strftime('%Y年%m月%d日')})"
-                        else:
-                            expiry_text = f"{date_label} ({expiry_date.strftime('%Y年%m月%d日')})"
-
-                        expiring_customers.append({
-                            'expiry_date': expiry_text,
-                            'jdy_account': str(row.get('用户ID', '')),
-                            'company_name': str(row.get('账号-企业名称', '')),
-                            'sales_person': sales_person,
-                            'customer_classification': str(row.get('客户分类', '')),
-                            'days_until_expiry': days_until_expiry,
-                            'zone': zone_val,
-                            'customer_stage': stage_label if stage_label else 'NA'
-                        })
-                        try:
-                            arr_val = row.get('应续ARR', '')
-                            if pd.notna(arr_val) and str(arr_val).strip() and str(arr_val).lower() != 'nan':
-                                arr_display = f"{float(str(arr_val).replace(',', ''))}元"
-                            else:
-                                arr_display = '0元'
-                        except Exception:
-                            arr_display = '0元'
-                        try:
-                            contract_val = None
-                            for col in ['合同金额', '合同价', '合同总金额', '合同金额（元）']:
-                                cv = row.get(col, '')
-                                if pd.notna(cv) and str(cv).strip() and str(cv).lower() != 'nan':
-                                    contract_val = str(cv)
-                                    break
-                            contract_display = f"{float(str(contract_val).replace(',', '').replace('元',''))}元" if contract_val else '0元'
-                        except Exception:
-                            contract_display = '0元'
-                        expiring_customers[-1]['uid_arr'] = arr_display
-                        expiring_customers[-1]['contract_amount'] = contract_display
-                        expiring_customers[-1]['amount'] = arr_display if arr_display != '0元' else contract_display
-                except Exception as e:
-                    logger.warning(f"日期转换错误: {str(e)}")
-                    continue
+        # 向量化筛选目标窗口内到期的客户
+        window, total_expiring = snapshot.window(
+            today, 0, 7,
+            zones=zones_list if apply_zone_filter else None,
+            sales_person=sales_filter
+        )
+        filtered_out = total_expiring - len(window)
         
-        # 按到期日期排序
-        expiring_customers.sort(key=lambda x: x['days_until_expiry'])
+        # 仅为命中切片构建返回数据（已按到期日期升序）
+        expiring_customers = []
+        for record in window.to_dict('records'):
+            expiry_date = record['_expiry_day'].date()
+            days_until_expiry = (expiry_date - today).days
+            date_label = expiry_label(days_until_expiry)
+            # 追加客户阶段到日期标签（如有），格式示例：3天后到期-回款 (2025年10月31日)
+            stage_label = record['_stage']
+            if stage_label:
+                expiry_text = f"{date_label}-{stage_label} ({expiry_date.strftime('%Y年%m月%d日')})"
+            else:
+                expiry_text = f"{date_label} ({expiry_date.strftime('%Y年%m月%d日')})"
+            arr_display = format_arr_display(record)
+            contract_display = format_contract_display(record)
+            expiring_customers.append({
+                'expiry_date': expiry_text,
+                'jdy_account': str(record.get('用户ID', '')),
+                'company_name': str(record.get('账号-企业名称', '')),
+                'sales_person': record['_sales'],
+                'customer_classification': str(record.get('客户分类', '')),
+                'days_until_expiry': days_until_expiry,
+                'zone': record['_zone'],
+                'customer_stage': stage_label if stage_label else 'NA',
+                'uid_arr': arr_display,
+                'contract_amount': contract_display,
+                'amount': arr_display if arr_display != '0元' else contract_display
+            })
         
         # 记录筛选统计信息
         logger.info(f"筛选统计 - 总到期客户: {total_expiring}, 筛选掉: {filtered_out}, 最终结果: {len(expiring_customers)}, 筛选条件: {sales_filter}")
@@ -1376,30 +1497,129 @@ def get_expiring_customers():
             else:
                 message = "😊 未来7天内没有客户到期"
             logger.info(message)
-            return jsonify({
+            return {
                 'expiring_customers': [], 
                 'message': message,
                 'today_date': today.strftime('%Y年%m月%d日'),
                 'reminder_type': reminder_type,
                 'selected_zones': zones_list
-            })
+            }, 200
         else:
             logger.info(f"找到{len(expiring_customers)}个即将过期的客户")
-            return jsonify({
+            return {
                 'expiring_customers': expiring_customers,
                 'today_date': today.strftime('%Y年%m月%d日'),
                 'reminder_type': reminder_type,
                 'selected_zones': zones_list
-            })
+            }, 200
 
     except Exception as e:
         logger.error(f"获取即将过期客户失败: {str(e)}")
-        return jsonify({
+        return {
             'expiring_customers': [], 
             'error': f'获取客户信息时出现问题',
             'today_date': datetime.now().strftime('%Y年%m月%d日'),
             'reminder_type': '系统错误'
+        }, 200
+
+@app.route('/get_expiring_customers')
+@login_required
+@conditional_get(_snapshot_validator)
+@cached_result
+def get_expiring_customers():
+    payload, status = _get_expiring_customers_payload(request.args)
+    return jsonify(payload), status
+
+# 首页启动数据包：各分区与对应的独立接口一致，共用同一个快照
+DASHBOARD_SECTIONS = {
+    'sales_representatives': _get_sales_representatives_payload,
+    'zones': _get_zones_payload,
+    'expiring_customers': _get_expiring_customers_payload,
+    'monthly_revenue': _get_monthly_revenue_payload,
+    'unsigned_customers': _get_unsigned_customers_payload,
+}
+
+@app.route('/dashboard_bundle')
+@login_required
+@conditional_get(_snapshot_validator)
+@cached_result
+def dashboard_bundle():
+    """首页启动数据：一次快照读取返回多个分区（sections=zones,expiring_customers,...，缺省为全部）
+
+    各分区的筛选参数与独立接口相同（sales_filter、zones、status、min_days、max_days），
+    分区失败时在 failed_sections 中给出其状态码，其余分区照常返回。
+    """
+    try:
+        requested = [name.strip() for name in request.args.get('sections', '').split(',') if name.strip()]
+        sections = requested or list(DASHBOARD_SECTIONS)
+        unknown = [name for name in sections if name not in DASHBOARD_SECTIONS]
+        if unknown:
+            return jsonify({'success': False, 'error': f'未知的分区: {unknown}',
+                            'available_sections': list(DASHBOARD_SECTIONS)}), 400
+
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'success': False, 'error': '数据文件读取失败'}), 500
+
+        payloads = {}
+        failed = {}
+        for name in dict.fromkeys(sections):
+            payload, status = DASHBOARD_SECTIONS[name](request.args, snapshot=snapshot)
+            payloads[name] = payload
+            if status != 200:
+                failed[name] = status
+        return jsonify({
+            'success': not failed,
+            'snapshot_version': snapshot.version,
+            'sections': payloads,
+            'failed_sections': failed
         })
+    except Exception as e:
+        logger.error(f"获取首页数据包失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'获取首页数据包失败: {str(e)}'}), 500
+
+def build_customer_result(customer_data):
+    """将一条客户记录（原始列 + 快照派生列）转换为 /query_customer 的返回结构"""
+    pd = ensure_pandas_imported()
+    # 处理新字段映射
+    account_enterprise_name = str(customer_data.get('账号-企业名称', ''))
+    version_val = ''
+    try:
+        for col in ['版本', '购买版本', '产品版本', '版本类型']:
+            v = customer_data.get(col, '')
+            if pd.notna(v) and str(v).strip() and str(v).lower() != 'nan':
+                version_val = str(v).strip()
+                break
+    except Exception:
+        version_val = str(customer_data.get('版本', ''))
+    # 责任销售字段 - 优先使用续费责任销售，如果为空则使用责任销售中英文（派生列 _sales_raw）
+    sales = str(customer_data.get('_sales_raw', ''))
+    sales_cn_en = str(customer_data.get('责任销售中英文', ''))
+    jdy_sales = str(customer_data.get('简道云销售', ''))
+
+    # 到期日期
+    expiry_day = customer_data.get('_expiry_day')
+    expiry_date = expiry_day.strftime('%Y年%m月%d日') if expiry_day is not None and pd.notna(expiry_day) else ''
+
+    # 应续ARR为0时视为未填写；计算展示金额：优先应续ARR，否则合同金额
+    arr_display = format_amount(customer_data.get('_arr'), zero_as_missing=True)
+    contract_display = format_contract_display(customer_data)
+    amount_display = arr_display if arr_display and arr_display != '0元' else contract_display
+
+    return {
+        'account_enterprise_name': account_enterprise_name,  # 账号-企业名称
+        'company_name': str(customer_data.get('公司名称', '')),  # 公司名称
+        'tax_number': str(customer_data.get('税号', '')),  # 税号
+        'version': version_val,
+        'expiry_date': expiry_date,  # 到期日期
+        'uid_arr': arr_display,  # 应续ARR
+        'contract_amount': contract_display,
+        'amount': amount_display,
+        'sales': sales,  # 续费责任销售
+        'sales_cn_en': sales_cn_en,  # 责任销售中英文
+        'jdy_sales': jdy_sales,  # 简道云销售
+        'user_id': str(customer_data.get('用户ID', ''))  # 保留用户ID用于兼容
+    }
 
 @app.route('/query_customer', methods=['POST'])
 @login_required
@@ -1425,22 +1645,13 @@ def query_customer():
             logger.error(f"文件不存在: {excel_path}")
             return jsonify({'error': '数据文件不存在'}), 500
 
-        try:
-            # 确保pandas已延迟导入
-            pd = ensure_pandas_imported()
-            df = pd.read_excel(excel_path)
-            # 列名归一化：兼容“简道云ID”、“账号-企业名称”
-            try:
-                if '用户ID' not in df.columns and '简道云ID' in df.columns:
-                    df.rename(columns={'简道云ID': '用户ID'}, inplace=True)
-                if '公司名称' not in df.columns and '账号-企业名称' in df.columns:
-                    df.rename(columns={'账号-企业名称': '公司名称'}, inplace=True)
-            except Exception:
-                pass
-            logger.info(f"成功读取Excel文件，共{len(df)}行数据")
-        except Exception as e:
-            logger.error(f"Excel读取错误: {str(e)}")
+        # 确保pandas已延迟导入；列名归一化（简道云ID、账号-企业名称）由快照服务统一处理
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            logger.error("Excel读取错误: 客户数据快照不可用")
             return jsonify({'error': '数据文件读取失败'}), 500
+        df = snapshot.df
+        logger.info(f"成功读取Excel文件，共{len(df)}行数据")
 
         # 检查必要的列是否存在（公司列允许两种：公司名称 或 账号-企业名称）
         if '用户ID' not in df.columns:
@@ -1453,15 +1664,25 @@ def query_customer():
         
         # 根据查询条件进行模糊匹配
         if jdy_id:
-            matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
+            # 用户ID索引：精确匹配优先，未命中时按部分ID匹配
+            matching_rows = df.iloc[snapshot.find_rows(jdy_id, allow_partial=True)]
+            match_types = None
         else:
-            # 优化：同时在"公司名称"和"账号-企业名称"列中进行搜索
-            company_name_lower = str(company_name).lower()
-            # 使用OR条件进行多列搜索
-            matching_rows = df[
-                (df['公司名称'].astype(str).str.lower().str.contains(company_name_lower, na=False)) |
-                (df['账号-企业名称'].astype(str).str.lower().str.contains(company_name_lower, na=False))
-            ]
+            # 名称倒排索引：同时检索"公司名称"和"账号-企业名称"，按 完全 > 前缀 > 包含 排序，
+            # 都未命中时才返回相似匹配；默认返回全部匹配（仅相似匹配时最多 NAME_SEARCH_TOP_K 条），
+            # 请求指定 top_k 时截断，截断与否由 total/truncated 给出
+            try:
+                top_k = int(request.json.get('top_k') or 0) or None
+            except (TypeError, ValueError):
+                top_k = None
+            ranked = snapshot.search_names(company_name)
+            total = len(ranked)
+            if top_k is None and ranked and ranked[0][1] == MATCH_OVERLAP:
+                top_k = NAME_SEARCH_TOP_K
+            if top_k is not None:
+                ranked = ranked[:max(top_k, 1)]
+            matching_rows = df.iloc[[pos for pos, _, _ in ranked]]
+            match_types = [NAME_MATCH_TYPES[tier] for _, tier, _ in ranked]
             
         if matching_rows.empty:
             query_type = "简道云账号" if jdy_id else "公司名称"
@@ -1469,101 +1690,158 @@ def query_customer():
             logger.info(f"未找到匹配的客户信息，查询{query_type}: {query_value}")
             return jsonify({'error': '未找到客户信息'}), 404
 
-        # 处理多条匹配记录
-        results = []
-        for _, customer_data in matching_rows.iterrows():
-            # 处理新字段映射
-            account_enterprise_name = str(customer_data.get('账号-企业名称', ''))
-            version_val = ''
-            try:
-                for col in ['版本', '购买版本', '产品版本', '版本类型']:
-                    v = customer_data.get(col, '')
-                    if pd.notna(v) and str(v).strip() and str(v).lower() != 'nan':
-                        version_val = str(v).strip()
-                        break
-            except Exception:
-                version_val = str(customer_data.get('版本', ''))
-            # 处理责任销售字段 - 优先使用续费责任销售，如果为空则使用责任销售中英文
-            sales_raw = customer_data.get('续费责任销售', '')
-            if pd.isna(sales_raw) or sales_raw == '' or str(sales_raw).lower() == 'nan':
-                sales = str(customer_data.get('责任销售中英文', ''))
-            else:
-                sales = str(sales_raw)
-            
-            sales_cn_en = str(customer_data.get('责任销售中英文', ''))
-            jdy_sales = str(customer_data.get('简道云销售', ''))
-            
-            
-            # 处理到期日期
-            expiry_date = ''
-            if '到期日期' in customer_data and pd.notna(customer_data['到期日期']):
-                try:
-                    expiry_date = pd.to_datetime(customer_data['到期日期']).strftime('%Y年%m月%d日')
-                    logger.info(f"到期日期: {expiry_date}")
-                except Exception as e:
-                    logger.warning(f"日期转换错误: {str(e)}")
-                    expiry_date = ''
-            
-            # 处理ARR
-            try:
-                arr_value = customer_data.get('应续ARR', 0)
-                if pd.isna(arr_value) or arr_value == '' or float(str(arr_value).replace(',', '')) == 0:
-                    arr_display = '0元'
-                else:
-                    arr_display = f"{float(str(arr_value).replace(',', ''))}元"
-                logger.info(f"应续ARR: {arr_display}")
-            except Exception as e:
-                logger.warning(f"ARR处理错误: {str(e)}")
-                arr_display = '0元'
-            
-            # 合同金额
-            try:
-                contract_val = None
-                for col in ['合同金额', '合同价', '合同总金额', '合同金额（元）']:
-                    if col in customer_data:
-                        cv = customer_data.get(col, '')
-                        if pd.notna(cv) and str(cv).strip() and str(cv).lower() != 'nan':
-                            contract_val = str(cv)
-                            break
-                if contract_val is None:
-                    contract_display = '0元'
-                else:
-                    amt = float(str(contract_val).replace(',', '').replace('元', ''))
-                    contract_display = f"{amt}元"
-            except Exception:
-                contract_display = '0元'
-
-            # 计算展示金额：优先应续ARR，否则合同金额
-            amount_display = arr_display if arr_display and arr_display != '0元' else contract_display
-
-            results.append({
-                'account_enterprise_name': account_enterprise_name,  # 账号-企业名称
-                'company_name': str(customer_data.get('公司名称', '')),  # 公司名称
-                'tax_number': str(customer_data.get('税号', '')),  # 税号
-                'version': version_val,
-                'expiry_date': expiry_date,  # 到期日期
-                'uid_arr': arr_display,  # 应续ARR
-                'contract_amount': contract_display,
-                'amount': amount_display,
-                'sales': sales,  # 续费责任销售
-                'sales_cn_en': sales_cn_en,  # 责任销售中英文
-                'jdy_sales': jdy_sales,  # 简道云销售
-                'user_id': str(customer_data.get('用户ID', ''))  # 保留用户ID用于兼容
-            })
-
-            logger.info(
-                f"处理客户数据: {customer_data['用户ID']}, 账号-企业名称: {account_enterprise_name}, "
-                f"版本: {version_val}, 应续ARR: {arr_display}, 合同金额: {contract_display}, "
-                f"续费责任销售: {sales}, 责任销售中英文: {sales_cn_en}, 简道云销售: {jdy_sales}"
-            )
+        # 处理多条匹配记录（金额、到期日、销售取自快照派生列）
+        derived = snapshot.derived if snapshot.derived is not None else build_derived_columns(df)
+        matching_rows = matching_rows.join(derived.loc[matching_rows.index])
+        results = [build_customer_result(record) for record in matching_rows.to_dict('records')]
+        if match_types:
+            for result, match_type in zip(results, match_types):
+                result['match_type'] = match_type
 
         logger.info(f"查询成功，找到{len(results)}条匹配记录")
-        return jsonify({'results': results})
+        if jdy_id:
+            return jsonify({'results': results})
+        return jsonify({'results': results, 'total': total, 'truncated': total > len(results)})
 
     except Exception as e:
         logger.error(f"查询出错: {str(e)}")
         return jsonify({'error': f'查询出错: {str(e)}'}), 500
 
+# 批量查询：一次请求查多个简道云账号/公司名称，单个快照内完成
+BATCH_QUERY_MAX_KEYS = 500
+
+def _clean_keys(values):
+    if values is None:
+        return []
+    if isinstance(values, str):
+        values = [values]
+    keys = []
+    for value in values:
+        text = str(value).strip() if value is not None else ''
+        if text:
+            keys.append(text)
+    return keys
+
+@app.route('/query_customer_batch', methods=['POST'])
+@login_required
+def query_customer_batch():
+    try:
+        data = request.get_json(silent=True) or {}
+        jdy_ids = _clean_keys(data.get('jdy_ids'))
+        company_names = _clean_keys(data.get('company_names'))
+        if not jdy_ids and not company_names:
+            return jsonify({'error': '请提供简道云账号列表(jdy_ids)或公司名称列表(company_names)'}), 400
+        if len(jdy_ids) + len(company_names) > BATCH_QUERY_MAX_KEYS:
+            return jsonify({'error': f'单次最多查询{BATCH_QUERY_MAX_KEYS}个账号/名称'}), 400
+        try:
+            top_k = int(data.get('top_k') or NAME_SEARCH_TOP_K)
+        except (TypeError, ValueError):
+            top_k = NAME_SEARCH_TOP_K
+        top_k = max(top_k, 1)
+
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'error': '数据文件读取失败'}), 500
+        df = snapshot.df
+        if '用户ID' not in df.columns:
+            return jsonify({'error': '数据格式错误：缺少用户ID列'}), 500
+
+        # 1) 逐个键走索引，只记录行位置
+        lookups = []
+        for jdy_id in jdy_ids:
+            exact = snapshot.find_rows(jdy_id)
+            positions = exact or snapshot.find_rows(jdy_id, allow_partial=True)
+            match_type = 'exact' if exact else 'partial'
+            lookups.append(('jdy_id', jdy_id, positions, [match_type] * len(positions)))
+        for name in company_names:
+            # 多取一条，用于判断是否截断
+            ranked = snapshot.search_names(name, top_k=top_k + 1)
+            lookups.append(('company_name', name, [pos for pos, _, _ in ranked],
+                            [NAME_MATCH_TYPES[tier] for _, tier, _ in ranked]))
+
+        # 2) 所有命中行去重后统一取派生列、构建结果（每个键最多返回 top_k 条）
+        unique_positions = sorted({pos for _, _, positions, _ in lookups for pos in positions[:top_k]})
+        rows = {}
+        if unique_positions:
+            matched = df.iloc[unique_positions]
+            derived = snapshot.derived if snapshot.derived is not None else build_derived_columns(df)
+            matched = matched.join(derived.loc[matched.index])
+            for pos, record in zip(unique_positions, matched.to_dict('records')):
+                rows[pos] = build_customer_result(record)
+
+        # 3) 按请求顺序组装：未命中标记、多客户歧义标记
+        items = []
+        not_found = 0
+        id_column = df['用户ID']
+        for key_type, key, positions, match_types in lookups:
+            results = []
+            for pos, match_type in zip(positions[:top_k], match_types):
+                result = dict(rows[pos])
+                result['match_type'] = match_type
+                results.append(result)
+            # 歧义只在最佳匹配等级内判断（如同名完全匹配对应多个客户），前缀/相似等邻近结果不计入
+            best = match_types[0] if match_types else None
+            customer_ids = {str(id_column.iat[pos]) for pos, match_type in zip(positions, match_types)
+                            if match_type == best}
+            if not results:
+                not_found += 1
+            items.append({
+                'key': key,
+                'key_type': key_type,
+                'found': bool(results),
+                'ambiguous': len(customer_ids) > 1,
+                'matched_count': len(positions),
+                'truncated': len(positions) > len(results),
+                'results': results
+            })
+
+        logger.info(f"批量查询完成：{len(items)}个键，未找到{not_found}个")
+        return jsonify({'items': items, 'total': len(items), 'not_found': not_found})
+
+    except Exception as e:
+        logger.error(f"批量查询出错: {str(e)}")
+        return jsonify({'error': f'批量查询出错: {str(e)}'}), 500
+
+# 输入联想：按 用户ID/公司名称/账号-企业名称/税号 前缀补全，供逐键调用
+SUGGEST_DEFAULT_LIMIT = 10
+SUGGEST_MAX_LIMIT = 50
+
+def _cell_text(value):
+    if value is None:
+        return ''
+    text = str(value).strip()
+    return '' if text.lower() == 'nan' else text
+
+@app.route('/suggest', methods=['GET'])
+@login_required
+def suggest():
+    q = str(request.args.get('q', '')).strip()
+    try:
+        limit = int(request.args.get('limit', SUGGEST_DEFAULT_LIMIT))
+    except (TypeError, ValueError):
+        limit = SUGGEST_DEFAULT_LIMIT
+    limit = min(max(limit, 1), SUGGEST_MAX_LIMIT)
+    if not q:
+        return jsonify({'q': q, 'suggestions': []})
+    try:
+        snapshot = get_cached_snapshot()
+        if snapshot is None:
+            return jsonify({'error': '数据文件读取失败'}), 500
+        df = snapshot.df
+        suggestions = []
+        for pos, field in snapshot.suggest(q, limit):
+            row = df.iloc[pos]
+            name = _cell_text(row.get('公司名称')) or _cell_text(row.get('账号-企业名称'))
+            item = {'id': _cell_text(row.get('用户ID')), 'name': name, 'field': field}
+            # 命中的不是 ID/主名称时附带命中值（税号、账号-企业名称）
+            if field not in ('用户ID', '公司名称'):
+                item['value'] = _cell_text(row.get(field))
+            suggestions.append(item)
+        return jsonify({'q': q, 'suggestions': suggestions})
+    except Exception as e:
+        logger.error(f"输入联想失败: {str(e)}")
+        return jsonify({'error': f'输入联想失败: {str(e)}'}), 500
+
 @app.route('/update_stage', methods=['POST'])
 @login_required
 def update_stage():
@@ -1582,7 +1860,8 @@ def update_stage():
         mgr = None
         if STAGE_MANAGER_AVAILABLE:
             try:
-                mgr = StageManager(get_user_excel_path())
+                mgr = StageManager(get_user_excel_path(), snapshot_service=customer_snapshots,
+                                   write_queue=stage_write_queue)
             except Exception as e:
                 logger.warning(f"状态管理器实例化失败: {str(e)}")
                 mgr = None
@@ -1633,9 +1912,12 @@ def _legacy_update_stage(jdy_id, stage):
             logger.error(f"Excel文件不存在: {excel_path}")
             return jsonify({'success': False, 'error': 'Excel文件不存在', 'error_type': 'file_not_found'}), 500
         
-        # 读取Excel文件
+        # 共享快照只读（不接受过期快照）；变更写入阶段变更日志后发布新快照
         ensure_pandas_imported()
-        df = pd.read_excel(excel_path)
+        snapshot = customer_snapshots.get(allow_stale=False)
+        if snapshot is None:
+            return jsonify({'success': False, 'error': 'Excel文件读取失败', 'error_type': 'file_read_error'}), 500
+        df = snapshot.df
         logger.info(f"成功读取Excel文件，共{len(df)}行数据")
         
         # 检查必要的列是否存在
@@ -1643,30 +1925,25 @@ def _legacy_update_stage(jdy_id, stage):
             logger.error("Excel文件中缺少'用户ID'列")
             return jsonify({'success': False, 'error': 'Excel文件格式错误：缺少用户ID列', 'error_type': 'column_missing'}), 500
         
-        # 查找匹配的客户记录
-        matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
+        # 查找匹配的客户记录（用户ID精确匹配，避免子串误命中其他客户）
+        matching_rows = df.iloc[snapshot.find_rows(jdy_id)]
         
         if matching_rows.empty:
             logger.warning(f"未找到匹配的客户记录: {jdy_id}")
             return jsonify({'success': False, 'error': f'未找到客户记录: {jdy_id}', 'error_type': 'customer_not_found'}), 404
         
-        # 检查是否有阶段列，如果没有则创建
-        stage_column = '客户阶段'
-        if stage_column not in df.columns:
-            df[stage_column] = ''
-            logger.info(f"创建新列: {stage_column}")
-        
         # 更新匹配记录的阶段
+        stage_column = '客户阶段'
         updated_count = 0
         for index in matching_rows.index:
-            old_stage = df.loc[index, stage_column] if pd.notna(df.loc[index, stage_column]) else '未设置'
-            df.loc[index, stage_column] = stage
+            old_value = df.loc[index, stage_column] if stage_column in df.columns else None
+            old_stage = old_value if pd.notna(old_value) else '未设置'
             updated_count += 1
             logger.info(f"更新记录 {index}: {old_stage} -> {stage}")
         
-        # 保存更新后的Excel文件
-        df.to_excel(excel_path, index=False)
-        logger.info(f"Excel文件已更新，共更新 {updated_count} 条记录")
+        # 经合并写入队列写入阶段变更日志并发布新快照
+        stage_write_queue.update(jdy_id, stage, {'source': 'legacy_update_stage'})
+        logger.info(f"阶段变更已记录，共更新 {updated_count} 条记录")
         
         return jsonify({
             'success': True,
@@ -1678,8 +1955,22 @@ def _legacy_update_stage(jdy_id, stage):
          logger.error(f"Excel文件操作失败: {str(e)}")
          return jsonify({'success': False, 'error': f'Excel文件操作失败: {str(e)}', 'error_type': 'file_operation_error'}), 500
 
+@app.route('/stage_journal/compact', methods=['POST'])
+@login_required
+def compact_stage_journal():
+    """立即把阶段变更日志写回工作簿"""
+    try:
+        result = customer_snapshots.compact(f"（{session.get('user', '')}手动触发）")
+        if result.get('error'):
+            return jsonify({'success': False, **result}), 500
+        return jsonify({'success': True, **result})
+    except Exception as e:
+        logger.error(f"阶段变更日志压实失败: {str(e)}")
+        return jsonify({'success': False, 'error': f'压实失败: {str(e)}'}), 500
+
 @app.route('/stage_history', methods=['GET'])
 @login_required
+@conditional_get(lambda: _file_validator(_stage_log_path()))
 def get_stage_history():
     """获取状态变更历史"""
     try:
@@ -1689,7 +1980,7 @@ def get_stage_history():
         mgr = None
         if STAGE_MANAGER_AVAILABLE:
             try:
-                mgr = StageManager(get_user_excel_path())
+                mgr = StageManager(get_user_excel_path(), snapshot_service=customer_snapshots)
             except Exception as e:
                 logger.warning(f"状态管理器实例化失败: {str(e)}")
                 mgr = None
@@ -1740,7 +2031,7 @@ def validate_stage_batch():
         mgr = None
         if STAGE_MANAGER_AVAILABLE:
             try:
-                mgr = StageManager(get_user_excel_path())
+                mgr = StageManager(get_user_excel_path(), snapshot_service=customer_snapshots)
             except Exception as e:
                 logger.warning(f"状态管理器实例化失败: {str(e)}")
                 mgr = None
@@ -1766,6 +2057,82 @@ def validate_stage_batch():
             'error_type': 'system_error'
         }), 500
 
+# 单次批量推进的最大条数
+STAGE_BATCH_MAX_UPDATES = 500
+
+@app.route('/update_stage_batch', methods=['POST'])
+@login_required
+def update_stage_batch():
+    """批量推进客户阶段：同一快照上校验，一次写入变更日志，返回逐条结果
+
+    请求体：{"updates": [{"jdy_id": "...", "target_stage": "合同"}], "atomic": true, "force": false}
+    atomic=true 时任一条未通过校验则整批不写入（409）；force=true 时跳过状态转换规则校验
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not data or 'updates' not in data:
+            return jsonify({
+                'success': False,
+                'error': '缺少必要参数：updates',
+                'error_type': 'validation'
+            }), 400
+
+        updates = data['updates']
+        if not isinstance(updates, list) or not updates:
+            return jsonify({
+                'success': False,
+                'error': 'updates必须是非空数组',
+                'error_type': 'validation'
+            }), 400
+        if len(updates) > STAGE_BATCH_MAX_UPDATES:
+            return jsonify({
+                'success': False,
+                'error': f'单次最多推进{STAGE_BATCH_MAX_UPDATES}条',
+                'error_type': 'validation'
+            }), 400
+
+        mgr = None
+        if STAGE_MANAGER_AVAILABLE:
+            try:
+                mgr = StageManager(get_user_excel_path(), snapshot_service=customer_snapshots)
+            except Exception as e:
+                logger.warning(f"状态管理器实例化失败: {str(e)}")
+                mgr = None
+        if not mgr:
+            return jsonify({
+                'success': False,
+                'error': '状态管理器不可用',
+                'error_type': 'service_unavailable'
+            }), 503
+
+        logger.info(f"批量推进客户阶段: {len(updates)}条")
+        result = mgr.update_stage_batch(
+            updates,
+            force=bool(data.get('force', False)),
+            atomic=bool(data.get('atomic', True)),
+            metadata={
+                'source': 'web_interface_batch',
+                'user': session.get('user'),
+                'user_agent': request.headers.get('User-Agent', ''),
+                'ip': request.remote_addr,
+                'timestamp': datetime.now().isoformat()
+            }
+        )
+        if result['success']:
+            return jsonify(result), 200
+        error_type = result.get('error_type', 'unknown')
+        if error_type == 'batch_rejected':
+            return jsonify(result), 409
+        return jsonify(result), 500
+
+    except Exception as e:
+        logger.error(f"批量推进阶段失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'error_type': 'system_error'
+        }), 500
+
 @app.route('/stage_rules', methods=['GET'])
 @login_required
 def get_stage_rules():
@@ -1774,7 +2141,7 @@ def get_stage_rules():
         mgr = None
         if STAGE_MANAGER_AVAILABLE:
             try:
-                mgr = StageManager(get_user_excel_path())
+                mgr = StageManager(get_user_excel_path(), snapshot_service=customer_snapshots)
             except Exception as e:
                 logger.warning(f"状态管理器实例化失败: {str(e)}")
                 mgr = None
@@ -2331,13 +2698,15 @@ def monitor_downloads():
                 'error': f'扫描文件夹失败: {str(e)}'
             }), 500
         
-        # 自动推进找到简道云账号的合同到"合同"阶段
+        # 自动推进找到简道云账号的合同到"合同"阶段（一次提交，合并为一次写入）
+        stage_results = update_customer_stages(
+            [contract['jdy_account'] for contract in recent_contracts if contract['jdy_account']], '合同')
         updated_contracts = []
         for contract in recent_contracts:
             if contract['jdy_account']:
                 try:
-                    # 调用更新阶段的逻辑
-                    result = update_customer_stage(contract['jdy_account'], '合同')
+                    # 取批量推进的结果
+                    result = stage_results[contract['jdy_account']]
                     if result['success']:
                         updated_contracts.append({
                             'filename': contract['filename'],
@@ -2408,49 +2777,55 @@ def extract_jdy_account_from_filename(filename):
     
     return None
 
-def update_customer_stage(jdy_id, stage):
-    """更新客户阶段的内部函数"""
+def update_customer_stages(jdy_ids, stage):
+    """批量推进客户阶段的内部函数：全部校验后一并提交到合并写入队列，返回 用户ID -> 结果"""
+    results = {}
     try:
         # 读取Excel文件
         excel_path = get_user_excel_path()
         if not os.path.exists(excel_path):
-            return {'success': False, 'error': 'Excel文件不存在'}
+            return {jdy_id: {'success': False, 'error': 'Excel文件不存在'} for jdy_id in jdy_ids}
         
         ensure_pandas_imported()
-        df = pd.read_excel(excel_path)
+        snapshot = customer_snapshots.get(allow_stale=False)
+        if snapshot is None:
+            return {jdy_id: {'success': False, 'error': 'Excel文件读取失败'} for jdy_id in jdy_ids}
         
         # 检查必要的列是否存在
-        if '用户ID' not in df.columns:
-            return {'success': False, 'error': 'Excel文件格式错误：缺少用户ID列'}
-        
-        # 查找匹配的客户记录
-        matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
-        
-        if matching_rows.empty:
-            return {'success': False, 'error': f'未找到客户记录: {jdy_id}'}
-        
-        # 检查是否有阶段列，如果没有则创建
-        stage_column = '客户阶段'
-        if stage_column not in df.columns:
-            df[stage_column] = ''
-        
-        # 更新匹配记录的阶段
-        updated_count = 0
-        for index in matching_rows.index:
-            df.loc[index, stage_column] = stage
-            updated_count += 1
+        if '用户ID' not in snapshot.df.columns:
+            return {jdy_id: {'success': False, 'error': 'Excel文件格式错误：缺少用户ID列'} for jdy_id in jdy_ids}
         
-        # 保存更新后的Excel文件
-        df.to_excel(excel_path, index=False)
+        # 查找匹配的客户记录（用户ID精确匹配，避免子串误命中其他客户），先全部入队再等待确认
+        pending = {}
+        for jdy_id in jdy_ids:
+            if jdy_id in results or jdy_id in pending:
+                continue
+            updated_count = len(snapshot.find_rows(jdy_id))
+            if not updated_count:
+                results[jdy_id] = {'success': False, 'error': f'未找到客户记录: {jdy_id}'}
+                continue
+            pending[jdy_id] = (stage_write_queue.submit(jdy_id, stage, {'source': 'contract_monitor'}), updated_count)
         
-        return {
-            'success': True,
-            'message': f'客户 {jdy_id} 已成功推进到 {stage} 阶段',
-            'updated_count': updated_count
-        }
+        # 写入阶段变更日志并发布新快照（工作簿在压实时统一写回）
+        for jdy_id, (future, updated_count) in pending.items():
+            try:
+                future.result(stage_write_queue.ack_timeout)
+                results[jdy_id] = {
+                    'success': True,
+                    'message': f'客户 {jdy_id} 已成功推进到 {stage} 阶段',
+                    'updated_count': updated_count
+                }
+            except Exception as e:
+                results[jdy_id] = {'success': False, 'error': f'更新失败: {str(e)}'}
         
     except Exception as e:
-        return {'success': False, 'error': f'更新失败: {str(e)}'}
+        for jdy_id in jdy_ids:
+            results.setdefault(jdy_id, {'success': False, 'error': f'更新失败: {str(e)}'})
+    return results
+
+def update_customer_stage(jdy_id, stage):
+    """更新客户阶段的内部函数"""
+    return update_customer_stages([jdy_id], stage)[jdy_id]
 
 def background_monitor_worker():
     """后台监控工作线程"""
@@ -2524,7 +2899,9 @@ def perform_monitor_check():
                         'jdy_account': jdy_account
                     })
         
-        # 自动推进找到简道云账号的合同到"合同"阶段
+        # 自动推进找到简道云账号的合同到"合同"阶段（一次提交，合并为一次写入）
+        stage_results = update_customer_stages(
+            [contract['jdy_account'] for contract in recent_contracts if contract['jdy_account']], '合同')
         updated_contracts = []
         for contract in recent_contracts:
             # 处理完成后立即记录文件，避免重复处理
@@ -2532,8 +2909,8 @@ def perform_monitor_check():
             
             if contract['jdy_account']:
                 try:
-                    # 调用更新阶段的逻辑
-                    result = update_customer_stage(contract['jdy_account'], '合同')
+                    # 取批量推进的结果
+                    result = stage_results[contract['jdy_account']]
                     if result['success']:
                         updated_contracts.append({
                             'filename': contract['filename'],
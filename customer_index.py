@@ -0,0 +1,580 @@
+import logging
+import threading
+from bisect import bisect_left
+from datetime import date, timedelta
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = date(1970, 1, 1)
+
+def day_number(day: date) -> int:
+    """日期 -> 距 1970-01-01 的天数"""
+    if hasattr(day, 'date') and callable(day.date):
+        day = day.date()
+    return (day - _EPOCH).days
+
+
+class ExpiryIndex:
+    """到期日排序索引：按天号升序的 int64 数组 + 行位置置换
+
+    任意日期窗口 = 两次二分查找 + 切片，返回的行位置已按到期日升序（同日保持原始行序）。
+    到期日为空（NaT）的行不进入索引。
+    """
+
+    def __init__(self, expiry_days):
+        import numpy as np
+        values = expiry_days.to_numpy(dtype='datetime64[ns]')
+        valid = ~np.isnat(values)
+        positions = np.flatnonzero(valid)
+        days = values[valid].astype('datetime64[D]').astype('int64')
+        order = np.argsort(days, kind='stable')
+        self.days = days[order]
+        self.positions = positions[order]
+
+    def __len__(self):
+        return int(len(self.days))
+
+    def _bounds(self, start: date, end: date):
+        import numpy as np
+        lo = int(np.searchsorted(self.days, day_number(start), side='left'))
+        hi = int(np.searchsorted(self.days, day_number(end), side='right'))
+        return lo, max(lo, hi)
+
+    def range(self, start: date, end: date):
+        """到期日落在 [start, end]（闭区间）内的行位置，按到期日升序"""
+        lo, hi = self._bounds(start, end)
+        return self.positions[lo:hi]
+
+    def count(self, start: date, end: date) -> int:
+        lo, hi = self._bounds(start, end)
+        return hi - lo
+
+
+def normalize_id(value) -> str:
+    """用户ID归一化：去空白、转小写；空值为空串；整数值的浮点数（如 12345.0）按整数处理"""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip()
+    if not text or text.lower() == 'nan':
+        return ''
+    return text.lower()
+
+
+class IdIndex:
+    """用户ID索引：归一化ID的精确哈希索引 + 按需构建的 n-gram 倒排索引（部分ID查询）
+
+    返回值均为行位置（iloc）列表，按原始行序排列。
+    """
+
+    def __init__(self, ids, ngram: int = 3):
+        self.ngram = ngram
+        self._ids = [normalize_id(v) for v in ids]
+        self._exact = {}
+        for pos, key in enumerate(self._ids):
+            if key:
+                self._exact.setdefault(key, []).append(pos)
+        self._grams = None
+        self._grams_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._exact)
+
+    def exact(self, value) -> List[int]:
+        """精确匹配（大小写不敏感）"""
+        return list(self._exact.get(normalize_id(value), ()))
+
+    def _build_grams(self):
+        with self._grams_lock:
+            if self._grams is not None:
+                return self._grams
+            n = self.ngram
+            grams = {}
+            for key in self._exact:
+                for gram in {key[i:i + n] for i in range(max(len(key) - n + 1, 0))}:
+                    grams.setdefault(gram, []).append(key)
+            self._grams = grams
+            return grams
+
+    def partial(self, value, limit: int = None) -> List[int]:
+        """部分ID匹配（子串，大小写不敏感）"""
+        query = normalize_id(value)
+        if not query:
+            return []
+        n = self.ngram
+        if len(query) < n:
+            candidates = self._exact.keys()
+        else:
+            grams = self._build_grams()
+            query_grams = sorted({query[i:i + n] for i in range(len(query) - n + 1)},
+                                 key=lambda g: len(grams.get(g, ())))
+            candidate_set = None
+            for gram in query_grams:
+                keys = grams.get(gram)
+                if not keys:
+                    return []
+                candidate_set = set(keys) if candidate_set is None else candidate_set.intersection(keys)
+                if not candidate_set:
+                    return []
+            candidates = candidate_set or ()
+        positions = []
+        for key in candidates:
+            if query in key:
+                positions.extend(self._exact[key])
+        positions.sort()
+        return positions[:limit] if limit else positions
+
+    def lookup(self, value, allow_partial: bool = False) -> List[int]:
+        """精确匹配优先；允许部分匹配时，精确未命中再做子串匹配"""
+        positions = self.exact(value)
+        if positions or not allow_partial:
+            return positions
+        return self.partial(value)
+
+
+def normalize_name(value) -> str:
+    """公司名称归一化：去空白、转小写；空值为空串"""
+    if value is None:
+        return ''
+    text = str(value).strip()
+    if not text or text.lower() == 'nan':
+        return ''
+    return text.lower()
+
+
+# 名称匹配等级（越小越靠前）
+MATCH_EXACT = 0
+MATCH_PREFIX = 1
+MATCH_SUBSTRING = 2
+MATCH_OVERLAP = 3
+
+
+class NameIndex:
+    """公司名称倒排索引：单字 + 字符二元组（bigram） -> 名称编号的有序数组
+
+    多个名称列合并建索引，同名行共用一个名称编号；名称编号按（长度, 名称）分配，
+    倒排表天然按名称长度升序，取前 top_k 时可提前结束扫描。
+    排名：完全匹配 > 前缀（字典序，二分定位） > 包含（名称越短越靠前） > bigram 重合度。
+    """
+
+    def __init__(self, columns, min_overlap: float = 0.5):
+        import numpy as np
+        self.min_overlap = min_overlap
+        rows_by_name = {}
+        for values in columns:
+            for pos, value in enumerate(values):
+                key = normalize_name(value)
+                if not key:
+                    continue
+                rows = rows_by_name.setdefault(key, [])
+                if not rows or rows[-1] != pos:
+                    rows.append(pos)
+        self._names = sorted(rows_by_name, key=lambda name: (len(name), name))
+        self._rows = [sorted(set(rows_by_name[name])) for name in self._names]
+        self._ids = {name: name_id for name_id, name in enumerate(self._names)}
+        # 前缀查找用的字典序名称表
+        self._lex_ids = sorted(range(len(self._names)), key=self._names.__getitem__)
+        self._lex_names = [self._names[i] for i in self._lex_ids]
+        postings = {}
+        for name_id, name in enumerate(self._names):
+            for gram in self._grams(name):
+                postings.setdefault(gram, []).append(name_id)
+        self._postings = {gram: np.asarray(name_ids, dtype=np.int32) for gram, name_ids in postings.items()}
+
+    def __len__(self):
+        return len(self._names)
+
+    @staticmethod
+    def _bigrams(text: str):
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    @classmethod
+    def _grams(cls, text: str):
+        return set(text) | cls._bigrams(text)
+
+    def _prefixed(self, query: str):
+        """以 query 开头（不含完全相同）的名称编号，字典序"""
+        lo = bisect_left(self._lex_names, query)
+        names = self._lex_names
+        for i in range(lo, len(names)):
+            if not names[i].startswith(query):
+                break
+            if names[i] != query:
+                yield self._lex_ids[i]
+
+    def _contained(self, query: str):
+        """包含 query（非前缀）的名称编号，名称长度升序
+
+        沿最短的 gram 倒排表扫描并做子串校验，无需先求交集。
+        """
+        grams = self._bigrams(query) if len(query) > 1 else {query}
+        shortest = None
+        for gram in grams:
+            arr = self._postings.get(gram)
+            if arr is None:
+                return
+            if shortest is None or len(arr) < len(shortest):
+                shortest = arr
+        names = self._names
+        for i in shortest:
+            name = names[i]
+            if query in name and not name.startswith(query):
+                yield int(i)
+
+    def _overlapping(self, query: str, exclude):
+        """与 query 的 bigram 重合度达到阈值的名称编号 -> 重合度
+
+        "有限""公司"这类高频 bigram 几乎命中全部名称，只用低频 bigram 生成候选，
+        再按完整 bigram 集合计算重合度。
+        """
+        import numpy as np
+        grams = self._bigrams(query)
+        present = [g for g in grams if g in self._postings]
+        if not grams or not present:
+            return {}
+        need = max(1, int(np.ceil(len(grams) * self.min_overlap)))
+        if len(present) < need:
+            return {}
+        limit = max(1, len(self._names) // 10)
+        source = [g for g in present if len(self._postings[g]) <= limit] or present
+        # 候选至少要在低频 bigram 上命中 need - 高频 bigram 数 次
+        min_hits = max(1, need - (len(present) - len(source)))
+        counts = np.bincount(np.concatenate([self._postings[g] for g in source]), minlength=len(self._names))
+        names = self._names
+        scores = {}
+        for i in np.flatnonzero(counts >= min_hits):
+            name_id = int(i)
+            if name_id in exclude or query in names[name_id]:
+                continue
+            shared = len(grams & self._bigrams(names[name_id]))
+            if shared >= need:
+                scores[name_id] = shared / len(grams)
+        return scores
+
+    def containing(self, query) -> List[int]:
+        """名称包含 query 的全部行位置（不排名，用于筛选）"""
+        query = normalize_name(query)
+        if not query:
+            return []
+        name_ids = list(self._contained(query))
+        name_ids.extend(self._prefixed(query))
+        if query in self._ids:
+            name_ids.append(self._ids[query])
+        return sorted({pos for name_id in name_ids for pos in self._rows[name_id]})
+
+    def search(self, query, top_k: int = None):
+        """返回 [(行位置, 匹配等级, 得分)]，按排名排序，最多 top_k 行（None 表示不限）
+
+        bigram 相似匹配只在没有 完全/前缀/包含 命中时作为兜底返回。
+        """
+        query = normalize_name(query)
+        if not query:
+            return []
+        results = []
+        seen = set()
+
+        def take(name_id, tier, score=1.0):
+            for pos in self._rows[name_id]:
+                if pos not in seen:
+                    seen.add(pos)
+                    results.append((pos, tier, score))
+            return bool(top_k) and len(results) >= top_k
+
+        exact_id = self._ids.get(query)
+        if exact_id is not None and take(exact_id, MATCH_EXACT):
+            return results[:top_k]
+        for name_id in self._prefixed(query):
+            if take(name_id, MATCH_PREFIX):
+                return results[:top_k]
+        for name_id in self._contained(query):
+            if take(name_id, MATCH_SUBSTRING):
+                return results[:top_k]
+        if results:
+            return results
+        overlaps = self._overlapping(query, exclude=set())
+        for name_id in sorted(overlaps, key=lambda i: (-overlaps[i], len(self._names[i]), i)):
+            if take(name_id, MATCH_OVERLAP, overlaps[name_id]):
+                return results[:top_k]
+        return results
+
+
+class SuggestIndex:
+    """输入联想用的有序前缀表：(归一化取值, 字段, 行位置) 按取值排序
+
+    前缀查询 = 一次二分定位 + 顺序扫描，凑满 limit 个不同客户即停止。
+    """
+
+    def __init__(self, fields):
+        entries = []
+        for field, values in fields:
+            for pos, value in enumerate(values):
+                key = normalize_id(value)
+                if key:
+                    entries.append((key, field, pos))
+        entries.sort()
+        self._keys = [key for key, _, _ in entries]
+        self._entries = [(field, pos) for _, field, pos in entries]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def complete(self, prefix, limit: int = 10, exclude=()):
+        """返回 [(行位置, 字段)]，每个客户只出现一次"""
+        prefix = normalize_id(prefix)
+        if not prefix or limit <= 0:
+            return []
+        keys = self._keys
+        seen = set(exclude)
+        results = []
+        for i in range(bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            field, pos = self._entries[i]
+            if pos in seen:
+                continue
+            seen.add(pos)
+            results.append((pos, field))
+            if len(results) >= limit:
+                break
+        return results
+
+
+# 单字节 popcount 查表
+_POPCOUNT = None
+
+def _popcount_table():
+    global _POPCOUNT
+    if _POPCOUNT is None:
+        import numpy as np
+        _POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+    return _POPCOUNT
+
+
+class BitmapIndex:
+    """战区 / 销售代表 / 阶段状态的位图索引（np.packbits 压缩，每行 1 bit）
+
+    任意 AND/OR 组合 = 字节数组上的按位运算，计数 = 查表 popcount。
+    维度：'zone'（标准化战区）、'sales'（标准化销售代表）、'stage'（阶段状态，如 contract/lost）。
+    """
+
+    def __init__(self, derived):
+        import numpy as np
+        self.size = int(len(derived))
+        self._nbytes = (self.size + 7) // 8
+        self._bitmaps = {}
+        for dim, column in (('zone', '_zone'), ('sales', '_sales')):
+            values = derived[column]
+            if hasattr(values, 'cat'):
+                codes = values.cat.codes.to_numpy()
+                categories = list(values.cat.categories)
+            else:
+                codes, uniques = values.factorize()
+                categories = list(uniques)
+            self._bitmaps[dim] = {
+                str(value): np.packbits(codes == code) for code, value in enumerate(categories)
+            }
+        self._bitmaps['stage'] = {
+            column[len('_status_'):]: np.packbits(derived[column].to_numpy(dtype=bool))
+            for column in derived.columns if column.startswith('_status_')
+        }
+
+    def values(self, dim: str) -> List[str]:
+        return list(self._bitmaps.get(dim, {}))
+
+    def empty(self):
+        import numpy as np
+        return np.zeros(self._nbytes, dtype=np.uint8)
+
+    def full(self):
+        import numpy as np
+        bits = np.full(self._nbytes, 0xFF, dtype=np.uint8)
+        tail = self.size % 8
+        if tail:
+            bits[-1] = (0xFF << (8 - tail)) & 0xFF
+        return bits
+
+    def bitmap(self, dim: str, value):
+        """单个取值的位图；未知取值返回全 0"""
+        bits = self._bitmaps.get(dim, {}).get(str(value))
+        return bits if bits is not None else self.empty()
+
+    def any_of(self, dim: str, values):
+        """OR：命中任一取值"""
+        import numpy as np
+        result = self.empty()
+        for value in values:
+            np.bitwise_or(result, self.bitmap(dim, value), out=result)
+        return result
+
+    def from_positions(self, positions):
+        import numpy as np
+        mask = np.zeros(self.size, dtype=bool)
+        mask[np.asarray(positions, dtype=np.int64)] = True
+        return np.packbits(mask)
+
+    def combine(self, zones=None, sales=None, stages=None, base=None):
+        """AND 组合各维度的 OR 结果；参数为 None 表示该维度不过滤"""
+        import numpy as np
+        bits = self.full() if base is None else base.copy()
+        for dim, values in (('zone', zones), ('sales', sales), ('stage', stages)):
+            if values is not None:
+                np.bitwise_and(bits, self.any_of(dim, values), out=bits)
+        return bits
+
+    def count(self, bits) -> int:
+        return int(_popcount_table()[bits].sum())
+
+    def mask(self, bits):
+        """位图 -> 长度为行数的 bool 数组"""
+        import numpy as np
+        return np.unpackbits(bits, count=self.size).astype(bool)
+
+    def positions(self, bits):
+        import numpy as np
+        return np.flatnonzero(self.mask(bits))
+
+    def facet_counts(self, dim: str, bits=None):
+        """按维度各取值计数（bits 为限定范围，如日期窗口）"""
+        import numpy as np
+        table = _popcount_table()
+        counts = {}
+        for value, bitmap in self._bitmaps.get(dim, {}).items():
+            selected = bitmap if bits is None else np.bitwise_and(bitmap, bits)
+            counts[value] = int(table[selected].sum())
+        return counts
+
+
+class ExpiryHistogram:
+    """按到期日的逐日直方图：每个有客户到期的日期一行
+
+    - counts：当日到期客户数；arr：当日应续ARR合计（缺失按 0）
+    - by_zone / by_sales / by_stage：当日按 战区 / 销售代表 / 阶段状态 的客户数（二维数组，列对应 zones/sales/stages）
+    - arr_by_zone / arr_by_sales：当日按 战区 / 销售代表 的 ARR 合计
+    任意日期区间 = 两次二分查找 + 切片，耗时只与区间内天数有关。
+    过滤某战区/销售后再展开其它维度时，各维度表只是边际分布，改为对区间内的行现场计数。
+    """
+
+    def __init__(self, derived, expiry_index: ExpiryIndex):
+        import numpy as np
+        days = expiry_index.days
+        positions = expiry_index.positions
+        self.days, day_slot = np.unique(days, return_inverse=True)
+        n_days = len(self.days)
+
+        def codes_of(column):
+            values = derived[column]
+            if not hasattr(values, 'cat'):
+                values = values.astype('category')
+            labels = [str(v) for v in values.cat.categories]
+            codes = values.cat.codes.to_numpy().astype(np.int64)[positions]
+            return labels, codes
+
+        arr = np.nan_to_num(derived['_arr'].to_numpy(dtype='float64')[positions])
+        self.counts = np.bincount(day_slot, minlength=n_days)
+        self.arr = np.bincount(day_slot, weights=arr, minlength=n_days)
+
+        self.zones, zone_codes = codes_of('_zone')
+        self.sales, sales_codes = codes_of('_sales')
+        self.by_zone, self.arr_by_zone = self._table(day_slot, zone_codes, len(self.zones), n_days, arr)
+        self.by_sales, self.arr_by_sales = self._table(day_slot, sales_codes, len(self.sales), n_days, arr)
+
+        status_columns = [c for c in derived.columns if c.startswith('_status_')]
+        self.stages = [c[len('_status_'):] for c in status_columns]
+        self.by_stage = np.zeros((n_days, len(status_columns)), dtype=np.int64)
+        self._stage_flags = np.zeros((len(positions), len(status_columns)), dtype=bool)
+        for i, column in enumerate(status_columns):
+            flags = derived[column].to_numpy(dtype=bool)[positions]
+            self._stage_flags[:, i] = flags
+            self.by_stage[:, i] = np.bincount(day_slot[flags], minlength=n_days)
+        # 逐行编码（按到期日升序），供过滤后展开时现场计数
+        self._day_slot = day_slot
+        self._zone_codes = zone_codes
+        self._sales_codes = sales_codes
+
+    @staticmethod
+    def _table(day_slot, codes, width, n_days, arr):
+        import numpy as np
+        valid = codes >= 0
+        flat = day_slot[valid] * width + codes[valid]
+        size = n_days * width
+        counts = np.bincount(flat, minlength=size).reshape(n_days, width)
+        sums = np.bincount(flat, weights=arr[valid], minlength=size).reshape(n_days, width)
+        return counts, sums
+
+    def _filtered_tables(self, window: slice, codes, column, breakdown):
+        """区间内满足过滤条件（codes == column）的行按天展开 breakdown 各维度，返回 {维度: (标签, 表)}"""
+        import numpy as np
+        n_days = window.stop - window.start
+        lo = int(np.searchsorted(self._day_slot, window.start, side='left'))
+        hi = int(np.searchsorted(self._day_slot, window.stop, side='left'))
+        if column is None:
+            keep = np.zeros(hi - lo, dtype=bool)
+        else:
+            keep = codes[lo:hi] == column
+        slots = self._day_slot[lo:hi][keep] - window.start
+        arr = np.zeros(len(slots))
+        tables = {}
+        for dim in breakdown:
+            if dim == 'stage':
+                flags = self._stage_flags[lo:hi][keep]
+                table = np.zeros((n_days, len(self.stages)), dtype=np.int64)
+                for i in range(len(self.stages)):
+                    table[:, i] = np.bincount(slots[flags[:, i]], minlength=n_days)
+                tables[dim] = (self.stages, table)
+            else:
+                labels, dim_codes = (self.zones, self._zone_codes) if dim == 'zone' else (self.sales, self._sales_codes)
+                table, _ = self._table(slots, dim_codes[lo:hi][keep], len(labels), n_days, arr)
+                tables[dim] = (labels, table)
+        return tables
+
+    def __len__(self):
+        return int(len(self.days))
+
+    def slice(self, start: date, end: date):
+        """[start, end] 闭区间对应的行切片"""
+        import numpy as np
+        lo = int(np.searchsorted(self.days, day_number(start), side='left'))
+        hi = int(np.searchsorted(self.days, day_number(end), side='right'))
+        return slice(lo, max(lo, hi))
+
+    def series(self, start: date, end: date, zone: str = None, sales: str = None, breakdown=()):
+        """区间内逐日数据 [{'date', 'count', 'arr', ['by_zone'|'by_sales'|'by_stage']}]
+
+        zone / sales 二选一作为过滤维度；breakdown 为需要展开的维度，指定过滤时展开结果同样只统计过滤后的客户。
+        """
+        if zone is not None and sales is not None:
+            raise ValueError('zone 与 sales 不能同时指定')
+        window = self.slice(start, end)
+        counts, arr = self.counts[window], self.arr[window]
+        if zone is not None:
+            column = self.zones.index(zone) if zone in self.zones else None
+            counts = self.by_zone[window, column] if column is not None else counts * 0
+            arr = self.arr_by_zone[window, column] if column is not None else arr * 0
+            tables = self._filtered_tables(window, self._zone_codes, column, breakdown)
+        elif sales is not None:
+            column = self.sales.index(sales) if sales in self.sales else None
+            counts = self.by_sales[window, column] if column is not None else counts * 0
+            arr = self.arr_by_sales[window, column] if column is not None else arr * 0
+            tables = self._filtered_tables(window, self._sales_codes, column, breakdown)
+        else:
+            tables = {
+                'zone': (self.zones, self.by_zone[window]),
+                'sales': (self.sales, self.by_sales[window]),
+                'stage': (self.stages, self.by_stage[window]),
+            }
+        rows = []
+        for i, day in enumerate(self.days[window]):
+            if not counts[i]:
+                continue
+            row = {
+                'date': (_EPOCH + timedelta(days=int(day))).isoformat(),
+                'count': int(counts[i]),
+                'arr': round(float(arr[i]), 2)
+            }
+            for dim in breakdown:
+                labels, table = tables[dim]
+                row[f'by_{dim}'] = {label: int(n) for label, n in zip(labels, table[i]) if n}
+            rows.append(row)
+        return rows
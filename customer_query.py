@@ -0,0 +1,763 @@
+import re
+import logging
+from datetime import date
+from typing import Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# pandas延迟导入
+pd = None
+
+def ensure_pandas_imported():
+    """确保pandas已导入"""
+    global pd
+    if pd is None:
+        import pandas as pandas_module
+        pd = pandas_module
+        logger.info("pandas已延迟导入到customer_query")
+    return pd
+
+# 战区列兼容：支持'战区'、'所属战区'或'归属战区'
+ZONE_COLUMNS = ('战区', '所属战区', '归属战区')
+
+# 客户阶段状态筛选（固定顺序，前端状态芯片依赖该顺序）
+STAGE_STATUSES = [
+    ('all', '全部状态'),
+    ('na', 'NA状态'),
+    ('contract', '合同状态'),
+    ('invoice', '开票状态'),
+    ('advance_invoice', '提前开状态'),
+    ('paid', '回款状态'),
+    ('upsell', '增购状态'),
+    ('invalid', '无效状态'),
+    ('lost', '失联状态'),
+]
+
+# 各状态对应的阶段关键字（包含任一关键字即命中，状态之间可重叠，如“提前开票”）
+STAGE_KEYWORDS = {
+    'contract': ('合同',),
+    'invoice': ('开票',),
+    'advance_invoice': ('提前开',),
+    'paid': ('回款', '已付'),
+    'upsell': ('增购',),
+    'invalid': ('无效',),
+    'lost': ('失联',),
+}
+
+# 销售代表姓名标准化函数
+def normalize_sales_name(sales_name):
+    """
+    标准化销售代表姓名，解决大小写不一致问题
+    例如：Esther.zhu 和 Esther.Zhu 都标准化为 Esther.Zhu
+    """
+    if not sales_name or str(sales_name).lower() == 'nan':
+        return ''
+
+    # 检查是否为pandas的NaN值
+    try:
+        pd = ensure_pandas_imported()
+        if pd.isna(sales_name):
+            return ''
+    except:
+        # 如果pandas不可用，使用简单的检查
+        if sales_name is None or (hasattr(sales_name, '__len__') and len(str(sales_name).strip()) == 0):
+            return ''
+
+    name = str(sales_name).strip()
+    if not name:
+        return ''
+
+    # 特殊处理已知的销售代表姓名
+    name_lower = name.lower()
+    if name_lower == 'esther.zhu':
+        return 'Esther.Zhu'
+    elif name_lower == 'mia.mi':
+        return 'Mia.Mi'
+
+    # 对于其他姓名，保持原有格式但确保首字母大写
+    return name
+
+def _is_empty_sales(sales_raw) -> bool:
+    """续费责任销售是否为空（空串、'nan'、NaN）"""
+    if not sales_raw or sales_raw == '' or str(sales_raw).lower() == 'nan':
+        return True
+    try:
+        pd = ensure_pandas_imported()
+        if pd.isna(sales_raw):
+            return True
+    except:
+        pass
+    return False
+
+def get_normalized_sales_person(row):
+    """
+    从数据行中获取标准化的销售代表姓名
+    优先使用续费责任销售，如果为空则使用责任销售中英文
+    """
+    sales_raw = row.get('续费责任销售', '')
+    if _is_empty_sales(sales_raw):
+        sales_person = str(row.get('责任销售中英文', ''))
+    else:
+        sales_person = str(sales_raw)
+
+    return normalize_sales_name(sales_person)
+
+# 战区名称标准化函数（去掉“战区/大区/区”后缀，统一空格）
+def normalize_zone(zone_name):
+    if zone_name is None:
+        return ''
+    name = str(zone_name).strip()
+    if not name or name.lower() == 'nan':
+        return ''
+    # 去除全角空格
+    name = name.replace('\u3000', ' ').strip()
+    try:
+        # 去掉末尾后缀：战区/大区/区
+        name = re.sub(r'(战区|大区|区)$', '', name)
+    except Exception:
+        pass
+    return name.strip()
+
+def normalize_stage_text(stage) -> str:
+    """客户阶段文本：空值/NaN/'nan' 统一为空串"""
+    if stage is None:
+        return ''
+    try:
+        pd = ensure_pandas_imported()
+        if pd.isna(stage):
+            return ''
+    except Exception:
+        pass
+    text = str(stage).strip()
+    if not text or text.lower() == 'nan':
+        return ''
+    return text
+
+def find_zone_column(df) -> Optional[str]:
+    for candidate in ZONE_COLUMNS:
+        if candidate in df.columns:
+            return candidate
+    return None
+
+def _map_unique(series, func):
+    """按唯一值计算再回填，避免对每行重复调用标准化函数"""
+    pd = ensure_pandas_imported()
+    codes, uniques = pd.factorize(series)
+    # codes == -1 表示缺失值，对应 lookup 最后一个元素（按 NaN 处理）
+    lookup = [func(v) for v in uniques] + [func(float('nan'))]
+    return pd.Series([lookup[c] for c in codes], index=series.index, dtype=object)
+
+def raw_sales_person_series(df):
+    """整列计算未标准化的销售代表（续费责任销售为空时回退到责任销售中英文）"""
+    pd = ensure_pandas_imported()
+    if '续费责任销售' in df.columns:
+        primary = df['续费责任销售']
+        primary_empty = _map_unique(primary, _is_empty_sales).astype(bool)
+        primary_text = _map_unique(primary, str)
+    else:
+        primary_empty = pd.Series(True, index=df.index)
+        primary_text = pd.Series('', index=df.index, dtype=object)
+    if '责任销售中英文' in df.columns:
+        fallback_text = _map_unique(df['责任销售中英文'], str)
+    else:
+        fallback_text = pd.Series('', index=df.index, dtype=object)
+    return primary_text.where(~primary_empty, fallback_text)
+
+def sales_person_series(df):
+    """整列计算标准化销售代表（续费责任销售为空时回退到责任销售中英文）"""
+    return _map_unique(raw_sales_person_series(df), normalize_sales_name)
+
+def zone_series(df, zone_col: Optional[str]):
+    """整列计算标准化战区，缺失列时为空串"""
+    pd = ensure_pandas_imported()
+    if not zone_col or zone_col not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return _map_unique(df[zone_col], normalize_zone)
+
+def stage_series(df):
+    """整列计算客户阶段文本（空值为空串）"""
+    pd = ensure_pandas_imported()
+    if '客户阶段' not in df.columns:
+        return pd.Series('', index=df.index, dtype=object)
+    return _map_unique(df['客户阶段'], normalize_stage_text)
+
+def expiry_day_series(df):
+    """到期日期（按天归一化的 datetime64），无法解析或缺列时为 NaT"""
+    pd = ensure_pandas_imported()
+    if '到期日期' not in df.columns:
+        return pd.Series(pd.NaT, index=df.index, dtype='datetime64[ns]')
+    values = df['到期日期']
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values, errors='coerce')
+    return values.dt.normalize()
+
+def parse_amount(value) -> float:
+    """解析金额单元格（去掉千分位逗号与“元”），空值或无法解析时为 NaN"""
+    if not _has_value(value):
+        return float('nan')
+    try:
+        return float(str(value).replace(',', '').replace('元', ''))
+    except (TypeError, ValueError):
+        return float('nan')
+
+def amount_series(df, column: str):
+    pd = ensure_pandas_imported()
+    if column not in df.columns:
+        return pd.Series(float('nan'), index=df.index, dtype='float64')
+    values = df[column]
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.astype('float64')
+    return _map_unique(values, parse_amount).astype('float64')
+
+# 合同金额候选列（按优先级取第一个非空值）
+CONTRACT_AMOUNT_COLUMNS = ['合同金额', '合同价', '合同总金额', '合同金额（元）']
+
+def contract_amount_series(df):
+    """合同金额：取第一个非空候选列的值；该值无法解析时为 NaN（不再回退到后续列）"""
+    pd = ensure_pandas_imported()
+    result = pd.Series(float('nan'), index=df.index, dtype='float64')
+    resolved = pd.Series(False, index=df.index)
+    for col in CONTRACT_AMOUNT_COLUMNS:
+        if col not in df.columns:
+            continue
+        present = _map_unique(df[col], _has_value).astype(bool) & ~resolved
+        if present.any():
+            result[present] = amount_series(df, col)[present]
+            resolved |= present
+    return result
+
+def _categorical(series):
+    return series.astype('category')
+
+def build_derived_columns(df):
+    """快照加载时一次性物化的派生列（与 df 同索引）
+
+    - _expiry_day: datetime64，按天归一化的到期日期
+    - _sales_raw / _sales: 销售代表（原始回退值 / 标准化值），categorical
+    - _zone: 标准化战区，categorical；_stage: 阶段文本（空为''），categorical
+    - _arr / _contract_amount: float64 金额，缺失为 NaN
+    - _status_<key>: 各阶段状态筛选的布尔标记（见 STAGE_KEYWORDS）
+    """
+    pd = ensure_pandas_imported()
+    sales_raw = raw_sales_person_series(df)
+    stages = stage_series(df)
+    derived = pd.DataFrame({
+        '_expiry_day': expiry_day_series(df),
+        '_sales_raw': _categorical(sales_raw),
+        '_sales': _categorical(_map_unique(sales_raw, normalize_sales_name)),
+        '_zone': _categorical(zone_series(df, find_zone_column(df))),
+        '_stage': _categorical(stages),
+        '_arr': amount_series(df, '应续ARR'),
+        '_contract_amount': contract_amount_series(df),
+    }, index=df.index)
+    for value, _ in STAGE_STATUSES:
+        if value != 'all':
+            derived[f'_status_{value}'] = stage_status_mask(stages, value).astype(bool)
+    return derived
+
+def stage_status_mask(stages, status: str):
+    """按状态筛选值生成布尔掩码；stages 为已归一化的阶段文本列"""
+    pd = ensure_pandas_imported()
+    if not status or status == 'all':
+        return pd.Series(True, index=stages.index)
+    stages = stages.astype(object)
+    if status == 'na':
+        return (stages == '') | (stages.str.upper() == 'NA')
+    keywords = STAGE_KEYWORDS.get(status)
+    if not keywords:
+        return pd.Series(False, index=stages.index)
+    mask = pd.Series(False, index=stages.index)
+    for keyword in keywords:
+        mask |= stages.str.contains(keyword, regex=False)
+    return mask
+
+def status_mask(frame, status: str):
+    """基于派生列 _status_<key> 的状态掩码；未知状态不匹配任何行"""
+    pd = ensure_pandas_imported()
+    if not status or status == 'all':
+        return pd.Series(True, index=frame.index)
+    column = f'_status_{status}'
+    if column not in frame.columns:
+        return pd.Series(False, index=frame.index)
+    return frame[column]
+
+def filter_expiry_window(df, today: date, min_days: int, max_days: int,
+                         zones: Optional[Iterable[str]] = None, sales_person: Optional[str] = None,
+                         status: Optional[str] = None, derived=None, expiry_index=None,
+                         bitmap_index=None) -> Tuple[object, int]:
+    """到期窗口筛选引擎：对整表做布尔掩码运算，仅返回命中窗口与筛选条件的切片
+
+    - 日期窗口：[today+min_days, today+max_days]（按天，闭区间）
+    - zones：标准化后的战区集合；sales_person：标准化销售代表；status：阶段状态筛选值
+    - derived：快照物化的派生列（build_derived_columns），缺省时现场计算
+    - expiry_index：快照的到期日排序索引（customer_index.ExpiryIndex），有则二分定位窗口，
+      只对窗口内的行计算其余筛选条件
+    - bitmap_index：快照的位图索引（customer_index.BitmapIndex），有则战区/销售/状态条件为位运算
+    返回 (切片DataFrame, 窗口内总数)，切片为原始列 + 派生列，按到期日升序（同日保持原始行序）
+    """
+    pd = ensure_pandas_imported()
+    if derived is None:
+        derived = build_derived_columns(df)
+    start = pd.Timestamp(today) + pd.Timedelta(days=min_days)
+    end = pd.Timestamp(today) + pd.Timedelta(days=max_days)
+    if expiry_index is not None:
+        positions = expiry_index.range(start, end)
+        total_in_window = int(len(positions))
+        window = derived.iloc[positions]
+        mask = pd.Series(True, index=window.index)
+    else:
+        window = derived
+        expiry = derived['_expiry_day']
+        mask = (expiry >= start) & (expiry <= end)
+        total_in_window = int(mask.sum())
+    sales_values = [sales_person] if sales_person is not None and sales_person != 'all' else None
+    zone_values = list(zones) if zones else None
+    status_values = [status] if status and status != 'all' else None
+    if bitmap_index is not None:
+        if sales_values or zone_values or status_values:
+            keep = bitmap_index.mask(bitmap_index.combine(zones=zone_values, sales=sales_values,
+                                                          stages=status_values))
+            if expiry_index is not None:
+                mask &= keep[positions]
+            else:
+                mask &= keep
+    else:
+        if sales_values:
+            mask &= window['_sales'] == sales_person
+        if zone_values:
+            mask &= window['_zone'].isin(zone_values)
+        if status_values:
+            mask &= status_mask(window, status)
+    selected = window[mask]
+    sub = df.loc[selected.index].join(selected)
+    if expiry_index is None:
+        sub = sub.sort_values('_expiry_day', kind='mergesort')
+    return sub, total_in_window
+
+def status_counts(frame) -> List[dict]:
+    """按固定顺序统计各状态数量（稳定返回所有已知状态，即使为0）；frame 需含 _status_<key> 派生列"""
+    counts = []
+    for value, label in STAGE_STATUSES:
+        counts.append({'value': value, 'label': label, 'count': int(status_mask(frame, value).sum())})
+    return counts
+
+def _has_value(value) -> bool:
+    pd = ensure_pandas_imported()
+    try:
+        if pd.isna(value):
+            return False
+    except (TypeError, ValueError):
+        pass
+    return bool(str(value).strip()) and str(value).lower() != 'nan'
+
+def format_amount(value, zero_as_missing: bool = False) -> str:
+    """金额展示值，如 '12000.0元'；NaN（以及 zero_as_missing 时的 0）为 '0元'"""
+    if value is None or value != value or (zero_as_missing and value == 0):
+        return '0元'
+    return f"{float(value)}元"
+
+def format_arr_display(record) -> str:
+    """应续ARR展示值（读取派生列 _arr）"""
+    return format_amount(record.get('_arr'))
+
+def format_contract_display(record) -> str:
+    """合同金额展示值（读取派生列 _contract_amount）"""
+    return format_amount(record.get('_contract_amount'))
+
+def expiry_label(days_until_expiry: int) -> str:
+    if days_until_expiry == 0:
+        return "今天到期"
+    elif days_until_expiry == 1:
+        return "明天到期"
+    return f"{days_until_expiry}天后到期"
+
+# ---------------------------------------------------------------------------
+# 统一查询（/customers/query）：声明式筛选 + 排序 + 分页 + 字段投影
+# ---------------------------------------------------------------------------
+
+# 对外字段名 -> 快照列（原始列或派生列）
+QUERY_FIELDS = {
+    'id': '用户ID',
+    'company_name': '公司名称',
+    'account_enterprise_name': '账号-企业名称',
+    'tax_number': '税号',
+    'version': '版本',
+    'jdy_sales': '简道云销售',
+    'zone': '_zone',
+    'sales': '_sales',
+    'stage': '_stage',
+    'expiry_date': '_expiry_day',
+    'days_until_expiry': '_expiry_day',
+    'arr': '_arr',
+    'contract_amount': '_contract_amount',
+}
+DEFAULT_QUERY_FIELDS = ['id', 'company_name', 'zone', 'sales', 'stage', 'expiry_date', 'days_until_expiry', 'arr']
+AMOUNT_FIELDS = {'arr': '_arr', 'contract_amount': '_contract_amount'}
+QUERY_DEFAULT_LIMIT = 50
+QUERY_MAX_LIMIT = 500
+
+
+class QuerySpec:
+    """已校验的查询条件"""
+
+    def __init__(self):
+        self.min_days = None
+        self.max_days = None
+        self.zones = None
+        self.sales = None
+        self.stages = None
+        self.amount_field = 'arr'
+        self.amount_min = None
+        self.amount_max = None
+        self.text = ''
+        self.sort = []  # [(字段, 是否升序)]
+        self.fields = list(DEFAULT_QUERY_FIELDS)
+        self.limit = QUERY_DEFAULT_LIMIT
+        self.offset = 0
+        self.cursor = None
+
+    def fingerprint(self) -> str:
+        """筛选+排序条件的指纹（不含分页），游标据此校验是否属于同一查询"""
+        import hashlib
+        import json
+        key = json.dumps([self.min_days, self.max_days, self.zones, self.sales, self.stages,
+                          self.amount_field, self.amount_min, self.amount_max, self.text, self.sort],
+                         ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def _str_list(value, name: str) -> Optional[List[str]]:
+    if value is None or value == '' or value == []:
+        return None
+    if isinstance(value, str):
+        value = [v for v in value.split(',')]
+    if not isinstance(value, (list, tuple)):
+        raise ValueError(f'{name} 应为字符串列表')
+    items = [str(v).strip() for v in value if v is not None and str(v).strip()]
+    return items or None
+
+
+def _optional_number(value, name: str, cast=float):
+    if value is None or value == '':
+        return None
+    try:
+        return cast(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} 应为数字')
+
+
+def parse_query_spec(payload: dict) -> QuerySpec:
+    """解析 /customers/query 请求体，参数不合法时抛出 ValueError（消息可直接返回前端）
+
+    {
+      "filter": {
+        "expiry": {"min_days": -30, "max_days": 90},   # 到期日窗口（相对今天，闭区间）
+        "zones": ["华东"], "sales": ["张三"],            # 标准化战区/销售代表，任一命中
+        "stages": ["contract", "paid"],                 # 阶段状态（STAGE_STATUSES 的取值），任一命中
+        "amount": {"field": "arr", "min": 0, "max": 50000},
+        "text": "科技"                                   # 用户ID/公司名称 包含匹配
+      },
+      "sort": ["expiry_date", "-arr"],                   # '-' 前缀表示降序
+      "fields": ["id", "company_name", "expiry_date"],
+      "limit": 50, "offset": 0, "cursor": "..."
+    }
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('请求体应为JSON对象')
+    spec = QuerySpec()
+    flt = payload.get('filter') or {}
+    if not isinstance(flt, dict):
+        raise ValueError('filter 应为JSON对象')
+
+    expiry = flt.get('expiry')
+    if expiry is not None:
+        if not isinstance(expiry, dict):
+            raise ValueError('filter.expiry 应为JSON对象')
+        spec.min_days = _optional_number(expiry.get('min_days'), 'filter.expiry.min_days', int)
+        spec.max_days = _optional_number(expiry.get('max_days'), 'filter.expiry.max_days', int)
+        if spec.min_days is None and spec.max_days is None:
+            raise ValueError('filter.expiry 需要 min_days 或 max_days')
+        if spec.min_days is not None and spec.max_days is not None and spec.min_days > spec.max_days:
+            raise ValueError('filter.expiry.min_days 不能大于 max_days')
+
+    zones = _str_list(flt.get('zones'), 'filter.zones')
+    spec.zones = sorted({normalize_zone(z) for z in zones}) if zones else None
+    sales = _str_list(flt.get('sales'), 'filter.sales')
+    spec.sales = sorted(set(sales)) if sales else None
+
+    stages = _str_list(flt.get('stages'), 'filter.stages')
+    if stages:
+        known = {value for value, _ in STAGE_STATUSES}
+        unknown = [s for s in stages if s not in known]
+        if unknown:
+            raise ValueError(f'未知的阶段状态: {unknown}')
+        spec.stages = None if 'all' in stages else sorted(set(stages))
+
+    amount = flt.get('amount')
+    if amount is not None:
+        if not isinstance(amount, dict):
+            raise ValueError('filter.amount 应为JSON对象')
+        spec.amount_field = amount.get('field') or 'arr'
+        if spec.amount_field not in AMOUNT_FIELDS:
+            raise ValueError(f'filter.amount.field 仅支持: {list(AMOUNT_FIELDS)}')
+        spec.amount_min = _optional_number(amount.get('min'), 'filter.amount.min')
+        spec.amount_max = _optional_number(amount.get('max'), 'filter.amount.max')
+
+    spec.text = str(flt.get('text') or '').strip()
+
+    sort = payload.get('sort') or []
+    if isinstance(sort, str):
+        sort = sort.split(',')
+    if not isinstance(sort, (list, tuple)):
+        raise ValueError('sort 应为字段列表')
+    for key in sort:
+        key = str(key).strip()
+        if not key:
+            continue
+        ascending = not key.startswith('-')
+        field = key.lstrip('+-')
+        if field not in QUERY_FIELDS:
+            raise ValueError(f'不支持的排序字段: {field}')
+        spec.sort.append((field, ascending))
+
+    fields = _str_list(payload.get('fields'), 'fields')
+    if fields:
+        unknown = [f for f in fields if f not in QUERY_FIELDS]
+        if unknown:
+            raise ValueError(f'不支持的字段: {unknown}')
+        spec.fields = fields
+
+    spec.limit = _optional_number(payload.get('limit'), 'limit', int) or QUERY_DEFAULT_LIMIT
+    spec.limit = min(max(spec.limit, 1), QUERY_MAX_LIMIT)
+    spec.offset = max(_optional_number(payload.get('offset'), 'offset', int) or 0, 0)
+    spec.cursor = payload.get('cursor') or None
+    return spec
+
+
+def encode_cursor(version: int, fingerprint: str, offset: int) -> str:
+    import base64
+    import json
+    raw = json.dumps({'v': version, 'q': fingerprint, 'o': offset}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str, version: int, fingerprint: str) -> int:
+    """解析游标得到 offset；游标不属于本查询时抛出 ValueError，数据已更新时抛出 LookupError"""
+    import base64
+    import json
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        offset = int(data['o'])
+    except Exception:
+        raise ValueError('cursor 无效')
+    if data.get('q') != fingerprint:
+        raise ValueError('cursor 与当前查询条件不匹配')
+    if data.get('v') != version:
+        raise LookupError('数据已更新，请从第一页重新查询')
+    return max(offset, 0)
+
+
+def select_query_rows(df, derived, spec: QuerySpec, today: date, expiry_index=None, text_positions=None,
+                      bitmap_index=None):
+    """按查询条件筛选并排序，返回命中行的派生列 DataFrame（不分页，索引与 df 一致）
+
+    候选行先由到期日索引（有日期窗口时）与文本索引（text_positions）收窄，
+    战区/销售/阶段条件有位图索引时为位运算，否则为候选行上的向量化掩码；
+    排序使用稳定排序，缺失值排在最后。
+    """
+    import numpy as np
+    pd = ensure_pandas_imported()
+
+    positions = None
+    if spec.min_days is not None or spec.max_days is not None:
+        lo = spec.min_days if spec.min_days is not None else -36500
+        hi = spec.max_days if spec.max_days is not None else 36500
+        start = pd.Timestamp(today) + pd.Timedelta(days=lo)
+        end = pd.Timestamp(today) + pd.Timedelta(days=hi)
+        if expiry_index is not None:
+            positions = np.sort(expiry_index.range(start, end))
+        else:
+            expiry = derived['_expiry_day']
+            positions = np.flatnonzero(((expiry >= start) & (expiry <= end)).to_numpy())
+    if text_positions is not None:
+        text_positions = np.asarray(sorted(set(text_positions)), dtype=np.int64)
+        positions = text_positions if positions is None else np.intersect1d(positions, text_positions)
+
+    frame = derived if positions is None else derived.iloc[positions]
+    mask = np.ones(len(frame), dtype=bool)
+    if bitmap_index is not None:
+        if spec.zones or spec.sales or spec.stages:
+            keep = bitmap_index.mask(bitmap_index.combine(zones=spec.zones, sales=spec.sales,
+                                                          stages=spec.stages))
+            mask &= keep if positions is None else keep[positions]
+    else:
+        if spec.zones:
+            mask &= frame['_zone'].isin(spec.zones).to_numpy()
+        if spec.sales:
+            mask &= frame['_sales'].isin(spec.sales).to_numpy()
+        if spec.stages:
+            stage_mask = np.zeros(len(frame), dtype=bool)
+            for status in spec.stages:
+                stage_mask |= status_mask(frame, status).to_numpy(dtype=bool)
+            mask &= stage_mask
+    if spec.amount_min is not None or spec.amount_max is not None:
+        amounts = frame[AMOUNT_FIELDS[spec.amount_field]].to_numpy(dtype='float64')
+        amount_mask = ~np.isnan(amounts)
+        if spec.amount_min is not None:
+            amount_mask &= amounts >= spec.amount_min
+        if spec.amount_max is not None:
+            amount_mask &= amounts <= spec.amount_max
+        mask &= amount_mask
+    frame = frame[mask]
+    total = int(len(frame))
+
+    # 默认：有到期窗口时按到期日升序，否则保持原始行序
+    has_window = spec.min_days is not None or spec.max_days is not None
+    sort = spec.sort or ([('expiry_date', True)] if has_window else [])
+    if sort and total:
+        keys = pd.DataFrame(index=frame.index)
+        by, ascending = [], []
+        for i, (field, asc) in enumerate(sort):
+            column = QUERY_FIELDS[field]
+            values = frame[column] if column in frame.columns else df.loc[frame.index, column]
+            if isinstance(values.dtype, pd.CategoricalDtype) or values.dtype == object:
+                values = values.astype(object).where(values.notna(), None)
+                values = values.map(lambda v: '' if v is None else str(v))
+                # 空串视为缺失，排在最后
+                values = values.where(values != '', None)
+            keys[f'k{i}'] = values
+            by.append(f'k{i}')
+            ascending.append(asc)
+        order = keys.sort_values(by=by, ascending=ascending, kind='mergesort', na_position='last').index
+        frame = frame.loc[order]
+    return frame
+
+
+def run_query(df, derived, spec: QuerySpec, today: date, expiry_index=None, text_positions=None,
+              bitmap_index=None):
+    """在快照上执行查询，返回 (当前页 DataFrame（原始列+派生列）, 命中总数)"""
+    if derived is None:
+        derived = build_derived_columns(df)
+    frame = select_query_rows(df, derived, spec, today, expiry_index=expiry_index,
+                              text_positions=text_positions, bitmap_index=bitmap_index)
+    page = frame.iloc[spec.offset:spec.offset + spec.limit]
+    return df.loc[page.index].join(page), len(frame)
+
+
+def _json_value(value):
+    pd = ensure_pandas_imported()
+    if value is None:
+        return None
+    try:
+        if pd.isna(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float):
+        return value
+    text = str(value).strip()
+    return text if text.lower() != 'nan' else None
+
+
+def project_records(page, fields: List[str], today: date) -> List[dict]:
+    """按字段列表投影当前页，值已转为可 JSON 序列化的类型"""
+    pd = ensure_pandas_imported()
+    today_ts = pd.Timestamp(today)
+    items = []
+    for record in page.to_dict('records'):
+        item = {}
+        for field in fields:
+            column = QUERY_FIELDS[field]
+            value = record.get(column)
+            if field in ('expiry_date', 'days_until_expiry'):
+                if value is None or pd.isna(value):
+                    item[field] = None
+                elif field == 'expiry_date':
+                    item[field] = value.strftime('%Y-%m-%d')
+                else:
+                    item[field] = int((value - today_ts).days)
+            else:
+                item[field] = _json_value(value)
+        items.append(item)
+    return items
+
+# ---------------------------------------------------------------------------
+# 分面计数：阶段状态 × 战区 × 销售代表，一次向量化计算
+# ---------------------------------------------------------------------------
+
+class FacetCube:
+    """日期窗口内的计数立方体 counts[战区, 销售代表, 状态]
+
+    状态轴按 STAGE_STATUSES 顺序，第 0 位为 'all'（窗口内总数）；状态之间可重叠，
+    因此各状态计数之和不一定等于 'all'。
+    """
+
+    def __init__(self, zones: List[str], sales: List[str], counts):
+        self.zones = zones
+        self.sales = sales
+        self.statuses = [value for value, _ in STAGE_STATUSES]
+        self.counts = counts
+
+    def _select(self, zones=None, sales=None):
+        import numpy as np
+        cube = self.counts
+        if zones is not None:
+            wanted = set(zones)
+            cube = cube[np.array([z in wanted for z in self.zones], dtype=bool)]
+        if sales is not None:
+            wanted = set(sales)
+            cube = cube[:, np.array([s in wanted for s in self.sales], dtype=bool)]
+        return cube
+
+    def total(self, zones=None, sales=None) -> int:
+        return int(self._select(zones, sales)[:, :, 0].sum())
+
+    def status_counts(self, zones=None, sales=None) -> List[dict]:
+        """状态芯片计数（固定顺序，含计数为 0 的状态），格式同 status_counts()"""
+        totals = self._select(zones, sales).sum(axis=(0, 1))
+        return [{'value': value, 'label': label, 'count': int(totals[i])}
+                for i, (value, label) in enumerate(STAGE_STATUSES)]
+
+    def pivot(self, dim: str, zones=None, sales=None) -> dict:
+        """按 'zone' 或 'sales' 展开：{取值: {状态: 计数}}，省略窗口内无客户的取值"""
+        cube = self._select(zones, sales)
+        if dim == 'zone':
+            labels = [z for z in self.zones if zones is None or z in set(zones)]
+            table = cube.sum(axis=1)
+        elif dim == 'sales':
+            labels = [s for s in self.sales if sales is None or s in set(sales)]
+            table = cube.sum(axis=0)
+        else:
+            raise ValueError(f'不支持的分面维度: {dim}')
+        result = {}
+        for label, row in zip(labels, table):
+            if row[0]:
+                result[label] = {status: int(row[i]) for i, status in enumerate(self.statuses)}
+        return result
+
+
+def build_facet_cube(derived, positions=None) -> FacetCube:
+    """对 derived（或其 positions 行）一次 bincount 得到 战区 × 销售 × 状态 计数"""
+    import numpy as np
+    frame = derived if positions is None else derived.iloc[positions]
+    zone_values = frame['_zone'].astype('category') if not hasattr(frame['_zone'], 'cat') else frame['_zone']
+    sales_values = frame['_sales'].astype('category') if not hasattr(frame['_sales'], 'cat') else frame['_sales']
+    zones = [str(z) for z in zone_values.cat.categories]
+    sales = [str(s) for s in sales_values.cat.categories]
+    zone_codes = zone_values.cat.codes.to_numpy().astype(np.int64)
+    sales_codes = sales_values.cat.codes.to_numpy().astype(np.int64)
+    n_zone, n_sales, n_status = len(zones), len(sales), len(STAGE_STATUSES)
+
+    # 每行一个 'all' 位 + 各状态标记位，展开成 (行, 状态) 对后一次 bincount
+    flags = np.ones((len(frame), n_status), dtype=bool)
+    for i, (value, _) in enumerate(STAGE_STATUSES[1:], start=1):
+        column = f'_status_{value}'
+        flags[:, i] = frame[column].to_numpy(dtype=bool) if column in frame.columns else False
+    valid = (zone_codes >= 0) & (sales_codes >= 0)
+    cell = (zone_codes * n_sales + sales_codes)[valid]
+    rows, status_idx = np.nonzero(flags[valid])
+    counts = np.bincount(cell[rows] * n_status + status_idx, minlength=n_zone * n_sales * n_status)
+    return FacetCube(zones, sales, counts.reshape(n_zone, n_sales, n_status))
@@ -0,0 +1,699 @@
+import os
+import time
+import hashlib
+import logging
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Optional, Union
+
+from snapshot_sidecar import file_sha256, load_sidecar, write_sidecar
+from customer_query import (build_derived_columns, build_facet_cube, filter_expiry_window, run_query,
+                            select_query_rows)
+from customer_index import (BitmapIndex, ExpiryHistogram, ExpiryIndex, IdIndex, NameIndex, SuggestIndex,
+                            MATCH_SUBSTRING, normalize_id)
+from stage_journal import StageJournal, apply_stage_overlay
+from xlsx_patch import XlsxPatchError, patch_column
+from write_coordinator import WriteCoordinator
+
+# pandas延迟导入
+pd = None
+
+logger = logging.getLogger(__name__)
+
+def ensure_pandas_imported():
+    """确保pandas已导入"""
+    global pd
+    if pd is None:
+        import pandas as pandas_module
+        pd = pandas_module
+        logger.info("pandas已延迟导入到customer_snapshot")
+    return pd
+
+# 统一的列名别名表：标准列名 -> 可能出现的别名（按优先级）
+COLUMN_ALIASES = {
+    '用户ID': ['简道云ID', '简道云账号', '账号ID', '用户唯一ID', '客户唯一ID', '用户id', 'ID'],
+    '到期日期': ['到期时间', '试用到期时间'],
+    '公司名称': ['账号-企业名称'],
+    '跟进日期': ['跟进时间'],
+    '跟进记录': ['跟进日记'],
+}
+
+def normalize_columns(df) -> Dict[str, str]:
+    """就地统一列名别名，返回 {标准列名: 原始列名} 的映射，便于写回时还原"""
+    renamed = {}
+    for canonical, aliases in COLUMN_ALIASES.items():
+        if canonical in df.columns:
+            continue
+        for alias in aliases:
+            if alias in df.columns:
+                renamed[canonical] = alias
+                break
+    if renamed:
+        df.rename(columns={alias: canonical for canonical, alias in renamed.items()}, inplace=True)
+    return renamed
+
+
+def overlay_content_hash(file_hash: Optional[str], journal_digest: Optional[str]) -> Optional[str]:
+    """工作簿哈希 + 阶段变更日志摘要 -> 快照内容哈希（无未压实变更时即工作簿哈希）"""
+    if not file_hash or not journal_digest:
+        return file_hash
+    return hashlib.sha256(f"{file_hash}:{journal_digest}".encode('utf-8')).hexdigest()
+
+
+# 每个快照最多缓存的分面窗口数
+FACET_CACHE_SIZE = 32
+
+# 参与名称检索的列
+NAME_COLUMNS = ('公司名称', '账号-企业名称')
+# 参与输入联想的列
+SUGGEST_COLUMNS = ('用户ID', '公司名称', '账号-企业名称', '税号')
+
+
+class CustomerSnapshot:
+    """客户数据快照：一次解析、多处共享的只读数据视图"""
+
+    def __init__(self, df, version: int, path: str, mtime: Optional[float],
+                 renamed_columns: Dict[str, str] = None, content_hash: str = None,
+                 source: str = 'xlsx'):
+        self.df = df
+        # 一次性物化的派生列（标准化销售/战区/阶段、金额、到期日），与 df 同索引
+        self.derived = None
+        # 到期日排序索引（按天号二分查找窗口）
+        self.expiry_index = None
+        # 逐日到期直方图（按战区/销售/阶段细分 + 每日ARR），供日历与续费预测
+        self.expiry_histogram = None
+        # 战区/销售/阶段状态位图索引
+        self.bitmap_index = None
+        # 用户ID哈希索引（精确匹配 + 部分ID的 n-gram 倒排）
+        self.id_index = None
+        # 公司名称 bigram 倒排索引、输入联想前缀表，首次使用时构建
+        self._name_index = None
+        self._suggest_index = None
+        self._index_lock = threading.Lock()
+        # 分面计数缓存：(日期, min_days, max_days) -> FacetCube；快照版本变化时随快照整体失效
+        self._facet_cache = OrderedDict()
+        self.version = version
+        self.path = path
+        self.mtime = mtime
+        self.renamed_columns = renamed_columns or {}
+        # content_hash 标识快照内容：工作簿哈希，有未压实的阶段变更时再叠加变更日志摘要
+        self.content_hash = content_hash
+        self.file_hash = content_hash
+        # 已合并的阶段变更日志条目数
+        self.journal_entries = 0
+        # 加载/发布时的跨进程写入代数标记，与代数文件不一致说明其它 worker 写过
+        self.write_token = None
+        self.source = source  # xlsx / sidecar / save / journal
+        self.loaded_at = time.time()
+
+    def to_source_frame(self, df=None):
+        """将标准列名还原为Excel原始列名（写回或导出时使用）"""
+        frame = self.df if df is None else df
+        if not self.renamed_columns:
+            return frame
+        return frame.rename(columns={canonical: alias for canonical, alias in self.renamed_columns.items()})
+
+    def materialize(self):
+        """构建派生列与索引；失败时保持为None，查询时现场计算"""
+        try:
+            self.derived = build_derived_columns(self.df)
+            self.expiry_index = ExpiryIndex(self.derived['_expiry_day'])
+            self.bitmap_index = BitmapIndex(self.derived)
+            self.expiry_histogram = ExpiryHistogram(self.derived, self.expiry_index)
+        except Exception as e:
+            logger.warning(f"派生列/索引物化失败，查询时将现场计算: {str(e)}")
+        try:
+            if '用户ID' in self.df.columns:
+                self.id_index = IdIndex(self.df['用户ID'].tolist())
+        except Exception as e:
+            logger.warning(f"用户ID索引构建失败: {str(e)}")
+        return self
+
+    def find_rows(self, jdy_id, allow_partial: bool = False):
+        """按用户ID查找行位置（iloc）；写操作只做精确匹配，查询可放宽为部分匹配"""
+        if '用户ID' not in self.df.columns:
+            return []
+        if self.id_index is None:
+            self.id_index = IdIndex(self.df['用户ID'].tolist())
+        return self.id_index.lookup(jdy_id, allow_partial=allow_partial)
+
+    @property
+    def name_index(self) -> NameIndex:
+        if self._name_index is None:
+            with self._index_lock:
+                if self._name_index is None:
+                    columns = [self.df[col].tolist() for col in NAME_COLUMNS if col in self.df.columns]
+                    self._name_index = NameIndex(columns)
+        return self._name_index
+
+    @property
+    def suggest_index(self) -> SuggestIndex:
+        if self._suggest_index is None:
+            with self._index_lock:
+                if self._suggest_index is None:
+                    fields = [(col, self.df[col].tolist()) for col in SUGGEST_COLUMNS if col in self.df.columns]
+                    self._suggest_index = SuggestIndex(fields)
+        return self._suggest_index
+
+    def suggest(self, query, limit: int = 10):
+        """输入联想：先取 用户ID/名称/税号 的前缀补全，不足时用名称包含匹配补足，返回 [(行位置, 字段)]"""
+        results = self.suggest_index.complete(query, limit)
+        if len(results) < limit and any(col in self.df.columns for col in NAME_COLUMNS):
+            seen = {pos for pos, _ in results}
+            for pos, tier, _ in self.search_names(query, top_k=limit * 2):
+                if tier <= MATCH_SUBSTRING and pos not in seen:
+                    seen.add(pos)
+                    results.append((pos, '公司名称'))
+                    if len(results) >= limit:
+                        break
+        return results
+
+    def histogram(self) -> ExpiryHistogram:
+        """逐日到期直方图；物化失败时现场构建"""
+        if self.expiry_histogram is None:
+            derived = self.derived if self.derived is not None else build_derived_columns(self.df)
+            expiry_index = self.expiry_index or ExpiryIndex(derived['_expiry_day'])
+            self.expiry_histogram = ExpiryHistogram(derived, expiry_index)
+        return self.expiry_histogram
+
+    def facets(self, today, min_days: int, max_days: int):
+        """到期窗口内的 战区 × 销售 × 状态 计数（customer_query.FacetCube），按 (日期, 窗口) 缓存"""
+        key = (today, min_days, max_days)
+        with self._index_lock:
+            cube = self._facet_cache.get(key)
+            if cube is not None:
+                self._facet_cache.move_to_end(key)
+                return cube
+        pd = ensure_pandas_imported()
+        derived = self.derived if self.derived is not None else build_derived_columns(self.df)
+        start = pd.Timestamp(today) + pd.Timedelta(days=min_days)
+        end = pd.Timestamp(today) + pd.Timedelta(days=max_days)
+        if self.expiry_index is not None:
+            positions = self.expiry_index.range(start, end)
+        else:
+            expiry = derived['_expiry_day']
+            positions = ((expiry >= start) & (expiry <= end)).to_numpy().nonzero()[0]
+        cube = build_facet_cube(derived, positions)
+        with self._index_lock:
+            self._facet_cache[key] = cube
+            while len(self._facet_cache) > FACET_CACHE_SIZE:
+                self._facet_cache.popitem(last=False)
+        return cube
+
+    def text_positions(self, text):
+        """用户ID或公司名称/账号-企业名称包含 text 的行位置（走ID与名称索引）"""
+        positions = set(self.find_rows(text, allow_partial=True))
+        if any(col in self.df.columns for col in NAME_COLUMNS):
+            positions.update(self.name_index.containing(text))
+        return positions
+
+    def query(self, spec, today):
+        """统一查询（见 customer_query.run_query），返回 (当前页, 命中总数)"""
+        text_positions = self.text_positions(spec.text) if spec.text else None
+        return run_query(self.df, self.derived, spec, today,
+                         expiry_index=self.expiry_index, text_positions=text_positions,
+                         bitmap_index=self.bitmap_index)
+
+    def select_positions(self, spec, today):
+        """按统一查询条件筛选并排序（不分页），返回命中行在 df 中的位置数组，供导出逐行读取"""
+        derived = self.derived if self.derived is not None else build_derived_columns(self.df)
+        text_positions = self.text_positions(spec.text) if spec.text else None
+        frame = select_query_rows(self.df, derived, spec, today,
+                                  expiry_index=self.expiry_index, text_positions=text_positions,
+                                  bitmap_index=self.bitmap_index)
+        return self.df.index.get_indexer(frame.index)
+
+    def search_names(self, query, top_k: int = None):
+        """按公司名称/账号-企业名称检索，返回 [(行位置, 匹配等级, 得分)]，已按排名排序"""
+        return self.name_index.search(query, top_k=top_k)
+
+    def window(self, today, min_days: int, max_days: int, **filters):
+        """到期窗口查询（见 customer_query.filter_expiry_window），使用本快照的派生列与索引"""
+        return filter_expiry_window(self.df, today, min_days, max_days,
+                                    derived=self.derived, expiry_index=self.expiry_index,
+                                    bitmap_index=self.bitmap_index, **filters)
+
+
+class _InflightLoad:
+    """一次进行中的加载；并发请求共享同一结果（singleflight）"""
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.event = threading.Event()
+        self.snapshot = None
+        self.waiters = 0
+
+
+class CustomerSnapshotService:
+    """客户数据快照服务：所有读写路径共用的单一数据入口
+
+    - 读：get()/get_df() 返回共享快照，调用方不得就地修改 df
+    - 写：先 copy() 再修改，最后通过 save() 落盘并发布新版本
+    - 阶段变更：update_stages() 追加到变更日志（<工作簿>.stages.jsonl）并发布新版本，不改写工作簿；
+      加载时回放日志合并进快照，compact() 把日志写回工作簿后截断
+    - 失效：invalidate() 显式丢弃当前快照，文件 mtime 变化或TTL到期时自动重载
+    - 多进程：所有写操作持有 WriteCoordinator 跨进程写锁并递增写入代数；其它 worker 读取时发现代数变化，
+      工作簿未变则只回放变更日志追平，否则重新加载
+    - 冷加载：工作簿内容哈希与列式旁路文件匹配时直接加载旁路文件，跳过openpyxl解析
+    - 并发：同一时刻只有一个加载在执行，其余请求等待其结果；开启 stale_while_revalidate
+      时，已有快照过期后继续返回旧快照，由后台线程构建新快照
+    """
+
+    def __init__(self, excel_path: Union[str, Callable[[], str]], ttl_seconds: int = 300,
+                 use_sidecar: bool = True, stale_while_revalidate: bool = False,
+                 load_timeout: float = 120, use_journal: bool = True):
+        self._path_provider = excel_path if callable(excel_path) else (lambda: excel_path)
+        self.ttl_seconds = ttl_seconds
+        self.use_sidecar = use_sidecar
+        self.stale_while_revalidate = stale_while_revalidate
+        self.load_timeout = load_timeout
+        self.use_journal = use_journal
+        self._journals: Dict[str, StageJournal] = {}
+        # 其它进程只追加了阶段变更时，同一时刻只由一个线程回放追平
+        self._catch_up_lock = threading.Lock()
+        self._snapshot = None
+        self._version = 0
+        # 每次失效/写回递增，用于丢弃基于旧文件的进行中加载结果
+        self._generation = 0
+        self._inflight = None
+        self._lock = threading.Lock()
+        # 新快照发布时的回调（如清空查询结果缓存）
+        self._listeners = []
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'coalesced_waits': 0,
+            'background_refreshes': 0,
+            'catch_ups': 0,
+            'loads': 0,
+            'load_errors': 0,
+            'last_load_ms': None,
+            'max_load_ms': 0.0,
+            'total_load_ms': 0.0
+        }
+
+    @property
+    def excel_path(self) -> str:
+        return self._path_provider()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def journal_for(self, path: str = None) -> Optional[StageJournal]:
+        """工作簿对应的阶段变更日志；未启用时返回None"""
+        if not self.use_journal:
+            return None
+        path = path or self.excel_path
+        with self._lock:
+            journal = self._journals.get(path)
+            if journal is None:
+                journal = self._journals[path] = StageJournal(StageJournal.default_path(path))
+            return journal
+
+    def coordinator_for(self, path: str = None) -> WriteCoordinator:
+        """工作簿对应的跨进程写协调器（同一进程内按路径共用）"""
+        return WriteCoordinator.for_path(path or self.excel_path)
+
+    def _merge_journal(self, snapshot: 'CustomerSnapshot'):
+        """把阶段变更日志合并进刚加载/写回的快照（物化之前调用）"""
+        journal = self.journal_for(snapshot.path)
+        if journal is None:
+            return
+        overlay, entries, digest = journal.state()
+        if entries:
+            changed = apply_stage_overlay(snapshot.df, overlay)
+            logger.info(f"已合并阶段变更日志: {entries}条变更，涉及{len(changed)}行")
+        snapshot.journal_entries = entries
+        snapshot.content_hash = overlay_content_hash(snapshot.file_hash, digest)
+
+    def _is_fresh(self, snapshot: CustomerSnapshot, path: str, mtime: Optional[float],
+                  token: Optional[str]) -> bool:
+        if snapshot is None or snapshot.path != path or snapshot.mtime != mtime:
+            return False
+        if snapshot.write_token != token:
+            return False
+        return (time.time() - snapshot.loaded_at) <= self.ttl_seconds
+
+    def _parse_workbook(self, path: str):
+        pd = ensure_pandas_imported()
+        df = pd.read_excel(path)
+        renamed = normalize_columns(df)
+        try:
+            if '到期日期' in df.columns:
+                df['到期日期'] = pd.to_datetime(df['到期日期'], errors='coerce')
+        except Exception:
+            pass
+        return df, renamed
+
+    def _load(self, path: str, mtime: Optional[float]) -> CustomerSnapshot:
+        ensure_pandas_imported()
+        started = time.time()
+        # 先取写入代数再读文件：读取期间其它进程的写入会在下次访问时被发现
+        token = self.coordinator_for(path).token()
+        content_hash = None
+        loaded = None
+        source = 'xlsx'
+        if self.use_sidecar:
+            try:
+                content_hash = file_sha256(path)
+                loaded = load_sidecar(path, content_hash)
+            except Exception as e:
+                logger.warning(f"列式旁路文件校验失败: {str(e)}")
+        if loaded is not None:
+            df, renamed = loaded
+            source = 'sidecar'
+        else:
+            df, renamed = self._parse_workbook(path)
+            if content_hash:
+                write_sidecar(path, content_hash, df, renamed)
+        snapshot = CustomerSnapshot(df, 0, path, mtime, renamed, content_hash, source)
+        snapshot.write_token = token
+        self._merge_journal(snapshot)
+        snapshot.materialize()
+        elapsed_ms = (time.time() - started) * 1000
+        with self._lock:
+            self._metrics['loads'] += 1
+            self._metrics['last_load_ms'] = round(elapsed_ms, 1)
+            self._metrics['total_load_ms'] += elapsed_ms
+            self._metrics['max_load_ms'] = max(self._metrics['max_load_ms'], round(elapsed_ms, 1))
+        logger.info(f"客户数据快照已加载({source}): 共{len(df)}行，耗时{elapsed_ms:.0f}ms")
+        return snapshot
+
+    def _publish(self, snapshot: CustomerSnapshot) -> CustomerSnapshot:
+        """分配版本号并设为当前快照（调用方需持有 self._lock）"""
+        self._version += 1
+        snapshot.version = self._version
+        self._snapshot = snapshot
+        for listener in self._listeners:
+            try:
+                listener(snapshot)
+            except Exception as e:
+                logger.warning(f"快照发布回调失败: {str(e)}")
+        return snapshot
+
+    def subscribe(self, listener: Callable[[CustomerSnapshot], None]):
+        """注册快照发布回调（在持有服务锁时调用，回调应快速返回）"""
+        self._listeners.append(listener)
+
+    def _run_load(self, flight: _InflightLoad, path: str, mtime: Optional[float]):
+        try:
+            snapshot = self._load(path, mtime)
+            with self._lock:
+                if flight.generation == self._generation:
+                    self._publish(snapshot)
+                else:
+                    logger.info("加载期间快照已失效，丢弃本次加载结果")
+            flight.snapshot = snapshot
+        except Exception as e:
+            with self._lock:
+                self._metrics['load_errors'] += 1
+            logger.error(f"客户数据快照加载失败: {str(e)}")
+        finally:
+            with self._lock:
+                if self._inflight is flight:
+                    self._inflight = None
+            flight.event.set()
+
+    def _load_coalesced(self, path: str, mtime: Optional[float]) -> Optional[CustomerSnapshot]:
+        while True:
+            with self._lock:
+                flight = self._inflight
+                leader = flight is None
+                outdated = not leader and flight.generation != self._generation
+                if leader:
+                    flight = self._inflight = _InflightLoad(self._generation)
+                elif not outdated:
+                    flight.waiters += 1
+                    self._metrics['coalesced_waits'] += 1
+            if leader:
+                self._run_load(flight, path, mtime)
+                return flight.snapshot
+            if not flight.event.wait(self.load_timeout):
+                logger.warning(f"等待客户数据快照加载超时({self.load_timeout}s)")
+                return flight.snapshot
+            if not outdated:
+                return flight.snapshot
+            # 进行中的加载读取的是失效前的文件，等其结束后重新发起
+
+    def _refresh_in_background(self, path: str, mtime: Optional[float]):
+        with self._lock:
+            if self._inflight is not None:
+                return
+            flight = self._inflight = _InflightLoad(self._generation)
+            self._metrics['background_refreshes'] += 1
+        threading.Thread(target=self._run_load, args=(flight, path, mtime),
+                         name='customer-snapshot-refresh', daemon=True).start()
+
+    def _catch_up(self, snapshot: CustomerSnapshot, token: Optional[str]) -> Optional[CustomerSnapshot]:
+        """其它进程只追加了阶段变更（工作簿未变）：在当前快照上回放变更日志，无需重新加载
+
+        日志被截断等无法增量追平的情况返回None，由调用方完整重新加载。
+        """
+        with self._catch_up_lock:
+            # 等锁期间可能已有其它线程追平或重新加载
+            current = self._snapshot
+            if current is None or current.path != snapshot.path or current.mtime != snapshot.mtime:
+                return None
+            if current.write_token == token:
+                return current
+            snapshot = current
+            journal = self.journal_for(snapshot.path)
+            if journal is None:
+                return None
+            overlay, entries, digest = journal.state()
+            if entries < snapshot.journal_entries:
+                return None
+            df = snapshot.df.copy()
+            apply_stage_overlay(df, overlay)
+            caught_up = CustomerSnapshot(df, 0, snapshot.path, snapshot.mtime, snapshot.renamed_columns,
+                                         overlay_content_hash(snapshot.file_hash, digest), 'journal')
+            caught_up.file_hash = snapshot.file_hash
+            caught_up.journal_entries = entries
+            caught_up.write_token = token
+            caught_up.materialize()
+            with self._lock:
+                self._metrics['catch_ups'] += 1
+                self._generation += 1
+                published = self._publish(caught_up)
+        logger.info(f"其它进程写入了阶段变更，已回放追平: 日志共{entries}条")
+        return published
+
+    def get(self, allow_stale: bool = True) -> Optional[CustomerSnapshot]:
+        """获取当前快照，必要时重新加载；文件不存在或读取失败时返回None
+
+        写操作在写锁内以 allow_stale=False 调用，确保基于最新数据（不返回过期快照）。
+        """
+        path = self.excel_path
+        if not os.path.exists(path):
+            return None
+        try:
+            mtime = os.path.getmtime(path)
+        except Exception:
+            mtime = None
+        token = self.coordinator_for(path).token()
+        snapshot = self._snapshot
+        if self._is_fresh(snapshot, path, mtime, token):
+            with self._lock:
+                self._metrics['hits'] += 1
+            return snapshot
+        if snapshot is not None and snapshot.path == path and snapshot.mtime == mtime \
+                and snapshot.write_token != token \
+                and (time.time() - snapshot.loaded_at) <= self.ttl_seconds:
+            try:
+                caught_up = self._catch_up(snapshot, token)
+            except Exception as e:
+                logger.warning(f"回放阶段变更日志失败，改为重新加载: {str(e)}")
+                caught_up = None
+            if caught_up is not None:
+                return caught_up
+        if allow_stale and self.stale_while_revalidate and snapshot is not None and snapshot.path == path:
+            with self._lock:
+                self._metrics['stale_hits'] += 1
+            self._refresh_in_background(path, mtime)
+            return snapshot
+        with self._lock:
+            self._metrics['misses'] += 1
+        return self._load_coalesced(path, mtime)
+
+    def get_df(self):
+        snapshot = self.get()
+        return snapshot.df if snapshot is not None else None
+
+    def reload(self, reason: str = '') -> Optional[CustomerSnapshot]:
+        """立即重新加载（工作簿被替换后调用，顺带生成列式旁路文件）"""
+        self.invalidate(reason)
+        return self.get()
+
+    def invalidate(self, reason: str = ''):
+        """显式失效当前快照，下次访问时重新加载"""
+        with self._lock:
+            if self._snapshot is not None:
+                logger.info(f"客户数据快照失效: v{self._snapshot.version} {reason}".rstrip())
+            self._snapshot = None
+            self._generation += 1
+
+    def _write_workbook(self, df, renamed: Dict[str, str]):
+        """将 df 原子写回Excel（还原原始列名），返回 (mtime, 工作簿哈希)"""
+        path = self.excel_path
+        source_df = df.rename(columns={canonical: alias for canonical, alias in renamed.items()}) if renamed else df
+        tmp_fd, tmp_path = tempfile.mkstemp(prefix='snapshot_', suffix='.xlsx', dir=os.path.dirname(path) or None)
+        os.close(tmp_fd)
+        try:
+            source_df.to_excel(tmp_path, index=False)
+            if os.path.exists(path):
+                # mkstemp 创建的文件权限为 0600，替换前沿用原工作簿的权限
+                shutil.copymode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception:
+            try:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            except Exception:
+                pass
+            raise
+        return self._written(df, renamed)
+
+    def _patch_stages(self, df, overlay: Dict[str, str], renamed: Dict[str, str]):
+        """只改写工作簿中 客户阶段 列的相关单元格（其余压缩包成员原样复制）；结构不支持时退回整表写回"""
+        try:
+            patch_column(self.excel_path, renamed.get('用户ID', '用户ID'), renamed.get('客户阶段', '客户阶段'),
+                         overlay, normalize_id)
+        except XlsxPatchError as e:
+            logger.warning(f"工作簿不支持就地修补，改为整表写回: {str(e)}")
+            return self._write_workbook(df, renamed)
+        return self._written(df, renamed)
+
+    def _written(self, df, renamed: Dict[str, str]):
+        """工作簿落盘后：取 mtime、重算哈希并更新列式旁路文件，返回 (mtime, 工作簿哈希)"""
+        path = self.excel_path
+        try:
+            mtime = os.path.getmtime(path)
+        except Exception:
+            mtime = None
+        content_hash = None
+        if self.use_sidecar:
+            try:
+                content_hash = file_sha256(path)
+                write_sidecar(path, content_hash, df, renamed)
+            except Exception as e:
+                logger.warning(f"更新列式旁路文件失败: {str(e)}")
+        return mtime, content_hash
+
+    def _publish_written(self, df, renamed: Dict[str, str], mtime, content_hash) -> CustomerSnapshot:
+        snapshot = CustomerSnapshot(df, 0, self.excel_path, mtime, renamed, content_hash, 'save')
+        snapshot.write_token = self.coordinator_for(snapshot.path).bump()
+        self._merge_journal(snapshot)
+        snapshot.materialize()
+        with self._lock:
+            self._generation += 1
+            return self._publish(snapshot)
+
+    def save(self, df) -> CustomerSnapshot:
+        """将修改后的 df 原子写回Excel，并直接发布为新版本快照（无需重新解析）"""
+        with self.write_lock:
+            base = self._snapshot
+            renamed = base.renamed_columns if base is not None else {}
+            mtime, content_hash = self._write_workbook(df, renamed)
+            return self._publish_written(df, renamed, mtime, content_hash)
+
+    @property
+    def write_lock(self) -> WriteCoordinator:
+        """跨进程写锁（可重入）：需要"读取-校验-写入"原子完成的调用方在其中读取快照并调用 update_stages"""
+        return self.coordinator_for()
+
+    def update_stages(self, changes: Dict[str, str], metadata: Dict = None,
+                      item_metadata: Dict[str, Dict] = None) -> Optional[CustomerSnapshot]:
+        """批量更新客户阶段（用户ID -> 新阶段）：追加到变更日志并 fsync 后发布新快照，不改写工作簿
+
+        未启用变更日志时退回为整表写回。返回新快照；数据文件不可用时返回None。
+        """
+        with self.write_lock:
+            base = self.get(allow_stale=False)
+            if base is None:
+                return None
+            df = base.df.copy()
+            journal = self.journal_for(base.path)
+            if journal is None:
+                apply_stage_overlay(df, {normalize_id(jdy_id): stage for jdy_id, stage in changes.items()})
+                return self.save(df)
+            journal.append(changes, metadata, item_metadata)
+            # 回放完整覆盖表（而非只叠加本次变更）：base 可能是读取代数后、其它进程追加前加载的，
+            # 发布的数据须与 entries/digest 一致
+            overlay, entries, digest = journal.state()
+            apply_stage_overlay(df, overlay)
+            snapshot = CustomerSnapshot(df, 0, base.path, base.mtime, base.renamed_columns,
+                                        overlay_content_hash(base.file_hash, digest), 'journal')
+            snapshot.file_hash = base.file_hash
+            snapshot.journal_entries = entries
+            snapshot.write_token = self.coordinator_for(base.path).bump()
+            snapshot.materialize()
+            with self._lock:
+                self._generation += 1
+                return self._publish(snapshot)
+
+    def compact(self, reason: str = '') -> Dict:
+        """把阶段变更日志写回工作簿并截断日志（显式调用或定时执行）"""
+        with self.write_lock:
+            journal = self.journal_for()
+            if journal is None:
+                return {'compacted': 0}
+            base = self.get(allow_stale=False)
+            if base is None:
+                return {'compacted': 0, 'error': '数据文件不可用'}
+            overlay, entries, _ = journal.state()
+            if not entries:
+                return {'compacted': 0}
+            started = time.time()
+            df = base.df.copy()
+            apply_stage_overlay(df, overlay)
+            mtime, content_hash = self._patch_stages(df, overlay, base.renamed_columns)
+            # 工作簿已落盘后再截断日志；中途失败时日志仍在，重放结果相同
+            journal.truncate(entries)
+            self._publish_written(df, base.renamed_columns, mtime, content_hash)
+            elapsed_ms = round((time.time() - started) * 1000, 1)
+            logger.info(f"阶段变更日志已压实{reason}: {entries}条变更写回工作簿，耗时{elapsed_ms}ms")
+            return {'compacted': entries, 'customers': len(overlay), 'elapsed_ms': elapsed_ms}
+
+    def discard_journal(self, reason: str = ''):
+        """丢弃未压实的阶段变更（工作簿被整体替换时调用，新文件为准）"""
+        with self.write_lock:
+            journal = self.journal_for()
+            if journal is not None:
+                journal.reset(reason)
+            self.write_lock.bump()
+
+    def replace_workbook(self, source_path: str, reason: str = '') -> Optional[CustomerSnapshot]:
+        """用 source_path（同目录临时文件）原子替换工作簿，丢弃未压实的阶段变更并立即重新加载"""
+        with self.write_lock:
+            os.replace(source_path, self.excel_path)
+            self.discard_journal(reason)
+        return self.reload(reason)
+
+    def stats(self) -> Dict:
+        snapshot = self._snapshot
+        with self._lock:
+            metrics = dict(self._metrics)
+            inflight = self._inflight
+        loads = metrics.pop('total_load_ms')
+        metrics['avg_load_ms'] = round(loads / metrics['loads'], 1) if metrics['loads'] else None
+        lookups = metrics['hits'] + metrics['stale_hits'] + metrics['misses']
+        metrics['hit_rate'] = round((metrics['hits'] + metrics['stale_hits']) / lookups, 4) if lookups else None
+        return {
+            'version': self._version,
+            'loaded': snapshot is not None,
+            'rows': int(len(snapshot.df)) if snapshot is not None else 0,
+            'source': snapshot.source if snapshot is not None else None,
+            'content_hash': snapshot.content_hash if snapshot is not None else None,
+            'journal_entries': snapshot.journal_entries if snapshot is not None else 0,
+            'loaded_at': datetime.fromtimestamp(snapshot.loaded_at).isoformat() if snapshot is not None else None,
+            'ttl_seconds': self.ttl_seconds,
+            'stale_while_revalidate': self.stale_while_revalidate,
+            'loading': inflight is not None,
+            'current_waiters': inflight.waiters if inflight is not None else 0,
+            'metrics': metrics
+        }
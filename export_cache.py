@@ -0,0 +1,136 @@
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ExportCache:
+    """导出文件磁盘缓存：键 = (工作簿哈希, 格式, 快照内容哈希, 归一化筛选条件...)
+
+    - 文件名为 <工作簿哈希前16位>_<键摘要>.<格式>，目录即索引，多个进程可共用
+    - 命中时更新文件 mtime，按 mtime 做 LRU；总字节数/条目数超限时淘汰最久未用的
+    - 工作簿内容变化（上传/压实）后 prune() 清除其它工作簿哈希的条目
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024, max_entries: int = 64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._metrics = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'pruned': 0, 'aborted': 0}
+
+    @staticmethod
+    def make_key(file_hash: str, export_format: str, *parts) -> str:
+        digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:24]
+        return f"{file_hash[:16]}_{digest}.{export_format}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def get(self, key: str) -> Optional[str]:
+        """命中时返回文件路径并刷新其 LRU 时间"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self._metrics['misses'] += 1
+            return None
+        with self._lock:
+            self._metrics['hits'] += 1
+        return path
+
+    def tee(self, key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """透传字节块的同时写入临时文件；完整生成后原子替换为缓存条目，中途中断则丢弃"""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.export_', suffix='.tmp', dir=self.directory)
+            tmp = os.fdopen(fd, 'wb')
+        except OSError as e:
+            logger.warning(f"导出缓存目录不可写，本次不缓存: {str(e)}")
+            yield from chunks
+            return
+        completed = False
+        try:
+            for chunk in chunks:
+                tmp.write(chunk)
+                yield chunk
+            tmp.close()
+            os.replace(tmp_path, self._path(key))
+            completed = True
+            with self._lock:
+                self._metrics['stores'] += 1
+            self.evict()
+        finally:
+            if not completed:
+                tmp.close()
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                with self._lock:
+                    self._metrics['aborted'] += 1
+
+    def _entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if name.startswith('.'):
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def evict(self):
+        """按 LRU 淘汰，直到条目数与总字节数都在上限内"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, name = entries.pop(0)
+            try:
+                os.remove(self._path(name))
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._metrics['evictions'] += 1
+
+    def prune(self, keep_hash: str = None):
+        """删除不属于 keep_hash 的条目（keep_hash 为空时全部删除）"""
+        prefix = f"{keep_hash[:16]}_" if keep_hash else None
+        removed = 0
+        for _, _, name in self._entries():
+            if prefix and name.startswith(prefix):
+                continue
+            try:
+                os.remove(self._path(name))
+                removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info(f"数据文件已变化，清除{removed}个导出缓存文件")
+            with self._lock:
+                self._metrics['pruned'] += removed
+
+    def stats(self) -> Dict:
+        entries = self._entries()
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {
+            'directory': self.directory,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'metrics': metrics,
+        }
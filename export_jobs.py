@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class ExportQueueFull(Exception):
+    """排队+运行中的导出任务已达上限"""
+
+
+class ExportJob:
+    """一个后台导出任务；状态同时落盘为 <id>.json，其它进程也能查询"""
+
+    # 每写出多少行落盘一次进度
+    PROGRESS_EVERY = 2000
+
+    def __init__(self, job_id: str, owner: str, export_format: str, download_name: str, mimetype: str):
+        self.id = job_id
+        self.owner = owner
+        self.format = export_format
+        self.download_name = download_name
+        self.mimetype = mimetype
+        self.status = JOB_QUEUED
+        self.rows_total = None
+        self.rows_written = 0
+        self.bytes_written = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.path = None
+        self.source = 'render'  # render / cache
+        self._manager = None
+
+    def track(self, rows: Iterable) -> Iterator:
+        """包装行迭代器，统计已写出的行数"""
+        for row in rows:
+            self.rows_written += 1
+            if self.rows_written % self.PROGRESS_EVERY == 0 and self._manager is not None:
+                self._manager._persist(self)
+            yield row
+
+    def to_dict(self) -> Dict:
+        progress = None
+        if self.status == JOB_DONE:
+            progress = 1.0
+        elif self.rows_total:
+            progress = round(min(self.rows_written / self.rows_total, 1.0), 4)
+        elif self.rows_total == 0:
+            progress = 0.0
+        return {
+            'job_id': self.id,
+            'owner': self.owner,
+            'format': self.format,
+            'download_name': self.download_name,
+            'mimetype': self.mimetype,
+            'status': self.status,
+            'rows_total': self.rows_total,
+            'rows_written': self.rows_written,
+            'bytes_written': self.bytes_written,
+            'progress': progress,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+            'path': self.path,
+            'source': self.source,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'ExportJob':
+        job = cls(data['job_id'], data.get('owner'), data.get('format'), data.get('download_name'),
+                  data.get('mimetype'))
+        for name in ('status', 'rows_total', 'rows_written', 'bytes_written', 'created_at', 'started_at',
+                     'finished_at', 'error', 'path', 'source'):
+            setattr(job, name, data.get(name))
+        return job
+
+
+class ExportJobManager:
+    """后台导出任务：有界线程池执行，交互请求不被导出阻塞
+
+    - submit() 入队并立即返回任务；排队+运行中的任务数超过 max_pending 时抛出 ExportQueueFull
+    - 结果文件与状态文件保存在 directory 下，超过 ttl_seconds 的任务在下次提交/查询时清理
+    """
+
+    def __init__(self, directory: str, max_workers: int = 1, max_pending: int = 4, ttl_seconds: int = 3600):
+        self.directory = directory
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export-job')
+        self._jobs: Dict[str, ExportJob] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._metrics = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'cache_hits': 0}
+
+    def _meta_path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _persist(self, job: ExportJob):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.job_', suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(job.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, self._meta_path(job.id))
+        except Exception as e:
+            logger.warning(f"保存导出任务状态失败 {job.id}: {str(e)}")
+
+    def _new_job(self, owner, export_format, download_name, mimetype) -> ExportJob:
+        job = ExportJob(uuid.uuid4().hex, owner, export_format, download_name, mimetype)
+        job._manager = self
+        return job
+
+    def submit(self, owner: str, export_format: str, download_name: str, mimetype: str,
+               render: Callable[[ExportJob], Iterable[bytes]]) -> ExportJob:
+        """提交导出任务；render(job) 返回字节块迭代器，并可用 job.track() 统计行数、设置 job.rows_total"""
+        self.cleanup()
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._metrics['rejected'] += 1
+                raise ExportQueueFull(f'导出任务排队已满（{self.max_pending}），请稍后再试')
+            self._pending += 1
+            self._metrics['submitted'] += 1
+            job = self._new_job(owner, export_format, download_name, mimetype)
+            self._jobs[job.id] = job
+        self._persist(job)
+        try:
+            self._executor.submit(self._run, job, render)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+                self._jobs.pop(job.id, None)
+            raise
+        return job
+
+    def complete_from(self, owner: str, export_format: str, download_name: str, mimetype: str,
+                      path: str, rows_total: int = None) -> ExportJob:
+        """结果已存在（导出缓存命中）时直接生成已完成的任务"""
+        self.cleanup()
+        job = self._new_job(owner, export_format, download_name, mimetype)
+        job.status = JOB_DONE
+        job.source = 'cache'
+        job.path = path
+        job.rows_total = rows_total
+        job.started_at = job.finished_at = time.time()
+        try:
+            job.bytes_written = os.path.getsize(path)
+        except OSError:
+            pass
+        with self._lock:
+            self._jobs[job.id] = job
+            self._metrics['submitted'] += 1
+            self._metrics['cache_hits'] += 1
+        self._persist(job)
+        return job
+
+    def _run(self, job: ExportJob, render):
+        job.status = JOB_RUNNING
+        job.started_at = time.time()
+        self._persist(job)
+        tmp_path = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.export_', suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in render(job):
+                    f.write(chunk)
+                    job.bytes_written += len(chunk)
+            final_path = os.path.join(self.directory, f"{job.id}.{job.format}")
+            os.replace(tmp_path, final_path)
+            tmp_path = None
+            job.path = final_path
+            job.status = JOB_DONE
+            with self._lock:
+                self._metrics['completed'] += 1
+            logger.info(f"导出任务完成 {job.id}: {job.rows_written}行, {job.bytes_written}字节, "
+                        f"耗时{time.time() - job.started_at:.2f}秒")
+        except Exception as e:
+            job.status = JOB_FAILED
+            job.error = str(e)
+            with self._lock:
+                self._metrics['failed'] += 1
+            logger.error(f"导出任务失败 {job.id}: {str(e)}")
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+            job.finished_at = time.time()
+            with self._lock:
+                self._pending -= 1
+            self._persist(job)
+
+    def get(self, job_id: str) -> Optional[ExportJob]:
+        """查询任务；本进程没有时从状态文件读取（多进程部署）"""
+        if not job_id or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        try:
+            with open(self._meta_path(job_id), 'r', encoding='utf-8') as f:
+                return ExportJob.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def cleanup(self):
+        """清理过期任务（状态文件与结果文件）；缓存命中任务的结果文件归导出缓存管理，不删除"""
+        cutoff = time.time() - self.ttl_seconds
+        with self._lock:
+            expired = [job for job in self._jobs.values()
+                       if job.finished_at and job.finished_at < cutoff]
+            for job in expired:
+                self._jobs.pop(job.id, None)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            return {
+                'pending': self._pending,
+                'max_pending': self.max_pending,
+                'jobs': len(self._jobs),
+                'metrics': metrics,
+            }
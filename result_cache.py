@@ -0,0 +1,90 @@
+import logging
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, Hashable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ResultCache:
+    """查询结果 LRU 缓存：缓存已序列化的响应体（bytes），按条目数与总字节数双重限制
+
+    键由调用方组装，约定包含 快照版本 + 归一化查询参数 + 当天日期：
+    - 上传/阶段更新会发布新快照版本，调用 invalidate() 清空
+    - 跨过零点后键中的日期变化，首次写入新日期的结果时清除前一天的条目
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> bytes
+        self._bytes = 0
+        self._day: Optional[date] = None
+        self._lock = threading.Lock()
+        self._metrics = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'invalidations': 0,
+            'rejected_oversize': 0,
+        }
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        with self._lock:
+            body = self._entries.get(key)
+            if body is None:
+                self._metrics['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._metrics['hits'] += 1
+            return body
+
+    def put(self, key: Hashable, body: bytes, day: date = None):
+        size = len(body)
+        with self._lock:
+            if size > self.max_bytes // 4:
+                self._metrics['rejected_oversize'] += 1
+                return
+            if day is not None and day != self._day:
+                if self._day is not None and self._entries:
+                    logger.info(f"日期切换（{self._day} -> {day}），清空查询结果缓存")
+                    self._clear_locked()
+                self._day = day
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._entries[key] = body
+            self._bytes += size
+            self._metrics['stores'] += 1
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self._metrics['evictions'] += 1
+
+    def _clear_locked(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def invalidate(self, reason: str = ''):
+        """清空全部条目（数据发生变化时调用）"""
+        with self._lock:
+            if self._entries:
+                logger.info(f"查询结果缓存失效{reason}，清除{len(self._entries)}条")
+            self._clear_locked()
+            self._metrics['invalidations'] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+            lookups = metrics['hits'] + metrics['misses']
+            metrics['hit_rate'] = round(metrics['hits'] / lookups, 4) if lookups else None
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'day': self._day.isoformat() if self._day else None,
+                'metrics': metrics,
+            }
@@ -0,0 +1,155 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 列式旁路文件格式版本，格式变化时递增以废弃旧文件
+SIDECAR_FORMAT = 1
+MANIFEST_NAME = 'manifest.json'
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """计算文件内容哈希"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def sidecar_root(workbook_path: str) -> str:
+    """旁路文件目录：与工作簿同目录的隐藏目录，如 .战区客户列表.xlsx.cols/"""
+    directory, name = os.path.split(os.path.abspath(workbook_path))
+    return os.path.join(directory, f'.{name}.cols')
+
+def _sidecar_dir(workbook_path: str, content_hash: str) -> str:
+    return os.path.join(sidecar_root(workbook_path), content_hash[:32])
+
+def _encode_column(np, pd, series) -> Optional[Tuple[str, object, object]]:
+    """将一列编码为可 mmap 的 numpy 数组，返回 (kind, values, na_mask)；无法编码时返回None"""
+    dtype = series.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool', series.to_numpy(dtype=bool), None
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'int', series.to_numpy(dtype='int64'), None
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float', series.to_numpy(dtype='float64'), None
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        if getattr(dtype, 'tz', None) is not None:
+            return None
+        mask = series.isna().to_numpy()
+        values = series.to_numpy(dtype='datetime64[ns]').astype('int64')
+        return 'datetime', values, mask
+    # 文本列：只接受 str + 空值，混合类型（如数字与文本混排）放弃旁路，回退到Excel解析
+    mask = series.isna().to_numpy()
+    non_null = series[~mask]
+    if not all(isinstance(v, str) for v in non_null):
+        return None
+    values = series.where(~series.isna(), '').to_numpy(dtype=str)
+    return 'str', values, mask
+
+def _decode_column(np, pd, kind: str, values, mask, index):
+    if kind == 'datetime':
+        out = pd.Series(values.astype('datetime64[ns]'), index=index)
+        if mask is not None and mask.any():
+            out[mask] = pd.NaT
+        return out
+    if kind == 'str':
+        out = pd.Series(values.astype(object), index=index)
+        if mask is not None and mask.any():
+            out[mask] = np.nan
+        return out
+    return pd.Series(values, index=index)
+
+def write_sidecar(workbook_path: str, content_hash: str, df, renamed_columns: Dict[str, str]) -> bool:
+    """将已归一化的快照写成列式旁路文件（每列一个 .npy），成功返回True"""
+    try:
+        import numpy as np
+        import pandas as pd
+        target = _sidecar_dir(workbook_path, content_hash)
+        if os.path.exists(os.path.join(target, MANIFEST_NAME)):
+            return True
+        root = sidecar_root(workbook_path)
+        os.makedirs(root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='tmp_', dir=root)
+        try:
+            columns = []
+            for i, name in enumerate(df.columns):
+                encoded = _encode_column(np, pd, df[name])
+                if encoded is None:
+                    logger.info(f"列'{name}'类型混合，跳过列式旁路文件生成")
+                    return False
+                kind, values, mask = encoded
+                entry = {'name': str(name), 'kind': kind, 'file': f'c{i}.npy'}
+                np.save(os.path.join(tmp_dir, entry['file']), values, allow_pickle=False)
+                if mask is not None:
+                    entry['mask'] = f'c{i}.mask.npy'
+                    np.save(os.path.join(tmp_dir, entry['mask']), mask, allow_pickle=False)
+                columns.append(entry)
+            manifest = {
+                'format': SIDECAR_FORMAT,
+                'source_sha256': content_hash,
+                'rows': int(len(df)),
+                'columns': columns,
+                'renamed_columns': renamed_columns or {}
+            }
+            with open(os.path.join(tmp_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False)
+            try:
+                os.replace(tmp_dir, target)
+            except OSError:
+                # 并发写入时其他进程已生成同一哈希目录
+                if not os.path.exists(os.path.join(target, MANIFEST_NAME)):
+                    raise
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+        prune_sidecars(workbook_path, keep=content_hash)
+        return True
+    except Exception as e:
+        logger.warning(f"写入列式旁路文件失败: {str(e)}")
+        return False
+
+def load_sidecar(workbook_path: str, content_hash: str):
+    """按工作簿内容哈希加载旁路文件，返回 (df, renamed_columns)；不存在或不匹配时返回None"""
+    target = _sidecar_dir(workbook_path, content_hash)
+    manifest_path = os.path.join(target, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        import numpy as np
+        import pandas as pd
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != SIDECAR_FORMAT or manifest.get('source_sha256') != content_hash:
+            return None
+        index = pd.RangeIndex(int(manifest['rows']))
+        data = {}
+        for entry in manifest['columns']:
+            values = np.load(os.path.join(target, entry['file']), mmap_mode='r', allow_pickle=False)
+            mask = None
+            if entry.get('mask'):
+                mask = np.load(os.path.join(target, entry['mask']), allow_pickle=False)
+            data[entry['name']] = _decode_column(np, pd, entry['kind'], values, mask, index)
+        df = pd.DataFrame(data, index=index, columns=[entry['name'] for entry in manifest['columns']])
+        return df, manifest.get('renamed_columns') or {}
+    except Exception as e:
+        logger.warning(f"读取列式旁路文件失败，回退到Excel解析: {str(e)}")
+        return None
+
+def prune_sidecars(workbook_path: str, keep: str = None):
+    """清理与当前工作簿内容不匹配的旧旁路目录"""
+    root = sidecar_root(workbook_path)
+    if not os.path.isdir(root):
+        return
+    keep_name = keep[:32] if keep else None
+    for name in os.listdir(root):
+        if name == keep_name or name.startswith('tmp_'):
+            continue
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
@@ -0,0 +1,236 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from customer_index import normalize_id
+
+logger = logging.getLogger(__name__)
+
+
+class StageJournal:
+    """客户阶段变更日志（追加写 JSONL，每批写入后 fsync）
+
+    首行为文件头 {"journal_id": 随机标识, "created": ...}，每次新建/截断都换新标识；
+    之后每行一条变更：{"ts": ..., "jdy_id": 归一化用户ID, "stage": 新阶段, "batch": 批次号, "meta": {...}}
+    读取时按行顺序回放，同一用户ID后写覆盖先写，得到 用户ID -> 阶段 的覆盖表；
+    快照加载/发布时把覆盖表合并进内存数据，工作簿本身只在压实（compact）时改写。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._overlay: Dict[str, str] = {}
+        self._entries = 0
+        self._offset = 0
+        self._digest = hashlib.sha1()
+        self._file_id = None
+        self._journal_id = None
+        self._metrics = {'appends': 0, 'appended_entries': 0, 'compactions': 0, 'last_append_ms': None}
+
+    @staticmethod
+    def default_path(excel_path: str) -> str:
+        return f"{excel_path}.stages.jsonl"
+
+    @staticmethod
+    def _header_line() -> bytes:
+        header = {'journal_id': uuid.uuid4().hex, 'created': datetime.now().isoformat()}
+        return (json.dumps(header) + '\n').encode('utf-8')
+
+    @staticmethod
+    def _read_journal_id(f) -> Optional[str]:
+        """读取文件头中的日志标识；旧格式（无文件头）返回 None"""
+        try:
+            return json.loads(f.readline(256)).get('journal_id')
+        except (ValueError, AttributeError):
+            return None
+
+    def _reset_state(self):
+        self._overlay = {}
+        self._entries = 0
+        self._offset = 0
+        self._digest = hashlib.sha1()
+
+    @staticmethod
+    def _parse_entry(line: bytes) -> Optional[Dict]:
+        """解析一行变更；文件头、空行与无法解析的行返回 None（回放与截断共用同一规则）"""
+        if not line.strip():
+            return None
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            logger.warning(f"阶段变更日志存在无法解析的行，已跳过: {str(e)}")
+            return None
+        if not isinstance(record, dict) or 'journal_id' in record:
+            return None
+        if 'jdy_id' not in record or 'stage' not in record:
+            logger.warning("阶段变更日志存在缺少 jdy_id/stage 的行，已跳过")
+            return None
+        return record
+
+    def _refresh_locked(self):
+        """增量读取新追加的行；文件被替换、重建（即使复用了同一 inode）或截短时从头重读"""
+        try:
+            f = open(self.path, 'rb')
+        except FileNotFoundError:
+            self._reset_state()
+            self._file_id = None
+            self._journal_id = None
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            file_id = (st.st_dev, st.st_ino)
+            journal_id = self._read_journal_id(f)
+            if file_id != self._file_id or journal_id != self._journal_id or st.st_size < self._offset:
+                self._reset_state()
+                self._file_id = file_id
+                self._journal_id = journal_id
+            if st.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # 只消费完整的行（并发写入时最后一行可能尚未写完）
+        end = data.rfind(b'\n') + 1
+        if end <= 0:
+            return
+        data = data[:end]
+        for line in data.splitlines():
+            record = self._parse_entry(line)
+            if record is None:
+                continue
+            self._overlay[record['jdy_id']] = record['stage']
+            self._entries += 1
+        self._digest.update(data)
+        self._offset += len(data)
+
+    def state(self) -> Tuple[Dict[str, str], int, Optional[str]]:
+        """返回 (覆盖表副本, 条目数, 内容摘要)；无条目时摘要为 None"""
+        with self._lock:
+            self._refresh_locked()
+            digest = self._digest.hexdigest() if self._entries else None
+            return dict(self._overlay), self._entries, digest
+
+    def append(self, changes: Dict[str, str], metadata: Dict = None,
+               item_metadata: Dict[str, Dict] = None) -> int:
+        """追加一批变更并 fsync，返回写入条数；返回即表示已持久化
+
+        item_metadata 可按用户ID提供单条元数据（合并写入时保留各请求来源），缺省用 metadata
+        """
+        if not changes:
+            return 0
+        started = datetime.now()
+        batch = started.strftime('%Y%m%d%H%M%S%f')
+        lines = []
+        for jdy_id, stage in changes.items():
+            lines.append(json.dumps({
+                'ts': started.isoformat(),
+                'jdy_id': normalize_id(jdy_id),
+                'stage': stage,
+                'batch': batch,
+                'meta': (item_metadata or {}).get(jdy_id) or metadata or {},
+            }, ensure_ascii=False, default=str))
+        payload = ('\n'.join(lines) + '\n').encode('utf-8')
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size == 0:
+                    payload = self._header_line() + payload
+                os.write(fd, payload)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self._refresh_locked()
+            self._metrics['appends'] += 1
+            self._metrics['appended_entries'] += len(lines)
+            self._metrics['last_append_ms'] = round((datetime.now() - started).total_seconds() * 1000, 2)
+        return len(lines)
+
+    def truncate(self, through_entries: int):
+        """压实后丢弃前 through_entries 条（已写入工作簿），保留之后追加的条目"""
+        with self._lock:
+            self._refresh_locked()
+            try:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return
+            # 按回放规则计数：无法解析的行不算条目，截断位置与 state() 返回的条目数一致
+            kept, seen = [], 0
+            for line in data[:self._offset].splitlines(keepends=True):
+                if seen >= through_entries:
+                    if self._parse_entry(line) is not None:
+                        kept.append(line)
+                    continue
+                if self._parse_entry(line) is not None:
+                    seen += 1
+            # 读取之后才追加的内容原样保留
+            if data[self._offset:]:
+                kept.append(data[self._offset:])
+            if kept:
+                fd, tmp_path = tempfile.mkstemp(prefix='.stages_', suffix='.tmp',
+                                                dir=os.path.dirname(self.path) or None)
+                with os.fdopen(fd, 'wb') as f:
+                    # 新文件头：其它进程据此发现日志已被重建
+                    f.write(self._header_line())
+                    f.writelines(kept)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+            else:
+                os.remove(self.path)
+            self._file_id = None
+            self._journal_id = None
+            self._reset_state()
+            self._refresh_locked()
+            self._metrics['compactions'] += 1
+
+    def reset(self, reason: str = ''):
+        """丢弃全部条目（工作簿被整体替换时调用）"""
+        with self._lock:
+            try:
+                os.remove(self.path)
+                logger.info(f"阶段变更日志已清空{reason}")
+            except FileNotFoundError:
+                pass
+            self._file_id = None
+            self._journal_id = None
+            self._reset_state()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._refresh_locked()
+            return {
+                'path': self.path,
+                'journal_id': self._journal_id,
+                'entries': self._entries,
+                'customers': len(self._overlay),
+                'bytes': self._offset,
+                'metrics': dict(self._metrics),
+            }
+
+
+def apply_stage_overlay(df, overlay: Dict[str, str], stage_column: str = '客户阶段') -> List[int]:
+    """把 用户ID -> 阶段 覆盖表写入 df（就地修改），返回被修改的行位置"""
+    import numpy as np
+    if not overlay or '用户ID' not in df.columns:
+        return []
+    keys = df['用户ID'].map(normalize_id)
+    hit = keys.isin(overlay.keys()).to_numpy()
+    positions = np.flatnonzero(hit)
+    if not len(positions):
+        return []
+    if stage_column not in df.columns:
+        df[stage_column] = ''
+    if df[stage_column].dtype != object:
+        df[stage_column] = df[stage_column].astype(object)
+    col = df.columns.get_loc(stage_column)
+    df.iloc[positions, col] = keys.iloc[positions].map(overlay).to_numpy()
+    return positions.tolist()
@@ -1,11 +1,13 @@
 import os
 import logging
-import threading
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
 from enum import Enum
 import json
 
+from customer_snapshot import CustomerSnapshotService
+from customer_index import normalize_id
+
 # pandas延迟导入
 pd = None
 
@@ -38,10 +40,15 @@ class StageConflictError(Exception):
 class StageManager:
     """优化的状态管理器"""
     
-    def __init__(self, excel_path: str, log_file: str = None):
+    def __init__(self, excel_path: str, log_file: str = None,
+                 snapshot_service: Optional[CustomerSnapshotService] = None,
+                 write_queue=None):
         self.excel_path = excel_path
+        # 读写统一经过快照服务；未注入时使用独立实例（同样带别名归一化）
+        self.snapshots = snapshot_service or CustomerSnapshotService(excel_path)
+        # 单条变更可交给合并写入队列（StageWriteQueue），突发点击合并为一次写入
+        self.write_queue = write_queue
         self.log_file = log_file or os.path.join(os.getcwd(), 'logs', 'stage_changes.log')
-        self._lock = threading.Lock()
         self._setup_logging()
         
         # 状态变更规则定义
@@ -162,12 +169,15 @@ class StageManager:
         else:
             self.stage_logger.error(f"状态变更失败: {log_message}")
     
-    def _detect_conflicts(self, df, jdy_id: str) -> List[Dict]:
-        """检测状态冲突"""
+    def _detect_conflicts(self, df, jdy_id: str, positions: List[int] = None) -> List[Dict]:
+        """检测状态冲突（positions 为已通过用户ID索引查得的行位置）"""
         conflicts = []
         
         # 查找所有匹配的记录
-        matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
+        if positions is None:
+            matching_rows = df[df['用户ID'].map(normalize_id) == normalize_id(jdy_id)]
+        else:
+            matching_rows = df.iloc[positions]
         
         if len(matching_rows) > 1:
             # 检查是否有不同的状态
@@ -184,105 +194,216 @@ class StageManager:
     def update_stage(self, jdy_id: str, target_stage: str,
                     force: bool = False, metadata: Dict = None) -> Dict:
         """更新客户阶段状态（简化版 - 直接修改状态，无复杂逻辑）"""
-        with self._lock:  # 确保操作的原子性
+        # 不在此加锁：本方法不做"读取-校验-写入"，变更按用户ID追加到阶段变更日志（后写覆盖先写），
+        # 写入在快照服务的跨进程写锁内完成；若在此持写锁等待合并写入队列确认，会与写线程互相等待
+        try:
+            # 1. 参数校验
+            if not jdy_id or not target_stage:
+                error_msg = "缺少必要参数：jdy_id和target_stage不能为空"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'validation'}
+
+            # 2. 文件存在性检查
+            if not os.path.exists(self.excel_path):
+                error_msg = f"Excel文件不存在: {self.excel_path}"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'file_not_found'}
+
+            # 3. 读取客户数据快照（列名别名已统一，只读；不接受过期快照，其它 worker 的写入先追平）
+            pd = ensure_pandas_imported()
+            snapshot = self.snapshots.get(allow_stale=False)
+            if snapshot is None:
+                error_msg = f"读取Excel文件失败: {self.excel_path}"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'file_read_error'}
+            df = snapshot.df
+
+            # 4. 检查必要列
+            if '用户ID' not in df.columns:
+                error_msg = "Excel文件格式错误：缺少用户ID列"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'column_missing'}
+
+            # 5. 查找匹配记录（用户ID索引精确匹配，避免子串误命中其他客户）
+            matching_rows = df.iloc[snapshot.find_rows(jdy_id)]
+
+            if matching_rows.empty:
+                error_msg = f"未找到客户记录: {jdy_id}"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'customer_not_found'}
+
+            # 6. 记录所有匹配记录的变更（无校验、无冲突检查）
+            stage_column = '客户阶段'
+            updated_records = []
+
+            for index in matching_rows.index:
+                stage_value = df.loc[index, stage_column] if stage_column in df.columns else ''
+                current_stage = stage_value if (pd.notna(stage_value) if pd else stage_value is not None) else ''
+
+                updated_records.append({
+                    'index': index,
+                    'old_stage': str(current_stage) if current_stage else '',
+                    'new_stage': target_stage
+                })
+
+            # 7. 写入阶段变更日志并发布新快照（工作簿在压实时统一写回）
+            if not updated_records:
+                error_msg = "没有记录需要更新"
+                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'no_updates'}
+
             try:
-                # 1. 参数校验
-                if not jdy_id or not target_stage:
-                    error_msg = "缺少必要参数：jdy_id和target_stage不能为空"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'validation'}
+                if self.write_queue is not None:
+                    self.write_queue.update(jdy_id, target_stage, metadata)
+                else:
+                    self.snapshots.update_stages({jdy_id: target_stage}, metadata)
+            except Exception as e:
+                error_msg = f"保存Excel文件失败: {str(e)}"
+                self._log_stage_change(jdy_id, updated_records[0]['old_stage'],
+                                     target_stage, False, error_msg, metadata)
+                return {'success': False, 'error': error_msg, 'error_type': 'file_save_error'}
 
-                # 2. 文件存在性检查
-                if not os.path.exists(self.excel_path):
-                    error_msg = f"Excel文件不存在: {self.excel_path}"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'file_not_found'}
+            # 8. 记录成功日志
+            for record in updated_records:
+                self._log_stage_change(jdy_id, record['old_stage'], target_stage, True, None, metadata)
 
-                # 3. 读取Excel文件
-                try:
-                    pd = ensure_pandas_imported()
-                    df = pd.read_excel(self.excel_path)
-
-                    # 兼容列名：将常见ID列重命名为"用户ID"
-                    if '用户ID' not in df.columns:
-                        id_aliases = ['简道云ID', '简道云账号', '账号ID', '用户唯一ID', '客户唯一ID', '用户id', 'ID']
-                        for alias in id_aliases:
-                            if alias in df.columns:
-                                df.rename(columns={alias: '用户ID'}, inplace=True)
-                                self.stage_logger.info(f"兼容列名：将'{alias}'重命名为'用户ID'")
-                                break
-
-                except Exception as e:
-                    error_msg = f"读取Excel文件失败: {str(e)}"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'file_read_error'}
-
-                # 4. 检查必要列
-                if '用户ID' not in df.columns:
-                    error_msg = "Excel文件格式错误：缺少用户ID列"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'column_missing'}
+            return {
+                'success': True,
+                'message': f'客户 {jdy_id} 状态已更新为 {target_stage}',
+                'updated_count': len(updated_records),
+                'updated_records': updated_records
+            }
 
-                # 5. 查找匹配记录
-                matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
+        except Exception as e:
+            error_msg = f"状态更新异常: {str(e)}"
+            self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
+            return {'success': False, 'error': error_msg, 'error_type': 'system_error'}
 
-                if matching_rows.empty:
-                    error_msg = f"未找到客户记录: {jdy_id}"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'customer_not_found'}
+    def update_stage_batch(self, updates: List[Dict], force: bool = False, atomic: bool = True,
+                           metadata: Dict = None) -> Dict:
+        """批量更新客户阶段：同一快照上逐条校验，一次写入变更日志并发布一个新快照
 
-                # 6. 检查或创建阶段列
+        - 校验：参数、客户存在性、多状态冲突；force=False 时再按状态转换规则校验
+          （同一批次内同一客户的多条更新按顺序校验，后一条基于前一条的结果）
+        - atomic=True：任一条校验失败则整批不写入；atomic=False：只写入校验通过的条目
+        返回 {'success', 'applied_count', 'failed_count', 'results': [逐条结果], 'snapshot_version'}
+        """
+        results = []
+        with self.snapshots.write_lock:
+            try:
+                pd = ensure_pandas_imported()
+                if not os.path.exists(self.excel_path):
+                    return {'success': False, 'error': f"Excel文件不存在: {self.excel_path}",
+                            'error_type': 'file_not_found'}
+                # 持写锁读取最新快照（不接受过期快照），校验与写入基于同一份数据
+                snapshot = self.snapshots.get(allow_stale=False)
+                if snapshot is None:
+                    return {'success': False, 'error': f"读取Excel文件失败: {self.excel_path}",
+                            'error_type': 'file_read_error'}
+                df = snapshot.df
+                if '用户ID' not in df.columns:
+                    return {'success': False, 'error': "Excel文件格式错误：缺少用户ID列",
+                            'error_type': 'column_missing'}
                 stage_column = '客户阶段'
-                if stage_column not in df.columns:
-                    df[stage_column] = ''
 
-                # 7. 直接更新所有匹配记录（无校验、无冲突检查）
-                updated_records = []
+                # 批次内的最新状态：归一化用户ID -> 阶段
+                pending = {}
+                changes = {}
+                for i, update in enumerate(updates):
+                    update = update if isinstance(update, dict) else {}
+                    jdy_id = str(update.get('jdy_id') or '').strip()
+                    target_stage = str(update.get('target_stage') or update.get('stage') or '').strip()
+                    item = {'index': i, 'jdy_id': jdy_id, 'target_stage': target_stage}
+                    results.append(item)
+                    if not jdy_id or not target_stage:
+                        item.update(status='invalid', error='缺少必要参数：jdy_id和target_stage不能为空',
+                                    error_type='validation')
+                        continue
 
-                for index in matching_rows.index:
-                    stage_value = df.loc[index, stage_column]
-                    current_stage = stage_value if (pd.notna(stage_value) if pd else stage_value is not None) else ''
+                    positions = snapshot.find_rows(jdy_id)
+                    if not len(positions):
+                        item.update(status='not_found', error=f'未找到客户记录: {jdy_id}',
+                                    error_type='customer_not_found')
+                        continue
 
-                    # 记录变更（不做任何校验）
-                    updated_records.append({
-                        'index': index,
-                        'old_stage': str(current_stage) if current_stage else '',
-                        'new_stage': target_stage
-                    })
+                    key = normalize_id(jdy_id)
+                    if key in pending:
+                        current_stage = pending[key]
+                    else:
+                        current_stage = df.iat[positions[0], df.columns.get_loc(stage_column)] \
+                            if stage_column in df.columns else ''
+                        current_stage = current_stage if pd.notna(current_stage) else ''
+                    item['old_stage'] = str(current_stage) if current_stage else ''
+                    item['updated_count'] = len(positions)
 
-                    # 直接更新
-                    df.loc[index, stage_column] = target_stage
+                    if not force:
+                        conflicts = self._detect_conflicts(df, jdy_id, positions) if key not in pending else []
+                        if conflicts:
+                            item.update(status='conflict', error=conflicts[0]['message'], error_type='conflict',
+                                        conflicts=conflicts)
+                            continue
+                        is_valid, validation_msg = self._validate_stage_transition(current_stage, target_stage)
+                        if not is_valid:
+                            item.update(status='invalid', error=validation_msg, error_type='validation_failed')
+                            continue
 
-                # 8. 保存文件
-                if not updated_records:
-                    error_msg = "没有记录需要更新"
-                    self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'no_updates'}
+                    item['status'] = 'valid'
+                    pending[key] = target_stage
+                    changes[key] = target_stage
 
-                try:
-                    df.to_excel(self.excel_path, index=False)
-                except Exception as e:
-                    error_msg = f"保存Excel文件失败: {str(e)}"
-                    self._log_stage_change(jdy_id, updated_records[0]['old_stage'],
-                                         target_stage, False, error_msg, metadata)
-                    return {'success': False, 'error': error_msg, 'error_type': 'file_save_error'}
+                failed = [item for item in results if item['status'] != 'valid']
+                if atomic and failed:
+                    for item in results:
+                        if item['status'] == 'valid':
+                            item['status'] = 'skipped'
+                    for item in failed:
+                        self._log_stage_change(item['jdy_id'], item.get('old_stage', ''), item['target_stage'],
+                                               False, item['error'], metadata)
+                    return {
+                        'success': False,
+                        'error': f'{len(failed)}条更新未通过校验，整批未写入',
+                        'error_type': 'batch_rejected',
+                        'applied_count': 0,
+                        'failed_count': len(failed),
+                        'results': results,
+                        'snapshot_version': snapshot.version
+                    }
 
-                # 9. 记录成功日志
-                for record in updated_records:
-                    self._log_stage_change(jdy_id, record['old_stage'], target_stage, True, None, metadata)
+                published = snapshot
+                if changes:
+                    try:
+                        published = self.snapshots.update_stages(changes, metadata)
+                    except Exception as e:
+                        error_msg = f"保存阶段变更失败: {str(e)}"
+                        for item in results:
+                            if item['status'] == 'valid':
+                                item.update(status='failed', error=error_msg, error_type='file_save_error')
+                        return {'success': False, 'error': error_msg, 'error_type': 'file_save_error',
+                                'applied_count': 0, 'failed_count': len(results), 'results': results}
 
+                for item in results:
+                    if item['status'] == 'valid':
+                        item['status'] = 'applied'
+                        self._log_stage_change(item['jdy_id'], item['old_stage'], item['target_stage'],
+                                               True, None, metadata)
+                    else:
+                        self._log_stage_change(item['jdy_id'], item.get('old_stage', ''), item['target_stage'],
+                                               False, item['error'], metadata)
+                applied = sum(1 for item in results if item['status'] == 'applied')
                 return {
                     'success': True,
-                    'message': f'客户 {jdy_id} 状态已更新为 {target_stage}',
-                    'updated_count': len(updated_records),
-                    'updated_records': updated_records
+                    'message': f'已批量更新{applied}条，失败{len(results) - applied}条',
+                    'applied_count': applied,
+                    'failed_count': len(results) - applied,
+                    'results': results,
+                    'snapshot_version': published.version if published is not None else None
                 }
 
             except Exception as e:
-                error_msg = f"状态更新异常: {str(e)}"
-                self._log_stage_change(jdy_id, '', target_stage, False, error_msg, metadata)
-                return {'success': False, 'error': error_msg, 'error_type': 'system_error'}
-    
+                error_msg = f"批量状态更新异常: {str(e)}"
+                logging.getLogger(__name__).error(error_msg)
+                return {'success': False, 'error': error_msg, 'error_type': 'system_error', 'results': results}
+
     def get_stage_history(self, jdy_id: str = None, limit: int = 100) -> List[Dict]:
         """获取状态变更历史"""
         try:
@@ -325,7 +446,12 @@ class StageManager:
         
         try:
             pd = ensure_pandas_imported()
-            df = pd.read_excel(self.excel_path)
+            # 校验基于最新数据（不接受过期快照）
+            snapshot = self.snapshots.get(allow_stale=False)
+            if snapshot is None:
+                results['error'] = f'批量校验失败: 无法读取 {self.excel_path}'
+                return results
+            df = snapshot.df
             
             for update in updates:
                 jdy_id = update.get('jdy_id')
@@ -338,8 +464,9 @@ class StageManager:
                     })
                     continue
                 
-                # 查找记录
-                matching_rows = df[df['用户ID'].astype(str).str.contains(str(jdy_id), case=False, na=False)]
+                # 查找记录（哈希索引，每条 O(1)）
+                positions = snapshot.find_rows(jdy_id)
+                matching_rows = df.iloc[positions]
                 
                 if matching_rows.empty:
                     results['invalid'].append({
@@ -349,7 +476,7 @@ class StageManager:
                     continue
                 
                 # 检查冲突
-                conflicts = self._detect_conflicts(df, jdy_id)
+                conflicts = self._detect_conflicts(df, jdy_id, positions)
                 if conflicts:
                     results['conflicts'].append({
                         'update': update,
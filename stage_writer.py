@@ -0,0 +1,137 @@
+import queue
+import time
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional
+
+from customer_index import normalize_id
+
+logger = logging.getLogger(__name__)
+
+
+class StageWriteQueue:
+    """阶段写入合并队列：所有阶段变更交给单一写线程，按突发合并后一次写入
+
+    - submit() 入队并返回 Future；写线程攒满 max_batch 条或等待 flush_interval 秒后刷写
+    - 同一客户在一批内的多次变更只保留最后一次（写入顺序与提交顺序一致）
+    - 每批调用一次 snapshot_service.update_stages()：一次变更日志追加（fsync）+ 一次快照发布，
+      返回后才完成各 Future，即调用方拿到确认时变更已持久化
+    """
+
+    def __init__(self, snapshot_service, flush_interval: float = 0.05, max_batch: int = 100,
+                 ack_timeout: float = 30):
+        self.snapshots = snapshot_service
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.ack_timeout = ack_timeout
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._metrics = {
+            'submitted': 0,
+            'flushes': 0,
+            'written': 0,
+            'coalesced': 0,
+            'failed_flushes': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': None,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+            'max_ack_ms': 0.0,
+            'total_ack_ms': 0.0,
+        }
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='stage-writer', daemon=True)
+                self._thread.start()
+
+    def submit(self, jdy_id: str, stage: str, metadata: Dict = None) -> Future:
+        """入队一条阶段变更，返回在持久化后完成的 Future（结果为发布的新快照）"""
+        future = Future()
+        self._ensure_thread()
+        with self._lock:
+            self._metrics['submitted'] += 1
+        self._queue.put((jdy_id, stage, metadata or {}, future, time.time()))
+        return future
+
+    def update(self, jdy_id: str, stage: str, metadata: Dict = None, timeout: Optional[float] = None):
+        """提交并等待确认；写入失败时抛出原异常"""
+        return self.submit(jdy_id, stage, metadata).result(timeout or self.ack_timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        changes, item_metadata = {}, {}
+        for jdy_id, stage, metadata, _, _ in batch:
+            key = normalize_id(jdy_id)
+            # 重新插入以保证写入顺序为最后一次提交的顺序
+            changes.pop(key, None)
+            changes[key] = stage
+            item_metadata[key] = metadata
+        started = time.time()
+        try:
+            snapshot = self.snapshots.update_stages(changes, {'source': 'stage_write_queue'}, item_metadata)
+            if snapshot is None:
+                raise RuntimeError('客户数据快照不可用')
+            error = None
+        except Exception as e:
+            error = e
+            logger.error(f"阶段变更批量写入失败（{len(batch)}条）: {str(e)}")
+        finished = time.time()
+        flush_ms = (finished - started) * 1000
+        ack_ms = [(finished - enqueued) * 1000 for *_, enqueued in batch]
+        with self._lock:
+            m = self._metrics
+            m['flushes'] += 1
+            m['last_batch_size'] = len(batch)
+            m['last_flush_ms'] = round(flush_ms, 2)
+            m['max_flush_ms'] = max(m['max_flush_ms'], round(flush_ms, 2))
+            m['total_flush_ms'] += flush_ms
+            m['max_ack_ms'] = max(m['max_ack_ms'], round(max(ack_ms), 2))
+            m['total_ack_ms'] += sum(ack_ms)
+            if error is None:
+                m['written'] += len(changes)
+                m['coalesced'] += len(batch) - len(changes)
+            else:
+                m['failed_flushes'] += 1
+        for _, _, _, future, _ in batch:
+            if error is None:
+                future.set_result(snapshot)
+            else:
+                future.set_exception(error)
+        if len(batch) > 1:
+            logger.info(f"阶段变更合并写入: {len(batch)}条请求 -> {len(changes)}个客户，耗时{flush_ms:.0f}ms")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        total_flush = metrics.pop('total_flush_ms')
+        total_ack = metrics.pop('total_ack_ms')
+        metrics['avg_flush_ms'] = round(total_flush / metrics['flushes'], 2) if metrics['flushes'] else None
+        acked = metrics['submitted'] - self._queue.qsize()
+        metrics['avg_ack_ms'] = round(total_ack / acked, 2) if acked > 0 and metrics['flushes'] else None
+        return {
+            'queue_depth': self._queue.qsize(),
+            'flush_interval_ms': round(self.flush_interval * 1000, 1),
+            'max_batch': self.max_batch,
+            'writer_alive': self._thread is not None and self._thread.is_alive(),
+            'metrics': metrics,
+        }
@@ -12,14 +12,35 @@ function isStaticPreview() {
   }
 }
 
+// GET 响应的 ETag 缓存：url -> { etag, data }，服务端返回 304 时复用上次的数据
+const _etagCache = new Map();
+const ETAG_CACHE_LIMIT = 50;
+
 async function safeJsonFetch(url, options = {}, fallbackData = {}) {
   try {
-    const response = await fetch(url, options);
+    const method = (options.method || 'GET').toUpperCase();
+    const cached = method === 'GET' ? _etagCache.get(url) : null;
+    const fetchOptions = cached
+      ? { ...options, headers: { ...(options.headers || {}), 'If-None-Match': cached.etag } }
+      : options;
+    const response = await fetch(url, fetchOptions);
+    if (response.status === 304 && cached) {
+      return JSON.parse(JSON.stringify(cached.data));
+    }
     const contentType = response.headers ? (response.headers.get('content-type') || '') : '';
     if (!response.ok || !contentType.includes('application/json')) {
       return { ...fallbackData, _static_preview: true };
     }
-    return await response.json();
+    const data = await response.json();
+    const etag = method === 'GET' && response.headers ? response.headers.get('ETag') : null;
+    if (etag) {
+      _etagCache.delete(url);
+      _etagCache.set(url, { etag, data: JSON.parse(JSON.stringify(data)) });
+      if (_etagCache.size > ETAG_CACHE_LIMIT) {
+        _etagCache.delete(_etagCache.keys().next().value);
+      }
+    }
+    return data;
   } catch (error) {
     return { ...fallbackData, _static_preview: true, error: error && error.message ? error.message : String(error) };
   }
@@ -73,6 +94,40 @@ function logApiError(endpoint, error) {
   } catch (_) {}
 }
 
+// 首页启动数据包：首屏的到期提醒、未签约客户、本月收款合并为一次 /dashboard_bundle 请求
+// 每个分区只供首次加载使用一次；之后的筛选/刷新仍走各自接口
+let _dashboardBundlePromise = null;
+const _dashboardBundleUsed = new Set();
+
+function loadDashboardBundle() {
+  if (!_dashboardBundlePromise) {
+    const sections = [];
+    if (document.getElementById('contractForm') && !document.body.classList.contains('theme-giko-dark')) {
+      sections.push('expiring_customers');
+    }
+    if (document.getElementById('unsignedCustomersList')) sections.push('unsigned_customers');
+    if (document.getElementById('monthlyRevenue')) sections.push('monthly_revenue');
+    const status = localStorage.getItem('status-filter') || 'na';
+    const url = `/dashboard_bundle?sections=${sections.join(',')}&status=${encodeURIComponent(status)}`;
+    _dashboardBundlePromise = sections.length
+      ? safeJsonFetch(url, { credentials: 'same-origin' }, {}).then(data => ({ data, status }))
+      : Promise.resolve({ data: {}, status });
+  }
+  return _dashboardBundlePromise;
+}
+
+// 取启动数据包中的分区；数据包不可用、分区失败、已用过或参数不一致时返回 null，调用方回退到独立接口
+async function takeBundleSection(name, status) {
+  if (_dashboardBundleUsed.has(name)) return null;
+  _dashboardBundleUsed.add(name);
+  const bundle = await loadDashboardBundle();
+  const data = bundle.data || {};
+  if (data._static_preview || !data.sections || !(name in data.sections)) return null;
+  if ((data.failed_sections || {})[name]) return null;
+  if (status !== undefined && status !== bundle.status) return null;
+  return data.sections[name];
+}
+
 // 显示销售代表筛选模态框
 function showSalesFilterModal(type) {
     // 移除现有模态框
@@ -594,12 +649,13 @@ function updateFutureCustomersDisplay(customers, salesFilter) {
 
 // 获取即将到期的客户并显示提醒看板（静态预览友好）
 function fetchExpiringCustomers() {
-    safeJsonFetch('/get_expiring_customers', { credentials: 'same-origin' }, {
+    takeBundleSection('expiring_customers')
+    .then(section => section || safeJsonFetch('/get_expiring_customers', { credentials: 'same-origin' }, {
         expiring_customers: [],
         reminder_type: 'daily',
         today_date: new Date().toISOString().slice(0,10),
         message: '静态预览模式：API未启动，暂无到期客户数据'
-    })
+    }))
     .then(data => {
         if (!data) return;
         if (data.error) {
@@ -2185,9 +2241,7 @@ document.addEventListener('DOMContentLoaded', function() {
         btnSyncLocalOps.addEventListener('click', function() {
             const ops = getLocalStageOps();
             const entries = Object.entries(ops).filter(([k, v]) => v && v.status === 'pending');
-            entries.forEach(([id, v]) => {
-                updateStage(v.stage, id);
-            });
+            syncStageOpsBatch(entries);
         });
     }
     const btnExportAll = document.getElementById('btnExportAllCustomers');
@@ -2273,19 +2327,8 @@ document.addEventListener('DOMContentLoaded', function() {
                     assistAnswer.textContent += ` [解决了${data.conflicts_resolved}个冲突]`;
                 }
 
-                // 状态修改成功后，刷新未来30天客户看板（保持当前筛选）
-                try {
-                    const activeBtn = document.querySelector('#status-filter-container .filter-btn.active');
-                    const currentFilter = activeBtn ? activeBtn.getAttribute('data-filter') : 'na';
-                    fetchUnsignedCustomers(currentFilter);
-                } catch (e) {
-                    // 回退为默认NA筛选
-                    fetchUnsignedCustomers('na');
-                }
-
-                // 同步刷新战区视图（空数组表示全部战区）
-                const zones = Array.isArray(window._selectedZones) ? window._selectedZones : [];
-                fetchFutureCustomersWithZones(zones);
+                // 状态修改成功后，刷新看板（保持当前筛选）
+                refreshStageBoards();
                 markStageOpSynced(jdyId);
                 renderUnsyncedBanner();
                 renderUnsyncedOpsList();
@@ -2300,6 +2343,67 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
     
+    // 阶段变更后刷新未来30天客户看板与战区视图
+    function refreshStageBoards() {
+        try {
+            const activeBtn = document.querySelector('#status-filter-container .filter-btn.active');
+            const currentFilter = activeBtn ? activeBtn.getAttribute('data-filter') : 'na';
+            fetchUnsignedCustomers(currentFilter);
+        } catch (e) {
+            // 回退为默认NA筛选
+            fetchUnsignedCustomers('na');
+        }
+
+        // 同步刷新战区视图（空数组表示全部战区）
+        const zones = Array.isArray(window._selectedZones) ? window._selectedZones : [];
+        fetchFutureCustomersWithZones(zones);
+    }
+
+    // 批量推进本地未同步的阶段变更：一次请求、一次写入，逐条返回结果
+    function syncStageOpsBatch(entries) {
+        if (!entries.length) return;
+        assistAnswer.textContent = `正在批量推进 ${entries.length} 条阶段变更...`;
+        fetch('/update_stage_batch', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                updates: entries.map(([id, v]) => ({ jdy_id: id, target_stage: v.stage })),
+                // 与单条推进一致：不做状态转换规则校验，逐条落地
+                atomic: false,
+                force: true
+            })
+        })
+        .then(response => {
+            const contentType = response.headers.get('content-type');
+            if (!contentType || !contentType.includes('application/json')) {
+                throw new Error('阶段推进服务不可用');
+            }
+            return response.json();
+        })
+        .then(data => {
+            const results = Array.isArray(data.results) ? data.results : [];
+            results.forEach(item => {
+                if (item.status === 'applied' && entries[item.index]) markStageOpSynced(entries[item.index][0]);
+            });
+            const failed = results.filter(item => item.status !== 'applied');
+            if (data.success) {
+                assistAnswer.textContent = `✅ 批量推进完成：成功${data.applied_count || 0}条` +
+                    (failed.length ? `，失败${failed.length}条（${failed.map(item => `${item.jdy_id}: ${item.error}`).join('；')}）` : '');
+                if (data.applied_count > 0) refreshStageBoards();
+            } else {
+                assistAnswer.textContent = `❌ 批量推进失败: ${data.error || '未知错误'}`;
+            }
+            renderUnsyncedBanner();
+            renderUnsyncedOpsList();
+        })
+        .catch(error => {
+            console.error('批量推进阶段错误:', error);
+            assistAnswer.textContent = `❌ 批量推进失败: 网络连接错误或服务不可用`;
+        });
+    }
+
     // 处理状态更新错误
     function handleStageUpdateError(data, stage, jdyId) {
         const errorType = data.error_type || 'unknown';
@@ -2406,7 +2510,8 @@ document.addEventListener('DOMContentLoaded', function() {
             customers: []
         };
         
-        const data = await safeJsonFetch(url, { credentials: 'same-origin' }, fallback);
+        const data = (await takeBundleSection('unsigned_customers', statusFilter))
+            || await safeJsonFetch(url, { credentials: 'same-origin' }, fallback);
         
         if (!data) return;
         
@@ -2887,8 +2992,34 @@ function initCalendarDisplay() {
     fetchMonthlyRevenue();
 }
 
-// 获取本月收款总金额
+// 获取本月收款总金额（首次加载优先使用启动数据包）
 function fetchMonthlyRevenue() {
+    takeBundleSection('monthly_revenue').then(section => {
+        if (section) {
+            showMonthlyRevenue(section);
+        } else {
+            requestMonthlyRevenue();
+        }
+    });
+}
+
+function showMonthlyRevenue(data) {
+    const revenueElement = document.getElementById('monthlyRevenue');
+    if (revenueElement) {
+        if (data.error) {
+            console.error('获取收款数据失败:', data.error);
+            revenueElement.textContent = '数据错误';
+        } else if (data.revenue !== undefined) {
+            // 格式化金额显示
+            const formattedRevenue = new Intl.NumberFormat('zh-CN').format(data.revenue);
+            revenueElement.textContent = formattedRevenue;
+        } else {
+            revenueElement.textContent = '--';
+        }
+    }
+}
+
+function requestMonthlyRevenue() {
     fetch('/get_monthly_revenue', {
         credentials: 'same-origin'
     })
@@ -2917,20 +3048,7 @@ function fetchMonthlyRevenue() {
         })
         .then(data => {
             if (!data) return;
-            
-            const revenueElement = document.getElementById('monthlyRevenue');
-            if (revenueElement) {
-                if (data.error) {
-                    console.error('获取收款数据失败:', data.error);
-                    revenueElement.textContent = '数据错误';
-                } else if (data.revenue !== undefined) {
-                    // 格式化金额显示
-                    const formattedRevenue = new Intl.NumberFormat('zh-CN').format(data.revenue);
-                    revenueElement.textContent = formattedRevenue;
-                } else {
-                    revenueElement.textContent = '--';
-                }
-            }
+            showMonthlyRevenue(data);
         })
         .catch(error => {
             console.error('获取收款数据失败:', error);
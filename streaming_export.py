@@ -0,0 +1,221 @@
+import io
+import re
+import csv
+import math
+import zipfile
+import logging
+from datetime import date, datetime
+from typing import Iterable, Iterator, List, Sequence
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+CSV_MIMETYPE = 'text/csv; charset=utf-8'
+
+# XML 1.0 不允许的控制字符（Excel 单元格中偶有出现）
+_ILLEGAL_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+# 样式 0：常规；样式 1：日期（yyyy-mm-dd）
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/></numFmts>'
+    '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+
+class _ChunkStream:
+    """只追加的内存缓冲：zipfile 写入后由生成器取走，不支持 seek（zipfile 自动改用数据描述符）"""
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        if data:
+            self._chunks.append(bytes(data))
+            self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _column_letter(index: int) -> str:
+    letters = ''
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+def _is_missing(value) -> bool:
+    if value is None:
+        return True
+    if isinstance(value, float) and math.isnan(value):
+        return True
+    # pandas.NaT / numpy.datetime64('NaT')
+    return value != value
+
+
+def _cell_xml(ref: str, value) -> str:
+    if _is_missing(value):
+        return ''
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        # numpy 标量
+        try:
+            value = value.item()
+        except (ValueError, AttributeError):
+            pass
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        if isinstance(value, float) and math.isinf(value):
+            value = str(value)
+        else:
+            return f'<c r="{ref}"><v>{value!r}</v></c>'
+    if isinstance(value, datetime) or (hasattr(value, 'to_pydatetime') and not isinstance(value, str)):
+        if hasattr(value, 'to_pydatetime'):
+            value = value.to_pydatetime()
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None)
+        serial = (value - _EXCEL_EPOCH).total_seconds() / 86400
+        return f'<c r="{ref}" s="1"><v>{serial!r}</v></c>'
+    if isinstance(value, date):
+        serial = (value - _EXCEL_EPOCH.date()).days
+        return f'<c r="{ref}" s="1"><v>{serial}</v></c>'
+    text = _ILLEGAL_XML_CHARS.sub('', str(value))
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def _row_xml(row_number: int, letters: List[str], values: Sequence) -> str:
+    cells = ''.join(_cell_xml(f'{letters[i]}{row_number}', value) for i, value in enumerate(values))
+    return f'<row r="{row_number}">{cells}</row>'
+
+
+def iter_xlsx(header: Sequence[str], rows: Iterable[Sequence], sheet_name: str = 'Sheet1',
+              flush_rows: int = 500) -> Iterator[bytes]:
+    """流式生成 XLSX：逐行写入 sheet XML（内联字符串）并压缩，每 flush_rows 行产出一次字节块
+
+    内存占用与行数无关；工作簿结构与样式为固定模板，单元格类型按值推断（数字/布尔/日期/文本）。
+    """
+    out = _ChunkStream()
+    letters = [_column_letter(i) for i in range(len(header))]
+    workbook_xml = (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{escape(sheet_name[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    )
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('[Content_Types].xml', _CONTENT_TYPES)
+        zf.writestr('_rels/.rels', _ROOT_RELS)
+        zf.writestr('xl/workbook.xml', workbook_xml)
+        zf.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+        zf.writestr('xl/styles.xml', _STYLES)
+        yield out.drain()
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write((
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetData>'
+            ).encode('utf-8'))
+            sheet.write(_row_xml(1, letters, header).encode('utf-8'))
+            for i, values in enumerate(rows, start=2):
+                sheet.write(_row_xml(i, letters, values).encode('utf-8'))
+                if i % flush_rows == 0:
+                    chunk = out.drain()
+                    if chunk:
+                        yield chunk
+            sheet.write(b'</sheetData></worksheet>')
+    yield out.drain()
+
+
+def _csv_value(value):
+    if _is_missing(value):
+        return ''
+    if hasattr(value, 'to_pydatetime') and not isinstance(value, str):
+        value = value.to_pydatetime()
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d') if value.time() == datetime.min.time() else value.isoformat(sep=' ')
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        try:
+            value = value.item()
+        except (ValueError, AttributeError):
+            pass
+    return value
+
+
+def iter_csv(header: Sequence[str], rows: Iterable[Sequence], flush_rows: int = 500) -> Iterator[bytes]:
+    """流式生成 CSV（UTF-8 带 BOM，Excel 可直接打开中文）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('﻿')
+    writer.writerow(header)
+    for i, values in enumerate(rows, start=1):
+        writer.writerow([_csv_value(v) for v in values])
+        if i % flush_rows == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue().encode('utf-8')
+
+
+def iter_frame_rows(frame, positions, columns: Sequence[str], batch_size: int = 1000) -> Iterator[tuple]:
+    """按行位置分批取出指定列的行（每批只物化 batch_size 行）"""
+    for start in range(0, len(positions), batch_size):
+        batch = frame.iloc[positions[start:start + batch_size]]
+        for row in batch[list(columns)].itertuples(index=False, name=None):
+            yield row
@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+# 仓库为平铺的顶层模块，测试直接按模块名导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+HEADER = ['用户ID', '公司名称', '客户阶段', '到期日期']
+
+
+@pytest.fixture
+def make_workbook(tmp_path):
+    """用 openpyxl 生成小型客户工作簿：rows 为 (用户ID, 公司名称, 客户阶段, 到期日期)，返回文件路径"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font
+
+    def build(rows, name='customers.xlsx', header=HEADER):
+        wb = Workbook()
+        ws = wb.active
+        ws.title = '客户'
+        ws.append(header)
+        for cell in ws[1]:
+            cell.font = Font(bold=True)
+        for row in rows:
+            ws.append(list(row))
+        wb.create_sheet('备注').append(['说明', '测试工作簿'])
+        path = str(tmp_path / name)
+        wb.save(path)
+        return path
+
+    return build
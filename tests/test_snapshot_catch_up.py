@@ -0,0 +1,110 @@
+import os
+import subprocess
+import sys
+import textwrap
+from datetime import datetime
+
+import pytest
+
+from customer_snapshot import CustomerSnapshotService
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROWS = [
+    ('abc001', '甲公司', '试用', datetime(2026, 1, 5)),
+    ('abc002', '乙公司', '试用', datetime(2026, 2, 5)),
+    (12345, '丙公司', '试用', datetime(2026, 3, 5)),
+]
+
+
+def _stage(snapshot, jdy_id):
+    return snapshot.df.iloc[snapshot.find_rows(jdy_id)[0]]['客户阶段']
+
+
+@pytest.fixture
+def workbook(make_workbook):
+    return make_workbook(ROWS)
+
+
+def _service(path, **kwargs):
+    kwargs.setdefault('stale_while_revalidate', True)
+    return CustomerSnapshotService(path, **kwargs)
+
+
+def test_catch_up_after_foreign_bump(workbook):
+    reader, writer = _service(workbook), _service(workbook)
+    first = reader.get()
+    assert first.source != 'journal'
+
+    writer.update_stages({'abc001': '已签约'})
+
+    snapshot = reader.get()
+    assert snapshot is not first
+    assert snapshot.source == 'journal'
+    assert _stage(snapshot, 'abc001') == '已签约'
+    assert snapshot.write_token == reader.coordinator_for().token()
+    assert snapshot.journal_entries == 1
+    metrics = reader.stats()['metrics']
+    assert (metrics['catch_ups'], metrics['loads']) == (1, 1)
+    # 追平后代数一致，再次读取直接命中
+    assert reader.get() is snapshot
+
+
+def test_catch_up_after_write_from_other_process(workbook):
+    reader = _service(workbook)
+    reader.get()
+    script = textwrap.dedent(f"""
+        import sys
+        sys.path.insert(0, {REPO!r})
+        from customer_snapshot import CustomerSnapshotService
+        service = CustomerSnapshotService({workbook!r})
+        assert service.update_stages({{'12345': '已流失', 'abc002': '跟进中'}}) is not None
+    """)
+    subprocess.run([sys.executable, '-c', script], check=True, timeout=60)
+
+    snapshot = reader.get()
+    assert snapshot.source == 'journal'
+    assert (_stage(snapshot, '12345'), _stage(snapshot, 'abc002')) == ('已流失', '跟进中')
+    assert snapshot.write_token == reader.coordinator_for().token()
+    assert reader.stats()['metrics']['catch_ups'] == 1
+
+
+def test_foreign_compaction_triggers_full_reload(workbook):
+    reader, writer = _service(workbook), _service(workbook)
+    reader.get()
+    writer.update_stages({'abc001': '已签约'})
+    writer.compact()
+
+    # 工作簿已改写：即使开启 stale_while_revalidate，写路径也必须拿到最新数据
+    snapshot = reader.get(allow_stale=False)
+    assert snapshot.source != 'journal'
+    assert snapshot.journal_entries == 0
+    assert _stage(snapshot, 'abc001') == '已签约'
+    metrics = reader.stats()['metrics']
+    assert (metrics['catch_ups'], metrics['loads']) == (0, 2)
+
+
+def test_discarded_journal_is_not_caught_up(workbook):
+    reader, writer = _service(workbook), _service(workbook)
+    writer.update_stages({'abc001': '已签约'})
+    assert _stage(reader.get(), 'abc001') == '已签约'
+
+    # 日志被丢弃但工作簿未变：无法增量追平，须重新加载
+    writer.discard_journal('（测试）')
+
+    snapshot = reader.get(allow_stale=False)
+    assert _stage(snapshot, 'abc001') == '试用'
+    assert snapshot.journal_entries == 0
+    assert reader.stats()['metrics']['catch_ups'] == 0
+
+
+def test_update_stages_builds_on_foreign_changes(workbook):
+    first, second = _service(workbook), _service(workbook)
+    first.get()
+    second.update_stages({'abc002': '跟进中'})
+
+    snapshot = first.update_stages({'abc001': '已签约'})
+
+    assert (_stage(snapshot, 'abc001'), _stage(snapshot, 'abc002')) == ('已签约', '跟进中')
+    assert snapshot.journal_entries == 2
+    assert snapshot.write_token == first.coordinator_for().token()
@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+
+from stage_journal import StageJournal
+from write_coordinator import WriteCoordinator
+
+
+def _journal(tmp_path, name='customers.xlsx'):
+    return StageJournal(StageJournal.default_path(str(tmp_path / name)))
+
+
+def _entry(jdy_id, stage):
+    return json.dumps({'ts': '2026-01-01T00:00:00', 'jdy_id': jdy_id, 'stage': stage, 'batch': '1', 'meta': {}})
+
+
+def test_replay_last_write_wins(tmp_path):
+    journal = _journal(tmp_path)
+    assert journal.state() == ({}, 0, None)
+
+    journal.append({'ABC': '试用', 'def': '跟进中'})
+    journal.append({'abc': '已签约'})
+
+    overlay, entries, digest = journal.state()
+    assert overlay == {'abc': '已签约', 'def': '跟进中'}
+    assert entries == 3
+    assert digest is not None
+    with open(journal.path, 'rb') as f:
+        assert 'journal_id' in json.loads(f.readline())
+    # 另一个实例（其它进程）从头回放得到相同结果
+    assert _journal(tmp_path).state() == (overlay, entries, digest)
+
+
+def test_truncate_keeps_entries_appended_after_state(tmp_path):
+    compactor, writer = _journal(tmp_path), _journal(tmp_path)
+    compactor.append({'a': '试用', 'b': '试用'})
+    _, entries, _ = compactor.state()
+    # 压实方读取条目数之后，其它进程又追加了一批
+    writer.append({'c': '已签约', 'a': '跟进中'})
+
+    compactor.truncate(entries)
+
+    assert compactor.state()[:2] == ({'c': '已签约', 'a': '跟进中'}, 2)
+    # 追加方发现日志已被重建（新文件头），从头回放
+    assert writer.state()[:2] == ({'c': '已签约', 'a': '跟进中'}, 2)
+    writer.append({'d': '已流失'})
+    assert compactor.state()[:2] == ({'c': '已签约', 'a': '跟进中', 'd': '已流失'}, 3)
+
+
+def test_truncate_with_concurrent_appends_loses_nothing(tmp_path):
+    excel_path = str(tmp_path / 'customers.xlsx')
+    coordinator = WriteCoordinator(excel_path)
+    compactor = StageJournal(StageJournal.default_path(excel_path))
+    total = 200
+
+    def write():
+        writer = StageJournal(StageJournal.default_path(excel_path))
+        for i in range(total):
+            with coordinator:
+                writer.append({f'k{i:03d}': str(i)})
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    removed = 0
+    while thread.is_alive() or removed == 0:
+        with coordinator:
+            _, entries, _ = compactor.state()
+            if entries:
+                compactor.truncate(entries)
+                removed += entries
+    thread.join()
+
+    overlay, entries, _ = compactor.state()
+    assert removed + entries == total
+    # 保留的恰好是最后追加的 entries 条
+    assert sorted(overlay) == [f'k{i:03d}' for i in range(total - entries, total)]
+
+
+def test_truncate_counts_entries_like_replay(tmp_path):
+    journal = _journal(tmp_path)
+    lines = [
+        json.dumps({'journal_id': 'old', 'created': '2026-01-01T00:00:00'}),
+        _entry('a', '试用'),
+        '{not json',
+        '',
+        _entry('b', '跟进中'),
+        json.dumps({'foo': 1}),
+        json.dumps([1, 2]),
+        _entry('c', '已签约'),
+    ]
+    partial = _entry('d', '已流失')
+    with open(journal.path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n' + partial[:10])
+
+    overlay, entries, _ = journal.state()
+    assert (overlay, entries) == ({'a': '试用', 'b': '跟进中', 'c': '已签约'}, 3)
+
+    journal.truncate(2)
+
+    assert journal.state()[:2] == ({'c': '已签约'}, 1)
+    with open(journal.path, 'rb') as f:
+        content = f.read().decode('utf-8')
+    assert '{not json' not in content and '"foo"' not in content
+    # 读取时尚未写完的最后一行原样保留，写完后可被回放
+    assert content.endswith(partial[:10])
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write(partial[10:] + '\n')
+    assert journal.state()[:2] == ({'c': '已签约', 'd': '已流失'}, 2)
+
+
+def test_truncate_all_removes_file(tmp_path):
+    journal = _journal(tmp_path)
+    journal.append({'a': '试用'})
+    journal.truncate(1)
+    assert not os.path.exists(journal.path)
+    assert journal.state() == ({}, 0, None)
+
+
+def test_rebuilt_journal_is_replayed_from_start(tmp_path):
+    reader, other = _journal(tmp_path), _journal(tmp_path)
+    other.append({'a': '试用'})
+    assert reader.state()[:2] == ({'a': '试用'}, 1)
+
+    # 其它进程清空后重建，新文件比旧偏移量更长（且可能复用同一 inode）
+    other.reset()
+    other.append({'b': '已签约', 'c': '跟进中', 'd': '已流失'})
+
+    assert reader.state()[:2] == ({'b': '已签约', 'c': '跟进中', 'd': '已流失'}, 3)
@@ -0,0 +1,103 @@
+import os
+import stat
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from customer_index import normalize_id
+from xlsx_patch import XlsxPatchError, _first_sheet_path, patch_column
+
+ROWS = [
+    ('abc001', '甲公司', '试用', datetime(2026, 1, 5)),
+    (12345, '乙公司', '试用', datetime(2026, 2, 5)),
+    (None, '无ID公司', '试用', datetime(2026, 3, 5)),
+    ('ABC002', '丙公司', None, datetime(2026, 4, 5)),
+    (67890, '丁公司', '已签约', datetime(2026, 5, 5)),
+]
+
+
+def _members(path):
+    with zipfile.ZipFile(path) as zf:
+        return {info.filename: (info.CRC, info.compress_size, zf.read(info)) for info in zf.infolist()}, \
+            _first_sheet_path(zf)
+
+
+def test_patch_round_trip_readable_by_openpyxl_and_pandas(make_workbook):
+    import pandas as pd
+    from openpyxl import load_workbook
+
+    path = make_workbook(ROWS)
+    before = pd.read_excel(path)
+    updates = {'abc001': '已签约', '12345': '已流失', 'abc002': '跟进中'}
+
+    assert patch_column(path, '用户ID', '客户阶段', updates, normalize_id) == 3
+
+    ws = load_workbook(path).worksheets[0]
+    assert [row[2] for row in ws.iter_rows(min_row=2, values_only=True)] == \
+        ['已签约', '已流失', '试用', '跟进中', '已签约']
+
+    after = pd.read_excel(path)
+    assert list(after.columns) == list(before.columns)
+    assert after['客户阶段'].tolist() == ['已签约', '已流失', '试用', '跟进中', '已签约']
+    # 除目标列外的数据（含数值ID与空ID行）与修补前一致
+    untouched = ['用户ID', '公司名称', '到期日期']
+    pd.testing.assert_frame_equal(after[untouched], before[untouched])
+
+
+def test_numeric_ids_match_pandas_normalization(make_workbook):
+    import pandas as pd
+
+    path = make_workbook(ROWS)
+    # pandas 把含空值的数值ID列读成 float（12345.0），两侧归一化结果必须一致
+    ids = pd.read_excel(path)['用户ID']
+    assert ids.iloc[1] == 12345.0
+    keys = [normalize_id(value) for value in ids]
+    assert keys == ['abc001', '12345', '', 'abc002', '67890']
+
+    assert patch_column(path, '用户ID', '客户阶段', {'67890': '已流失', '': '不应写入'}, normalize_id) == 1
+    assert pd.read_excel(path)['客户阶段'].fillna('').tolist() == ['试用', '试用', '试用', '', '已流失']
+
+
+def test_other_members_unchanged(make_workbook):
+    path = make_workbook(ROWS)
+    before, sheet_path = _members(path)
+
+    patch_column(path, '用户ID', '客户阶段', {'abc001': '已签约'}, normalize_id)
+
+    after, _ = _members(path)
+    assert list(after) == list(before)
+    for name, member in before.items():
+        if name == sheet_path:
+            assert after[name][2] != member[2]
+        else:
+            assert after[name] == member, name
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+
+
+def test_file_mode_preserved(make_workbook):
+    path = make_workbook(ROWS)
+    os.chmod(path, 0o640)
+
+    patch_column(path, '用户ID', '客户阶段', {'abc001': '已签约'}, normalize_id)
+
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o640
+    assert [name for name in os.listdir(os.path.dirname(path)) if name.startswith('.patch_')] == []
+
+
+def test_no_match_leaves_file_untouched(make_workbook):
+    path = make_workbook(ROWS)
+    with open(path, 'rb') as f:
+        original = f.read()
+
+    assert patch_column(path, '用户ID', '客户阶段', {'missing': '已签约'}, normalize_id) == 0
+
+    with open(path, 'rb') as f:
+        assert f.read() == original
+
+
+def test_missing_target_column_raises(make_workbook):
+    path = make_workbook([('abc001', '甲公司', 'x', 'y')], header=['用户ID', '公司名称', '备注', '到期日期'])
+    with pytest.raises(XlsxPatchError):
+        patch_column(path, '用户ID', '客户阶段', {'abc001': '已签约'}, normalize_id)
@@ -0,0 +1,170 @@
+import os
+import time
+import uuid
+import logging
+import tempfile
+import threading
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地开发：只做进程内串行化
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class WriteLockTimeout(Exception):
+    """等待跨进程写锁超时"""
+
+
+class WriteCoordinator:
+    """工作簿写协调器：多个 gunicorn worker 共用同一数据文件时串行化所有写操作
+
+    - 写锁：<工作簿>.lock 上的 fcntl.flock 排他锁 + 进程内可重入锁，`with coordinator:` 使用；
+      同一进程内按路径共用一个实例（for_path），保证只有一个文件描述符持有 flock
+    - 读失效：每次写入在持锁期间调用 bump() 改写 <工作簿>.generation，
+      各进程读取快照时比较 token()，不一致即说明其它进程写过，需要追平或重新加载
+    """
+
+    _registry: Dict[str, 'WriteCoordinator'] = {}
+    _registry_lock = threading.Lock()
+
+    def __init__(self, excel_path: str, timeout: float = 30):
+        self.lock_path = f"{excel_path}.lock"
+        self.generation_path = f"{excel_path}.generation"
+        self.timeout = timeout
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+        self._stats_lock = threading.Lock()
+        self._metrics = {
+            'acquisitions': 0,
+            'contended': 0,
+            'timeouts': 0,
+            'bumps': 0,
+            'max_wait_ms': 0.0,
+            'total_wait_ms': 0.0,
+        }
+
+    @classmethod
+    def for_path(cls, excel_path: str) -> 'WriteCoordinator':
+        with cls._registry_lock:
+            coordinator = cls._registry.get(excel_path)
+            if coordinator is None:
+                coordinator = cls._registry[excel_path] = cls(excel_path)
+            return coordinator
+
+    def _acquire_file_lock(self) -> bool:
+        """获取 flock；返回是否发生过等待"""
+        directory = os.path.dirname(self.lock_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = time.time() + self.timeout
+        delay = 0.005
+        contended = False
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    contended = True
+                    if time.time() >= deadline:
+                        raise WriteLockTimeout(f'等待数据文件写锁超时({self.timeout}s): {self.lock_path}')
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.05)
+        except BaseException:
+            os.close(fd)
+            raise
+        self._fd = fd
+        return contended
+
+    def __enter__(self):
+        started = time.time()
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self._metrics['timeouts'] += 1
+            raise WriteLockTimeout(f'等待数据文件写锁超时({self.timeout}s): {self.lock_path}')
+        if self._depth == 0 and fcntl is not None:
+            try:
+                contended = self._acquire_file_lock()
+            except WriteLockTimeout:
+                self._thread_lock.release()
+                with self._stats_lock:
+                    self._metrics['timeouts'] += 1
+                raise
+            except BaseException:
+                self._thread_lock.release()
+                raise
+            wait_ms = (time.time() - started) * 1000
+            with self._stats_lock:
+                self._metrics['acquisitions'] += 1
+                self._metrics['contended'] += int(contended)
+                self._metrics['total_wait_ms'] += wait_ms
+                self._metrics['max_wait_ms'] = max(self._metrics['max_wait_ms'], round(wait_ms, 2))
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        try:
+            if self._depth == 0 and self._fd is not None:
+                fd, self._fd = self._fd, None
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_UN)
+                finally:
+                    os.close(fd)
+        finally:
+            self._thread_lock.release()
+        return False
+
+    def token(self) -> Optional[str]:
+        """当前写入代数标记；从未写过时为 None"""
+        try:
+            with open(self.generation_path, 'r', encoding='utf-8') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"读取写入代数文件失败: {str(e)}")
+            return None
+
+    def bump(self) -> str:
+        """持锁期间调用：生成新的写入代数标记并原子替换代数文件，返回新标记"""
+        current = self.token() or '0'
+        try:
+            counter = int(current.split(':', 1)[0]) + 1
+        except ValueError:
+            counter = 1
+        # 计数 + 进程号 + 随机串：代数文件被删除后重新计数也不会与旧标记相同
+        token = f"{counter}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        fd, tmp_path = tempfile.mkstemp(prefix='.generation_', suffix='.tmp',
+                                        dir=os.path.dirname(self.generation_path) or None)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(token)
+            os.replace(tmp_path, self.generation_path)
+        except Exception:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._stats_lock:
+            self._metrics['bumps'] += 1
+        return token
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            metrics = dict(self._metrics)
+        total_wait = metrics.pop('total_wait_ms')
+        metrics['avg_wait_ms'] = round(total_wait / metrics['acquisitions'], 2) if metrics['acquisitions'] else None
+        return {
+            'lock_path': self.lock_path,
+            'cross_process': fcntl is not None,
+            'held': self._depth > 0,
+            'token': self.token(),
+            'metrics': metrics,
+        }
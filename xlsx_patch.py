@@ -0,0 +1,285 @@
+import io
+import os
+import re
+import zlib
+import html
+import time
+import shutil
+import struct
+import logging
+import tempfile
+import posixpath
+import zipfile
+from typing import Callable, Dict, List, Optional, Tuple
+from xml.sax.saxutils import escape
+
+logger = logging.getLogger(__name__)
+
+_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+_CENTRAL_HEADER = struct.Struct('<4s4B4HL2L5H2L')
+_END_RECORD = struct.Struct('<4s4H2LH')
+_DATA_DESCRIPTOR_SIG = b'PK\x07\x08'
+_ZIP32_LIMIT = 0xFFFFFFFF
+
+_ROW_RE = re.compile(r'<row\b[^>]*?(?:/>|>.*?</row>)', re.S)
+_ROW_NUM_RE = re.compile(r'<row\b[^>]*?\br="(\d+)"')
+_CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_CELL_REF_RE = re.compile(r'\br="([A-Z]+)(\d+)"')
+_CELL_TYPE_RE = re.compile(r'\bt="([^"]*)"')
+_CELL_STYLE_RE = re.compile(r'\bs="([^"]*)"')
+_TEXT_RE = re.compile(r'<t\b[^>]*?(?:/>|>(.*?)</t>)', re.S)
+_VALUE_RE = re.compile(r'<v>(.*?)</v>', re.S)
+
+
+class XlsxPatchError(Exception):
+    """工作簿结构不支持就地修补（调用方应退回整表写回）"""
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for ch in letters:
+        index = index * 26 + (ord(ch) - 64)
+    return index
+
+
+def _first_sheet_path(zf: zipfile.ZipFile) -> str:
+    """pandas.read_excel 默认读取的第一个工作表在压缩包中的路径"""
+    workbook = zf.read('xl/workbook.xml').decode('utf-8')
+    sheet = re.search(r'<sheet\b[^>]*?/?>', workbook)
+    if not sheet:
+        raise XlsxPatchError('workbook.xml 中没有工作表')
+    rid = re.search(r'\br:id="([^"]+)"|\bid="([^"]+)"', sheet.group(0))
+    if not rid:
+        raise XlsxPatchError('工作表缺少关系ID')
+    rid = rid.group(1) or rid.group(2)
+    rels = zf.read('xl/_rels/workbook.xml.rels').decode('utf-8')
+    for rel in re.finditer(r'<Relationship\b[^>]*?/?>', rels):
+        attrs = rel.group(0)
+        if re.search(rf'\bId="{re.escape(rid)}"', attrs):
+            target = re.search(r'\bTarget="([^"]+)"', attrs).group(1)
+            if target.startswith('/'):
+                return target.lstrip('/')
+            return posixpath.normpath(posixpath.join('xl', target))
+    raise XlsxPatchError(f'找不到工作表关系 {rid}')
+
+
+def _shared_strings(zf: zipfile.ZipFile) -> List[str]:
+    try:
+        xml = zf.read('xl/sharedStrings.xml').decode('utf-8')
+    except KeyError:
+        return []
+    strings = []
+    for si in re.finditer(r'<si\b[^>]*>(.*?)</si>', xml, re.S):
+        strings.append(''.join(html.unescape(t.group(1) or '') for t in _TEXT_RE.finditer(si.group(1))))
+    return strings
+
+
+def _cell_type(attrs: str) -> str:
+    cell_type = _CELL_TYPE_RE.search(attrs)
+    return cell_type.group(1) if cell_type else 'n'
+
+
+def _cell_text(attrs: str, body: Optional[str], shared: Callable[[], List[str]]) -> str:
+    if not body:
+        return ''
+    cell_type = _cell_type(attrs)
+    if cell_type == 'inlineStr':
+        return ''.join(html.unescape(t.group(1) or '') for t in _TEXT_RE.finditer(body))
+    value = _VALUE_RE.search(body)
+    if not value:
+        return ''
+    text = html.unescape(value.group(1))
+    if cell_type == 's':
+        try:
+            return shared()[int(text)]
+        except (ValueError, IndexError):
+            return ''
+    return text
+
+
+def _cell_value(attrs: str, body: Optional[str], shared: Callable[[], List[str]]):
+    """键列取值：数值单元格返回 float（与 pandas 读入的值同类型，两侧交给同一个归一化函数），其余返回文本"""
+    text = _cell_text(attrs, body, shared)
+    if text and _cell_type(attrs) == 'n':
+        try:
+            return float(text)
+        except ValueError:
+            pass
+    return text
+
+
+def _new_cell(ref: str, attrs: str, value) -> str:
+    style = _CELL_STYLE_RE.search(attrs or '')
+    style_attr = f' s="{style.group(1)}"' if style else ''
+    if value is None or value == '':
+        return f'<c r="{ref}"{style_attr}/>'
+    return (f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">'
+            f'{escape(str(value))}</t></is></c>')
+
+
+def _patch_row(row_xml: str, row_num: str, column: str, value) -> str:
+    """替换（或按列序插入）行内指定列的单元格"""
+    target_index = _column_index(column)
+    ref = f'{column}{row_num}'
+    for cell in _CELL_RE.finditer(row_xml):
+        cell_ref = _CELL_REF_RE.search(cell.group(1))
+        if not cell_ref:
+            raise XlsxPatchError(f'第{row_num}行存在无引用的单元格')
+        index = _column_index(cell_ref.group(1))
+        if index == target_index:
+            return row_xml[:cell.start()] + _new_cell(ref, cell.group(1), value) + row_xml[cell.end():]
+        if index > target_index:
+            return row_xml[:cell.start()] + _new_cell(ref, '', value) + row_xml[cell.start():]
+    if row_xml.endswith('/>'):
+        return row_xml[:-2] + '>' + _new_cell(ref, '', value) + '</row>'
+    end = row_xml.rfind('</row>')
+    return row_xml[:end] + _new_cell(ref, '', value) + row_xml[end:]
+
+
+def patch_sheet_xml(xml: str, key_header: str, target_header: str, updates: Dict[str, object],
+                    normalize_key: Callable[[object], str], shared: Callable[[], List[str]]) -> Tuple[str, int]:
+    """按键列取值定位行，改写目标列单元格；返回 (新XML, 改写的单元格数)"""
+    rows = _ROW_RE.finditer(xml)
+    header = next(rows, None)
+    if header is None:
+        raise XlsxPatchError('工作表为空')
+    columns = {}
+    for cell in _CELL_RE.finditer(header.group(0)):
+        cell_ref = _CELL_REF_RE.search(cell.group(1))
+        if cell_ref:
+            columns[_cell_text(cell.group(1), cell.group(2), shared).strip()] = cell_ref.group(1)
+    if key_header not in columns:
+        raise XlsxPatchError(f'表头缺少键列: {key_header}')
+    if target_header not in columns:
+        raise XlsxPatchError(f'表头缺少目标列: {target_header}')
+    key_column = columns[key_header]
+    target_column = columns[target_header]
+
+    pieces, last, patched = [], 0, 0
+    for row in rows:
+        row_xml = row.group(0)
+        row_num = _ROW_NUM_RE.match(row_xml)
+        if not row_num:
+            raise XlsxPatchError('存在无行号的行')
+        row_num = row_num.group(1)
+        key_ref = f'r="{key_column}{row_num}"'
+        key_cell = None
+        for cell in _CELL_RE.finditer(row_xml):
+            if key_ref in cell.group(1):
+                key_cell = cell
+                break
+        if key_cell is None:
+            continue
+        key = normalize_key(_cell_value(key_cell.group(1), key_cell.group(2), shared))
+        if key not in updates:
+            continue
+        pieces.append(xml[last:row.start()])
+        pieces.append(_patch_row(row_xml, row_num, target_column, updates[key]))
+        last = row.end()
+        patched += 1
+    pieces.append(xml[last:])
+    return ''.join(pieces), patched
+
+
+def _dos_datetime(date_time) -> Tuple[int, int]:
+    year, month, day, hour, minute, second = date_time
+    return (hour << 11) | (minute << 5) | (second // 2), ((year - 1980) << 9) | (month << 5) | day
+
+
+def _raw_member(data: bytes, info: zipfile.ZipInfo) -> bytes:
+    """成员在源文件中的原始字节（本地文件头 + 压缩数据 + 数据描述符），原样复制"""
+    start = info.header_offset
+    header = _LOCAL_HEADER.unpack_from(data, start)
+    if header[0] != b'PK\x03\x04':
+        raise XlsxPatchError(f'成员 {info.filename} 的本地文件头损坏')
+    end = start + _LOCAL_HEADER.size + header[9] + header[10] + info.compress_size
+    if info.flag_bits & 0x08:
+        end += 16 if data[end:end + 4] == _DATA_DESCRIPTOR_SIG else 12
+    return data[start:end]
+
+
+def _central_record(info: zipfile.ZipInfo, offset: int, crc: int, compress_size: int, file_size: int,
+                    flag_bits: int, compress_type: int, date_time) -> bytes:
+    name = info.filename.encode('utf-8' if flag_bits & 0x800 else 'cp437')
+    dostime, dosdate = _dos_datetime(date_time)
+    return _CENTRAL_HEADER.pack(
+        b'PK\x01\x02', info.create_version, info.create_system, info.extract_version, info.reserved,
+        flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size,
+        len(name), len(info.extra), len(info.comment), 0, info.internal_attr, info.external_attr, offset
+    ) + name + info.extra + info.comment
+
+
+def patch_column(path: str, key_header: str, target_header: str, updates: Dict[str, object],
+                 normalize_key: Callable[[object], str] = lambda value: str(value).strip()) -> int:
+    """就地修补工作簿某一列：updates 为 {键列取值（归一化后）: 新值}，返回改写的单元格数
+
+    只重写第一个工作表的 sheet XML 成员，其余成员（样式、主题、共享字符串等）按原始压缩字节复制；
+    结果先写入同目录临时文件，再 os.replace 原子替换。结构不支持时抛出 XlsxPatchError。
+    """
+    started = time.time()
+    with open(path, 'rb') as f:
+        data = f.read()
+    zf = zipfile.ZipFile(io.BytesIO(data))
+    infos = zf.infolist()
+    if any(i.compress_size >= _ZIP32_LIMIT or i.file_size >= _ZIP32_LIMIT or i.header_offset >= _ZIP32_LIMIT
+           for i in infos):
+        raise XlsxPatchError('暂不支持 ZIP64 工作簿')
+    sheet_path = _first_sheet_path(zf)
+    sheet_info = zf.getinfo(sheet_path)
+
+    cache = {}
+
+    def shared():
+        if 'strings' not in cache:
+            cache['strings'] = _shared_strings(zf)
+        return cache['strings']
+
+    xml = zf.read(sheet_info).decode('utf-8')
+    new_xml, patched = patch_sheet_xml(xml, key_header, target_header, updates, normalize_key, shared)
+    if not patched:
+        return 0
+
+    sheet_bytes = new_xml.encode('utf-8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    sheet_compressed = compressor.compress(sheet_bytes) + compressor.flush()
+    sheet_crc = zlib.crc32(sheet_bytes) & 0xFFFFFFFF
+    now = time.localtime()[:6]
+
+    directory = os.path.dirname(path) or None
+    fd, tmp_path = tempfile.mkstemp(prefix='.patch_', suffix='.xlsx', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            central, offset = [], 0
+            for info in infos:
+                if info.filename == sheet_path:
+                    flag_bits = (info.flag_bits & ~0x08) & 0xFFFF
+                    name = info.filename.encode('utf-8' if flag_bits & 0x800 else 'cp437')
+                    dostime, dosdate = _dos_datetime(now)
+                    block = _LOCAL_HEADER.pack(b'PK\x03\x04', 20, flag_bits, zipfile.ZIP_DEFLATED, dostime, dosdate,
+                                               sheet_crc, len(sheet_compressed), len(sheet_bytes),
+                                               len(name), 0) + name + sheet_compressed
+                    central.append(_central_record(info, offset, sheet_crc, len(sheet_compressed), len(sheet_bytes),
+                                                   flag_bits, zipfile.ZIP_DEFLATED, now))
+                else:
+                    block = _raw_member(data, info)
+                    central.append(_central_record(info, offset, info.CRC, info.compress_size, info.file_size,
+                                                   info.flag_bits, info.compress_type, info.date_time))
+                out.write(block)
+                offset += len(block)
+            directory_bytes = b''.join(central)
+            out.write(directory_bytes)
+            out.write(_END_RECORD.pack(b'PK\x05\x06', 0, 0, len(central), len(central),
+                                       len(directory_bytes), offset, len(zf.comment)) + zf.comment)
+            out.flush()
+            os.fsync(out.fileno())
+        # mkstemp 创建的文件权限为 0600，替换前沿用原工作簿的权限
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    logger.info(f"工作簿就地修补完成: {target_header}列改写{patched}个单元格，耗时{(time.time() - started) * 1000:.0f}ms")
+    return patched